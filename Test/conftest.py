@@ -0,0 +1,64 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeParameter:
+    """不连接仪器的参数，记录每一次设置"""
+
+    def __init__(self, name: str, value: float = 0., step: float = None, log: list = None):
+        self.name = name
+        self.value = value
+        self.step = step
+        self.history = []
+        self.log = log
+
+    def __call__(self, *args):
+        if not args:
+            return self.value
+        self.value = float(args[0])
+        self.history.append(self.value)
+        if self.log is not None:
+            self.log.append((self.name, self.value))
+
+
+class FakeChannel:
+    def __init__(self, dac, channel: int):
+        self.channel = channel
+        self.voltage = FakeParameter(f'{dac.name}_ch{channel}_voltage')
+        self.voltage.short_name = 'voltage'
+        self.voltage.instrument = self
+        self.voltage.root_instrument = dac
+
+
+class FakeDAC:
+    """
+    模拟SP1060：通道电压满足scan.dac_channel的条件，set_voltages一次设置多个通道，每次调用记为一条指令
+    """
+    lsb = 20 / 2 ** 24
+
+    def __init__(self, name: str = 'dac', channels: int = 4):
+        self.name = name
+        self.commands = []
+        self.channels = {num: FakeChannel(self, num) for num in range(1, channels + 1)}
+
+    def dac_code(self, val):
+        return np.trunc((np.asarray(val) + 10) / self.lsb).astype(np.int64)
+
+    def set_voltages(self, values: dict):
+        self.commands.append(dict(values))
+        for channel, value in values.items():
+            self.channels[channel].voltage.value = value
+
+
+@pytest.fixture
+def dac():
+    return FakeDAC()
+
+
+@pytest.fixture
+def make_parameter():
+    return FakeParameter
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from tools.lockin import LockIn
+
+sample_rate, memory_size, frequency = 1e4, 1000, 137.
+
+
+def signal(start: int, n: int, amplitude: float = 1., theta: float = 30.):
+    t = (start + np.arange(n)) / sample_rate
+    return amplitude * np.cos(2 * np.pi * frequency * t + np.deg2rad(theta))
+
+
+def test_phase_is_continuous_across_blocks():
+    lockin = LockIn(frequency, sample_rate, memory_size)
+    # 每个block不是整数个周期，内部参考的相位需要按累计的采样点数推进
+    results = [lockin.demodulate(signal(num * memory_size, memory_size)) for num in range(5)]
+    assert [result['theta'] for result in results] == pytest.approx([30.] * 5, abs=1.)
+    assert [result['R'] for result in results] == pytest.approx([1.] * 5, abs=0.02)
+
+
+def test_points_axis_counts_as_consecutive_blocks():
+    lockin = LockIn(frequency, sample_rate, memory_size)
+    blocks = np.stack([signal(num * memory_size, memory_size) for num in range(4)])[np.newaxis]
+    theta = lockin.demodulate(blocks)['theta']
+    assert theta.shape == (1, 4)
+    assert theta[0] == pytest.approx([30.] * 4, abs=1.)
+    assert lockin.samples == 4 * memory_size
+    lockin.reset()
+    assert lockin.demodulate(signal(0, memory_size))['theta'] == pytest.approx(30., abs=1.)
+
+
+def test_reference_channel_gives_the_relative_phase():
+    lockin = LockIn(frequency, sample_rate, memory_size, reference='Dev1/ai5')
+    # 触发采集的block开始时刻任意，相位相对于参考通道计算
+    for start in (0, 123, 4567):
+        block = np.stack([signal(start, memory_size, 0.5, 75.), signal(start, memory_size, 2., 30.)])
+        x, theta = lockin.select(block, np.array([0, 0]), ['X', 'theta'], reference=1)
+        assert theta == pytest.approx(45., abs=1.)
+        assert x == pytest.approx(0.5 * np.cos(np.deg2rad(45.)), abs=0.02)
+
+
+def test_block_shorter_than_a_period_is_rejected():
+    with pytest.raises(ValueError):
+        LockIn(1., sample_rate, memory_size)
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from tools.scan import ScanPlan, ramp_parallel
+from tools.settling import SettleModel
+
+
+def test_plan_drops_writes_quantized_to_the_same_code(dac):
+    voltage = dac.channels[1].voltage
+    # 相邻两点之间的差小于一个码值，第二个点不需要写入
+    x = np.array([0., dac.lsb / 4, 1e-3, 2e-3])
+    plan = ScanPlan([x], [voltage])
+    assert plan.writes[0][:, 0].tolist() == [False, False, True, True]
+    assert plan.n_writes == 2
+    assert plan.n_dropped == 2
+
+
+def test_plan_batches_channels_of_one_dac(dac, make_parameter):
+    gates = (dac.channels[1].voltage, dac.channels[2].voltage)
+    other = make_parameter('other')
+    x = np.linspace(0, 0.1, 5)
+    plan = ScanPlan([x, np.linspace(0, 0.2, 3)], [gates, other])
+    # 同一台DAC上的两个通道每个点只需要一条指令，x的写操作在每一行中重复
+    assert plan.n_commands == 4 * 3 + 2
+    for point in range(plan.n_points):
+        plan.apply(point)
+    assert len(dac.commands) == 4 * 3
+    assert all(set(command) == {1, 2} for command in dac.commands)
+    assert dac.commands[-1] == {1: 0.1, 2: 0.1}
+    assert other.history == [0.1, 0.2]
+
+
+def test_settle_times_cover_the_return_to_the_row_start(make_parameter):
+    x, y = make_parameter('x'), make_parameter('y')
+    models = {'x': SettleModel(1e-3), 'y': SettleModel(1e-4)}
+    plan = ScanPlan([np.linspace(0, 0.1, 5), np.linspace(0, 0.01, 3)], [x, y])
+    waits = plan.settle_times(models, 0.)
+    step = models['x'].wait(0.025)
+    back = models['x'].wait(0.1)
+    assert waits[1] == pytest.approx(step)
+    # 每一行的第一个点在x回到起点之后等待x的回程
+    assert waits[0] == pytest.approx(back)
+    assert waits[5] == pytest.approx(back)
+
+
+def test_ramp_parallel_moves_in_lockstep(make_parameter):
+    log = []
+    a = make_parameter('a', 0., log=log)
+    b = make_parameter('b', 1., log=log)
+    c = make_parameter('c', 0.5, log=log)
+    ramp_parallel([a, b, c], [0.1, 0.9, 0.5], step=0.02, delay=0)
+    # 最长的一条ramp需要5步，其余参数与之同时出发、同时到达
+    assert len(a.history) == len(b.history) == 5
+    assert np.allclose(a.history, np.linspace(0, 0.1, 6)[1:])
+    assert np.allclose(b.history, np.linspace(1, 0.9, 6)[1:])
+    assert np.all(np.abs(np.diff([0.] + a.history)) <= 0.02 + 1e-12)
+    # 已经在终点的参数不设置
+    assert c.history == []
+    # 每一步中所有参数都设置之后才进入下一步
+    names = [name for name, _ in log]
+    assert names == ['a', 'b'] * 5
+
+
+class Failing:
+    name = 'broken'
+
+    def __call__(self, *args):
+        if args:
+            raise OSError('timeout')
+        return 0.
+
+
+def test_ramp_parallel_continues_after_a_failure(make_parameter):
+    a = make_parameter('a', 0.)
+    with pytest.raises(RuntimeError, match='broken'):
+        ramp_parallel([a, Failing()], 0.05, step=0.01, delay=0)
+    assert a.value == pytest.approx(0.05)
@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+import numpy as np
+import pytest
+from tools.scan import Scan
+from tools.scheduler import ScanQueue
+
+
+class FakeScan:
+    """只保存扫描范围和设置的Scan，scan_1d记录执行时的范围"""
+    spec_settings = ('sleep',)
+    scan_spec = Scan.scan_spec
+    apply_spec = Scan.apply_spec
+
+    def __init__(self, acq_channels=('Dev1/ai0',)):
+        self._ranges = {'scan_1d': [np.array([0])]}
+        self.sleep = 0.1
+        self.acq_channels = list(acq_channels)
+        self.calls = []
+
+    def scan_1d(self, scan_x: int):
+        self.calls.append((scan_x, self._ranges['scan_1d'][0].tolist(), self.sleep))
+
+    def fail(self):
+        raise RuntimeError('boom')
+
+    def interrupt(self):
+        raise KeyboardInterrupt
+
+    def wait(self, seconds: float):
+        self.calls.append(threading.current_thread().name)
+        time.sleep(seconds)
+
+
+def test_jobs_run_with_the_spec_at_submit(tmp_path):
+    scan = FakeScan()
+    queue = ScanQueue(str(tmp_path / 'queue.json'))
+    queue.register('scan', scan)
+    scan._ranges['scan_1d'][0], scan.sleep = np.arange(3), 0.2
+    queue.submit('scan', 'scan_1d', 0)
+    scan._ranges['scan_1d'][0], scan.sleep = np.arange(5), 0.3
+    queue.submit('scan', 'scan_1d', 0)
+    queue.run()
+    assert scan.calls == [(0, [0, 1, 2], 0.2), (0, [0, 1, 2, 3, 4], 0.3)]
+
+
+def test_priority_and_dependencies(tmp_path):
+    scan = FakeScan()
+    queue = ScanQueue(str(tmp_path / 'queue.json'))
+    queue.register('scan', scan)
+    failed = queue.submit('scan', 'fail')
+    skipped = queue.submit('scan', 'scan_1d', 1, depends_on=[failed])
+    late = queue.submit('scan', 'scan_1d', 2)
+    early = queue.submit('scan', 'scan_1d', 3, priority=1)
+    queue.run()
+    assert [call[0] for call in scan.calls] == [3, 2]
+    assert queue.jobs[failed].status == 'failed' and 'boom' in queue.jobs[failed].error
+    assert queue.jobs[skipped].status == 'skipped'
+    assert queue.jobs[late].status == queue.jobs[early].status == 'done'
+
+
+def test_queue_persists_and_aborts_interrupted_jobs(tmp_path):
+    path = str(tmp_path / 'queue.json')
+    scan = FakeScan()
+    queue = ScanQueue(path)
+    queue.register('scan', scan)
+    interrupted = queue.submit('scan', 'interrupt')
+    dependent = queue.submit('scan', 'scan_1d', 0, depends_on=[interrupted])
+    pending = queue.submit('scan', 'scan_1d', 1)
+    # 顺序执行时任务在调用run()的线程中执行，Ctrl+C中断整个队列
+    with pytest.raises(KeyboardInterrupt):
+        queue.run()
+    assert queue.jobs[interrupted].status == 'aborted'
+    # 程序在任务执行中退出时，文件中的任务仍为running
+    jobs = json.load(open(path))
+    jobs[pending]['status'] = 'running'
+    json.dump(jobs, open(path, 'w'))
+
+    reloaded = ScanQueue(path)
+    reloaded.register('scan', scan)
+    assert reloaded.jobs[pending].status == 'aborted'
+    assert reloaded.jobs[dependent].spec == queue.jobs[dependent].spec
+    reloaded.run()
+    assert reloaded.jobs[dependent].status == 'skipped'
+    assert scan.calls == []
+
+
+def test_jobs_with_disjoint_resources_run_together(tmp_path):
+    queue = ScanQueue(str(tmp_path / 'queue.json'), max_workers=2)
+    first, second, shared = FakeScan(['Dev1/ai0']), FakeScan(['Dev2/ai0']), FakeScan(['Dev1/ai1'])
+    for name, scan in (('first', first), ('second', second), ('shared', shared)):
+        queue.register(name, scan)
+    queue.submit('first', 'wait', 0.2)
+    queue.submit('second', 'wait', 0.2)
+    queue.submit('shared', 'wait', 0.2)
+    start = time.perf_counter()
+    queue.run()
+    elapsed = time.perf_counter() - start
+    # first和second同时执行，shared与first共用Dev1，只能在first之后执行
+    assert 0.35 < elapsed < 0.55
+    assert first.calls[0] != threading.current_thread().name
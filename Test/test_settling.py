@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from tools.settling import SettleModel, fit_settling, load_models, save_models
+
+
+def test_fit_settling_recovers_tau_and_dead_time():
+    sample_rate, tau, dead_time = 1e5, 2e-3, 5e-4
+    t = np.arange(2000) / sample_rate
+    trace = 1. - np.exp(-np.clip(t - dead_time, 0, None) / tau)
+    trace += np.random.default_rng(0).normal(0, 1e-4, t.shape)
+    fitted_tau, fitted_dead_time = fit_settling(trace, 0., sample_rate)
+    assert fitted_tau == pytest.approx(tau, rel=0.05)
+    assert fitted_dead_time == pytest.approx(dead_time, abs=1e-4)
+
+
+def test_fit_settling_rejects_a_flat_trace():
+    with pytest.raises(ValueError):
+        fit_settling(np.zeros(100), 0., 1e5)
+
+
+def test_wait_depends_on_the_step():
+    model = SettleModel(1e-3, dead_time=1e-4, tolerance=1e-5, max_wait=5e-3)
+    waits = model.wait([0., 1e-5, 1e-3, 10.])
+    assert waits[0] == waits[1] == pytest.approx(1e-4)
+    assert waits[2] == pytest.approx(1e-4 + 1e-3 * np.log(100))
+    assert waits[3] == pytest.approx(5e-3)
+
+
+def test_models_round_trip(tmp_path):
+    path = str(tmp_path / 'models.json')
+    save_models(path, {'g1': SettleModel(1e-3, 2e-4, 1e-6)})
+    model = load_models(path)['g1']
+    assert (model.tau, model.dead_time, model.tolerance, model.max_wait) == (1e-3, 2e-4, 1e-6, None)
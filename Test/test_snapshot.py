@@ -0,0 +1,58 @@
+import h5py
+import numpy as np
+import pytest
+from tools.snapshot import SnapshotStore, StationSnapshot, load_snapshot, read_record
+
+
+def save_runs(tmp_path, snapshots: list, full_every: int = 50):
+    store = SnapshotStore(full_every)
+    for run_id, snapshot in enumerate(snapshots):
+        with h5py.File(tmp_path / f'{run_id}.hdf5', 'w') as file:
+            store.save(file, snapshot, run_id)
+    return lambda run_id: h5py.File(tmp_path / f'{run_id}.hdf5', 'r')
+
+
+def test_diff_reports_changed_and_removed_parameters():
+    previous = StationSnapshot({'g1': 0.1, 'g2': 0.2, 'mode': 'AC'})
+    current = StationSnapshot({'g1': 0.1, 'g2': 0.3, 'range': 1.})
+    changed, removed = current.diff(previous)
+    assert changed == {'g2': 0.3, 'range': 1.}
+    assert removed == ['mode']
+    assert StationSnapshot(dict(previous.values)).digest == previous.digest
+
+
+def test_snapshots_round_trip_through_diffs(tmp_path):
+    snapshots = [StationSnapshot({'g1': 0.1, 'g2': 0.2, 'mode': 'AC'}, {'g1': 'V', 'g2': 'V'}),
+                 StationSnapshot({'g1': 0.1, 'g2': 0.3, 'mode': 'AC'}, {'g1': 'V', 'g2': 'V'}),
+                 StationSnapshot({'g1': 0.15, 'g2': 0.3, 'trace': np.arange(3.)}, {'g1': 'V', 'g2': 'V'},
+                                 errors={'dmm': 'timeout'})]
+    open_run = save_runs(tmp_path, snapshots)
+    with open_run(1) as file:
+        record = read_record(file)
+    # 第二个run只保存有变化的参数
+    assert record['base'] == 0 and record['values'] == {'g2': 0.3}
+    for run_id, snapshot in enumerate(snapshots):
+        loaded = load_snapshot(open_run, run_id)
+        assert set(loaded.values) == set(snapshot.values)
+        for name, value in snapshot.values.items():
+            assert np.array_equal(loaded[name], value)
+        assert loaded.units['g1'] == 'V'
+    assert load_snapshot(open_run, 2).errors == {'dmm': 'timeout'}
+
+
+def test_full_snapshot_every_few_runs(tmp_path):
+    snapshots = [StationSnapshot({'g1': float(num)}) for num in range(5)]
+    open_run = save_runs(tmp_path, snapshots, full_every=2)
+    bases = []
+    for run_id in range(5):
+        with open_run(run_id) as file:
+            bases.append(read_record(file)['base'])
+    assert bases == [-1, 0, 1, -1, 3]
+    assert load_snapshot(open_run, 4)['g1'] == 4.
+
+
+def test_missing_snapshot_is_an_error(tmp_path):
+    with h5py.File(tmp_path / '0.hdf5', 'w'):
+        pass
+    with pytest.raises(ValueError):
+        load_snapshot(lambda run_id: h5py.File(tmp_path / f'{run_id}.hdf5', 'r'), 0)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from tools.storage import Pyramid, RunCache, block_reduce
+
+
+def test_block_reduce_pads_odd_columns():
+    rows = np.arange(10, dtype=float).reshape(1, 5, 2)
+    mean = block_reduce(rows, np.nanmean)
+    assert mean.shape == (1, 3)
+    assert mean[0].tolist() == [1.5, 5.5, 8.5]
+    assert block_reduce(rows, np.nanmax)[0].tolist() == [3., 7., 9.]
+
+
+def test_pyramid_matches_the_full_data():
+    data = np.random.default_rng(0).normal(size=(2, 7, 5))
+    levels = []
+    nx, ny = 7, 5
+    while nx > 1 or ny > 1:
+        nx, ny = -(-nx // 2), -(-ny // 2)
+        levels.append({stat: np.full((2, nx, ny), np.nan) for stat in Pyramid.stats})
+    pyramid = Pyramid(levels, data.shape[-1])
+    for idy in range(data.shape[-1]):
+        pyramid.add_row(idy, data[..., idy])
+    first = levels[0]
+    assert first['mean'][:, 0, 0] == pytest.approx(data[:, :2, :2].mean(axis=(1, 2)))
+    assert first['min'][:, 3, 2] == pytest.approx(data[:, 6:, 4:].min(axis=(1, 2)))
+    assert not np.isnan(first['mean']).any()
+    top = levels[-1]
+    assert top['max'][:, 0, 0] == pytest.approx(data.max(axis=(1, 2)))
+    assert top['min'][:, 0, 0] == pytest.approx(data.min(axis=(1, 2)))
+
+
+def test_pyramid_requires_rows_in_pairs():
+    levels = [{stat: np.zeros((1, 2, 2)) for stat in Pyramid.stats}]
+    pyramid = Pyramid(levels, 4)
+    with pytest.raises(ValueError):
+        pyramid.add_row(1, np.zeros((1, 4)))
+
+
+def test_run_cache_evicts_least_recently_used(tmp_path):
+    loads = []
+
+    def loader(run_id):
+        loads.append(run_id)
+        return np.full(100, run_id, dtype=float)
+
+    cache = RunCache(loader, max_bytes=2000, spill_dir=str(tmp_path), spill_bytes=1000)
+    for run_id in range(3):
+        cache.put(run_id, np.full(100, run_id, dtype=float))
+    # 每个结果800 byte，内存中只能保留两个，最早的结果移到磁盘层
+    assert 0 not in cache._memory and 0 in cache._spilled
+    assert cache.nbytes <= 2000
+    cache.get(1)
+    cache.put(3, np.full(100, 3, dtype=float))
+    # 1刚被读取过，被移出内存的是2；磁盘层超过上限时删除最早的0
+    assert list(cache._memory) == [1, 3]
+    assert list(cache._spilled) == [2]
+    assert not (tmp_path / '0.npy').exists()
+    assert cache.get(2)[0] == 2
+    assert cache.get(0)[0] == 0
+    assert loads == [0]
+    cache.clear()
+    assert len(cache) == 0 and list(tmp_path.iterdir()) == []
@@ -0,0 +1,53 @@
+import h5py
+import numpy as np
+import pytest
+from tools.writer import AsyncWriter
+
+
+def test_writer_coalesces_slices_along_the_last_axis(tmp_path):
+    writer = AsyncWriter(flush_interval=10., max_batch=8)
+    with h5py.File(tmp_path / 'run.hdf5', 'w') as file:
+        contiguous = file.create_dataset('contiguous', (2, 20), 'f8')
+        chunked = file.create_dataset('chunked', (2, 20), 'f8', chunks=(2, 5))
+        expected = np.arange(40, dtype=float).reshape(2, 20)
+        value = np.empty(2)
+        for idx in range(20):
+            # 放入队列的数据被复制，之后修改value不影响写入的结果
+            value[:] = expected[:, idx]
+            writer.write(contiguous, (slice(None), idx), value)
+            writer.write(chunked, (slice(None), idx), value)
+        writer.flush()
+        assert np.array_equal(contiguous[:], expected)
+        assert np.array_equal(chunked[:], expected)
+        statistics = writer.statistics()
+        assert statistics['items'] == 40
+        # 连续存储每8个切片、分块存储每个chunk(5个切片)写入一次
+        assert statistics['writes'] == 3 + 4
+    writer.close()
+
+
+def test_writer_runs_deferred_calls_after_the_data(tmp_path):
+    writer = AsyncWriter(flush_interval=10.)
+    seen = []
+    with h5py.File(tmp_path / 'run.hdf5', 'w') as file:
+        dataset = file.create_dataset('data', (1, 4), 'f8')
+        for idx in range(4):
+            writer.write(dataset, (slice(None), idx), [idx])
+            writer.after(lambda index: seen.append((index, dataset[0, index])), idx)
+        writer.flush()
+    writer.close()
+    assert seen == [(idx, idx) for idx in range(4)]
+
+
+def test_writer_reports_errors_to_the_caller(tmp_path):
+    writer = AsyncWriter()
+    with h5py.File(tmp_path / 'run.hdf5', 'w') as file:
+        dataset = file.create_dataset('data', (1, 4), 'f8')
+        # 形状不匹配，写入在后台线程中失败
+        writer.write(dataset, (0, slice(None)), [1., 2., 3.])
+        with pytest.raises(RuntimeError):
+            writer.flush()
+        writer.write(dataset, (0, slice(None)), [1., 2., 3., 4.])
+        writer.flush()
+        assert dataset[0].tolist() == [1., 2., 3., 4.]
+    writer.close()
@@ -250,12 +250,16 @@ class SP1060_Channel(InstrumentChannel):
     """
     This class is used to address the 8 channel
     """
-    def __init__(self, parent: Instrument, name: str, channel: int) -> None:
+    def __init__(self, parent: Instrument, name: str, channel: int,
+                 max_val_age: Optional[float] = 1.0) -> None:
         """
         Args:
             parent: The Instrument instance to which the channel is to be attached.
             name: The 'colloquial' name of the channel
             channel: The channel on the DAC SP927 in the range 1-8
+            max_val_age: age (s) after which the qcodes cache of the voltage is
+                considered stale, so voltage.cache.get() queries the instrument again.
+                voltage() itself always queries the instrument.
         """
         #if channel not in range(1,9):
         #    raise ValueError('channel must be in range 1-9')
@@ -269,6 +273,7 @@ class SP1060_Channel(InstrumentChannel):
                            #set_cmd=self.set_voltage,
                            get_parser=float,
                            unit='V',
+                           max_val_age=max_val_age,
                            )
 
         self.add_parameter('state',
@@ -295,8 +300,6 @@ class SP1060_Channel(InstrumentChannel):
         
 
         self.channel=channel
-    
-
 
     def get_voltage(self):
         var_get =self._parent.ask('{} V?'.format(self.channel))
@@ -327,15 +330,18 @@ class DAC_SP1060(VisaInstrument):
       address: The GPIB address of this instrument
       kwargs: kwargs to be passed to VisaInstrument class
       terminator: read terminator for reads/writes to the instrument.
+      max_val_age: age (s) after which the cached channel voltages are re-read
+        by voltage.cache.get(), None to trust the cache until it is invalidated
     """
 
     def __init__(self, name: str, address: str, terminator: str = "\r\n",
+                 max_val_age: Optional[float] = 1.0,
                  **kwargs) -> None:
         super().__init__(name, address, terminator=terminator, **kwargs)
 
         for ch in range(1,25):
             ch_name = 'ch{}'.format(ch)
-            channel = SP1060_Channel(self, ch_name, ch)
+            channel = SP1060_Channel(self, ch_name, ch, max_val_age)
             self.add_submodule(ch_name, channel)
 
         
@@ -615,15 +621,69 @@ class DAC_SP1060(VisaInstrument):
 
     def write_cmd(self, cmd: str) -> None:
         self.visa_handle.write(cmd)
-        for _ in range(cmd.count(';')+1):
-            self._write_response = self.visa_handle.read()
+        # one return code per ';'-separated command, the last one is kept in _write_response
+        self._write_responses = [self.visa_handle.read() for _ in range(cmd.count(';')+1)]
+        self._write_response = self._write_responses[-1]
 
     def set_all_val(self,val):
+        self.invalidate_voltage_cache()
         self.write('ALL {}'.format(val_to_dacval(val)[:]))
         self._parent.empty_buffer()
         code = self._write_response
         check_error(int(code))
 
+    @staticmethod
+    def dac_code(val):
+        """
+        Integer DAC code that a voltage (or an array of voltages) is quantized to,
+        same conversion as val_to_dacval.
+        """
+        return np.trunc((np.asarray(val) + 10) * 838860.75).astype(np.int64)
+
+    def set_voltages(self, values: Dict[int, float]) -> None:
+        """
+        Set several DAC channels with one batched command, e.g. '1 7fffff;2 8ccccc'.
+        The instrument replies with one return code per channel.
+
+        Args:
+            values: mapping from channel number (1-24) to voltage
+        """
+        cmd = ';'.join('{} {}'.format(ch, val_to_dacval(val)) for ch, val in values.items())
+        self.invalidate_voltage_cache(values)
+        self.write_cmd(cmd)
+        self.empty_buffer()
+        for code in self._write_responses:
+            check_error(int(code))
+        for ch, val in values.items():
+            self.submodules['ch{}'.format(ch)].voltage.cache.set(dacval_to_val(int(self.dac_code(val))))
+
+    def invalidate_voltage_cache(self, channels: Optional[Iterable[int]] = None) -> None:
+        """
+        Mark the cached voltages as invalid so that voltage.cache.get() queries the instrument.
+
+        Args:
+            channels: channel numbers, all 24 channels by default
+        """
+        for ch in channels if channels is not None else range(1, 25):
+            self.submodules['ch{}'.format(ch)].voltage.cache.invalidate()
+
+    def verify_voltages(self) -> Dict[int, Tuple[float, float]]:
+        """
+        Compare the cached voltages with one bulk 'ALL V?' query and refresh the cache.
+
+        Returns:
+            mapping from channel number to (cached, actual) for every mismatch
+        """
+        mismatches = {}
+        for ch, voltage in enumerate(self.get_all_val(), start=1):
+            cache = self.submodules['ch{}'.format(ch)].voltage.cache
+            cached = cache.get(get_if_invalid=False)
+            # the cache holds the requested value, the instrument reports the quantized one
+            if cached is not None and abs(int(self.dac_code(cached)) - int(self.dac_code(voltage))) > 1:
+                mismatches[ch] = (cached, voltage)
+            cache.set(voltage)
+        return mismatches
+
     def get_all_val(self):
         var_get = self.ask('ALL V?')
         I = np.zeros(24)
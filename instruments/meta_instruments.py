@@ -1,5 +1,8 @@
 import artdaq
-from artdaq.constants import AcquisitionType
+import numpy as np
+from artdaq.constants import AcquisitionType, DigitalWidthUnits, LineGrouping
+from artdaq.stream_readers import AnalogMultiChannelReader
+from artdaq.stream_writers import DigitalSingleChannelWriter
 from functools import partial
 from random import gauss
 
@@ -239,11 +242,24 @@ class ACQTask:
     """ 代表一个采集任务，包含了采集的参数，采集的方法，采集的数据。"""
     __slots__ = 'task', 'read', '__dict__'
 
-    def __init__(self, acq_name: str, acq_channels: str, sample_rate: float, memory_size: int):
+    def __init__(self, acq_name: str, acq_channels: str, sample_rate: float, memory_size: int,
+                 trigger_source: str = None, trigger_delay: float = 0.):
+        """
+        :param acq_name: 采集卡名字
+        :param acq_channels: 采集的通道，多个通道可以用逗号分隔或者以列表形式传入，例如'Dev1/ai4,Dev1/ai5'
+        :param sample_rate: 采样率
+        :param memory_size: 每个通道每次读取的采样点数
+        :param trigger_source: 触发源，例如'/Dev1/PFI0'。设置后为可重复触发的有限采集，
+                               每个上升沿采集memory_size个点。缓冲区只能容纳一次触发的数据，
+                               每次触发之后需要在下一次触发之前用read_block读取
+        :param trigger_delay: 触发之后延迟多久开始采集，单位s，由采集卡计时，用于等待扫描点稳定
+        """
         self.acq = acq_name
-        self.channels = acq_channels
+        self.channels = acq_channels if isinstance(acq_channels, str) else ','.join(acq_channels)
         self.sr = sample_rate
         self.memsize = memory_size
+        self.trigger_source = trigger_source
+        self.trigger_delay = trigger_delay
         self._acq_controller = {'art': self.art, 'm2p': self.m2p}
 
     def __enter__(self):
@@ -260,12 +276,33 @@ class ACQTask:
     def art(self):
         task = artdaq.Task()
         task.ai_channels.add_ai_voltage_chan(self.channels)
-        task.timing.cfg_samp_clk_timing(self.sr,
-                                        sample_mode=AcquisitionType.CONTINUOUS,
-                                        samps_per_chan=int(self.memsize))
+        if self.trigger_source is None:
+            task.timing.cfg_samp_clk_timing(self.sr,
+                                            sample_mode=AcquisitionType.CONTINUOUS,
+                                            samps_per_chan=int(self.memsize))
+        else:
+            task.timing.cfg_samp_clk_timing(self.sr,
+                                            sample_mode=AcquisitionType.FINITE,
+                                            samps_per_chan=int(self.memsize))
+            task.triggers.start_trigger.cfg_dig_edge_start_trig(self.trigger_source)
+            task.triggers.start_trigger.retriggerable = True
+            if self.trigger_delay > 0:
+                task.triggers.start_trigger.delay_units = DigitalWidthUnits.SECONDS
+                task.triggers.start_trigger.delay = self.trigger_delay
+            task.start()
+        self.reader = AnalogMultiChannelReader(task.in_stream)
+        self.buffer = np.zeros((task.number_of_channels, int(self.memsize)))
         return task, partial(task.read,
                              number_of_samples_per_channel=self.memsize)
 
+    def read_block(self):
+        """
+        所有通道一次读取，数据写入预先分配好的buffer中，每次读取都复用同一块内存
+        :return: 形状为(通道数, memory_size)的数组
+        """
+        self.reader.read_many_sample(self.buffer, number_of_samples_per_channel=int(self.memsize))
+        return self.buffer
+
     @staticmethod
     def m2p():
         return dummyget
@@ -280,7 +317,7 @@ class ACQTask:
         :return:
         """
         self.acq = acq_name
-        self.channels = acq_channels
+        self.channels = acq_channels if isinstance(acq_channels, str) else ','.join(acq_channels)
         self.sr = sample_rate
         self.memsize = memory_size
 
@@ -288,6 +325,42 @@ class ACQTask:
         self.task.close()
 
 
+class TriggerLine:
+    """ 用数字输出线产生触发脉冲，连接到采集卡的触发输入，每设置完一个扫描点发出一个脉冲。"""
+
+    def __init__(self, line: str = None):
+        """
+        :param line: 数字输出线，例如'Dev1/port0/line0'，为None时不产生脉冲(触发由其他仪器产生)
+        """
+        self.line = line
+        self.task = None
+        self.writer = None
+
+    def __enter__(self):
+        if self.line is None:
+            return self
+        self.task = artdaq.Task()
+        self.task.do_channels.add_do_chan(self.line, line_grouping=LineGrouping.CHAN_PER_LINE)
+        self.writer = DigitalSingleChannelWriter(self.task.out_stream, auto_start=True)
+        self.writer.write_one_sample_one_line(False)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def pulse(self):
+        """产生一个上升沿，然后恢复低电平"""
+        if self.writer is None:
+            return
+        self.writer.write_one_sample_one_line(True)
+        self.writer.write_one_sample_one_line(False)
+
+    def close(self):
+        if self.task is not None:
+            self.task.close()
+            self.task = None
+
+
 def dummyset(voltage):
     return voltage
 
@@ -1,4 +1,14 @@
 from .scan import Scan
 from .project import DataManager, Project
 from .logger import Logger
+from .progress import TerminalReporter, FileReporter, MemoryReporter
+from .lockin import LockIn
+from .stream import LiveStream
+from .dryrun import DryRun
+from .monitor import Monitor
+from .scheduler import ScanQueue
+from .catalog import RunCatalog
+from .writer import AsyncWriter
+from .archive import RunArchive, consolidate, consolidate_project
+from .snapshot import StationSnapshot, read_station
 from .constants import generate_text, get_time, get_date, File_path
@@ -0,0 +1,267 @@
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import h5py
+import numpy as np
+
+ARCHIVE_NAME = 'archive.hdf5'
+RUN_FILE = re.compile(r'^(\d+)\.hdf5$')
+DATE_DIR = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+class RunArchive:
+    """
+    把一个日期目录下的run合并为一个压缩的归档文件：每个run保存为runs/{run_id}组，组内的结构与原来的{run_id}.hdf5相同。
+    index数据集记录每个run的run id以及原文件的大小和修改时间，是归档的目录：
+    只有写入index的组才是完整的，再次合并时原文件没有变化的run直接跳过。
+    """
+    index_dtype = np.dtype([('run_id', 'i8'), ('size', 'i8'), ('mtime', 'f8'), ('resumable', '?')])
+
+    def __init__(self, path: str):
+        """
+        :param path: 归档文件路径
+        """
+        self.path = path
+
+    def __repr__(self):
+        return f'RunArchive({self.path}, {len(self.run_ids())} runs)'
+
+    def __contains__(self, run_id):
+        return int(run_id) in self.index()
+
+    def index(self) -> dict:
+        """
+        :return: key为run id，value为{'size', 'mtime', 'resumable'}，归档文件不存在时为空
+        """
+        if not os.path.exists(self.path):
+            return {}
+        with h5py.File(self.path, 'r') as file:
+            rows = file['index'][:] if 'index' in file else np.zeros(0, self.index_dtype)
+        return {int(row['run_id']): {'size': int(row['size']), 'mtime': float(row['mtime']),
+                                     'resumable': bool(row['resumable'])} for row in rows}
+
+    def run_ids(self) -> list:
+        return sorted(self.index())
+
+    def open(self, run_id: int) -> h5py.Group:
+        """
+        以只读方式打开归档中的一个run，用完之后关闭group.file
+        :param run_id: run id
+        :return: run对应的h5py.Group，与run文件的根目录结构相同
+        """
+        file = h5py.File(self.path, 'r')
+        key = f'runs/{int(run_id)}'
+        if 'index' not in file or key not in file or int(run_id) not in file['index']['run_id']:
+            file.close()
+            raise KeyError(f'The run {run_id} is not in the archive {self.path}!')
+        return file[key]
+
+
+def run_files(directory: str) -> dict:
+    """
+    :param directory: 日期目录
+    :return: key为run id，value为{run_id}.hdf5的路径
+    """
+    files = {}
+    for name in os.listdir(directory):
+        match = RUN_FILE.match(name)
+        if match:
+            files[int(match.group(1))] = os.path.join(directory, name)
+    return files
+
+
+def compact_run(source: str, target: str, compression: str = 'gzip', compression_opts=4,
+                shuffle: bool = True) -> bool:
+    """
+    把一个run文件复制为压缩的临时文件，在子进程中执行，压缩不占用合并进程的时间
+    :param source: run文件路径
+    :param target: 临时文件路径
+    :param compression: 压缩方式，'gzip'或者'lzf'
+    :param compression_opts: 压缩参数
+    :param shuffle: 压缩前是否做字节重排
+    :return: run是否还可以继续(有断点但没有完成)，这样的run合并之后也不删除原文件
+    """
+    with h5py.File(source, 'r') as src, h5py.File(target, 'w') as dst:
+        dst.attrs.update(src.attrs)
+
+        def copy(name, item):
+            if isinstance(item, h5py.Group):
+                dst.require_group(name).attrs.update(item.attrs)
+                return
+            if item.shape == () or item.size == 0 or item.dtype.kind not in 'biufc':
+                dataset = dst.create_dataset(name, data=item[()])
+            else:
+                # 可扩展的数据集(例如monitor)保留maxshape，chunk可以大于当前的形状
+                options = {'chunks': item.chunks if item.chunks is not None else True, 'maxshape': item.maxshape,
+                           'compression': compression, 'shuffle': shuffle}
+                if compression_opts is not None and compression == 'gzip':
+                    options['compression_opts'] = compression_opts
+                dataset = dst.create_dataset(name, shape=item.shape, dtype=item.dtype, **options)
+                # 按chunk复制，不把大的数据集(例如原始波形)一次读入内存
+                for key in (item.iter_chunks() if item.chunks is not None else [Ellipsis]):
+                    dataset[key] = item[key]
+            dataset.attrs.update(item.attrs)
+
+        src.visititems(copy)
+        return 'scan' in src and 'finished' in src['scan'].attrs and not bool(src['scan'].attrs['finished'])
+
+
+def consolidate(directory: str,
+                archive_name: str = ARCHIVE_NAME,
+                workers: int = 4,
+                compression: str = 'gzip',
+                compression_opts=4,
+                shuffle: bool = True,
+                skip=(),
+                remove: bool = False,
+                catalog=None,
+                date: str = None) -> list:
+    """
+    增量合并一个日期目录下的run文件：只处理归档中没有或者原文件在上次合并之后有变化的run，
+    多个run在子进程中并行压缩，主进程按完成的顺序把结果复制到归档中。
+    被替换的旧组占用的空间不会释放，需要时可以用h5repack整理归档文件。
+    :param directory: 日期目录，例如'D:/Data/2023-09-19/'
+    :param archive_name: 归档文件名，保存在同一目录下
+    :param workers: 并行的进程数，小于等于1时在当前进程中依次执行
+    :param compression: 压缩方式
+    :param compression_opts: 压缩参数
+    :param shuffle: 压缩前是否做字节重排
+    :param skip: 不合并的run id，例如正在写入的run
+    :param remove: 合并之后是否删除原文件，可以继续的run不删除
+    :param catalog: RunCatalog，给出时跳过状态为running且文件仍在写入的run，并把删除了原文件的run的路径改为归档文件。
+                    状态为running但文件已经没有被打开的run(程序崩溃时留下的)记为failed并照常合并
+    :param date: catalog中的日期，默认为目录名
+    :return: 本次合并的run id
+    """
+    archive = os.path.join(directory, archive_name)
+    date = date if date is not None else os.path.basename(os.path.normpath(directory))
+    skip = set(skip)
+    sources = run_files(directory)
+    if catalog is not None:
+        for run in catalog.query(date=date, status='running'):
+            run_id = run['run_id']
+            if run_id not in sources or run_id in skip:
+                continue
+            if in_use(sources[run_id]):
+                skip.add(run_id)
+            else:
+                print(f'The run {run_id} is still running in the catalog but its file is closed, marked as failed')
+                catalog.finish(date, run_id, 'failed')
+    index = RunArchive(archive).index()
+    files = {run_id: (source, os.stat(source)) for run_id, source in sources.items() if run_id not in skip}
+    todo = {run_id: (source, stat) for run_id, (source, stat) in files.items() if not archived(index, run_id, stat)}
+    merged = merge(archive, index, todo, workers, compression, compression_opts, shuffle) if todo else []
+    if remove:
+        # 包括之前合并过、但当时没有删除原文件的run
+        removed = [run_id for run_id, (source, stat) in files.items()
+                   if archived(index, run_id, stat) and not index[run_id]['resumable']]
+        for run_id in removed:
+            os.remove(files[run_id][0])
+        if catalog is not None:
+            catalog.relocate(date, removed, archive)
+    return merged
+
+
+def in_use(source: str) -> bool:
+    """
+    :return: run文件是否正在被写入：写入时hdf5的文件锁使只读打开失败
+    """
+    try:
+        with h5py.File(source, 'r'):
+            return False
+    except OSError:
+        return True
+
+
+def archived(index: dict, run_id: int, stat: os.stat_result) -> bool:
+    """
+    :return: 归档中的run是否与原文件一致(大小和修改时间都没有变化)
+    """
+    entry = index.get(run_id)
+    return entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime
+
+
+def merge(archive: str, index: dict, todo: dict, workers: int, compression: str, compression_opts,
+          shuffle: bool) -> list:
+    """
+    并行压缩todo中的run并复制到归档中，同时更新index
+    :return: 合并的run id
+    """
+    directory = os.path.dirname(archive)
+    temp_dir = tempfile.mkdtemp(prefix='consolidate_', dir=directory)
+    merged = []
+    try:
+        jobs = {run_id: (source, os.path.join(temp_dir, f'{run_id}.hdf5'), compression, compression_opts, shuffle)
+                for run_id, (source, stat) in todo.items()}
+        with h5py.File(archive, 'a') as file:
+            runs = file.require_group('runs')
+            for run_id, resumable in run_jobs(jobs, workers):
+                if resumable is None:
+                    continue
+                key = str(run_id)
+                if key in runs:
+                    del runs[key]
+                with h5py.File(jobs[run_id][1], 'r') as src:
+                    group = runs.create_group(key)
+                    group.attrs.update(src.attrs)
+                    for name in src:
+                        src.copy(src[name], group, name=name)
+                os.remove(jobs[run_id][1])
+                stat = todo[run_id][1]
+                index[run_id] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'resumable': resumable}
+                merged.append(run_id)
+            # 索引最后写入，中断的合并不会留下登记过的不完整的组
+            rows = np.array([(run_id, entry['size'], entry['mtime'], entry['resumable'])
+                             for run_id, entry in sorted(index.items())], dtype=RunArchive.index_dtype)
+            if 'index' in file:
+                del file['index']
+            file.create_dataset('index', data=rows)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return sorted(merged)
+
+
+def run_jobs(jobs: dict, workers: int):
+    """
+    :return: 依次给出(run_id, resumable)，原文件无法打开(例如正在写入)时resumable为None
+    """
+    if workers <= 1:
+        for run_id, args in jobs.items():
+            yield run_id, try_compact(run_id, args)
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(compact_run, *args): run_id for run_id, args in jobs.items()}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except OSError as error:
+                print(f'The run {futures[future]} is skipped: {error}')
+                yield futures[future], None
+
+
+def try_compact(run_id: int, args: tuple):
+    try:
+        return compact_run(*args)
+    except OSError as error:
+        print(f'The run {run_id} is skipped: {error}')
+        return None
+
+
+def consolidate_project(root_path: str, exclude=(), **kwargs) -> dict:
+    """
+    依次合并数据根目录下的每个日期目录
+    :param root_path: 数据根目录，例如File_path().root_path
+    :param exclude: 不合并的日期，例如正在测量的当天
+    :param kwargs: 传给consolidate的参数
+    :return: key为日期，value为本次合并的run id
+    """
+    merged = {}
+    for name in sorted(os.listdir(root_path)):
+        directory = os.path.join(root_path, name)
+        if DATE_DIR.match(name) and name not in exclude and os.path.isdir(directory):
+            runs = consolidate(directory, date=name, **kwargs)
+            if runs:
+                merged[name] = runs
+    return merged
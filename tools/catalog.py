@@ -0,0 +1,194 @@
+import hashlib
+import json
+import sqlite3
+import time
+from contextlib import closing
+import numpy as np
+
+
+class RunCatalog:
+    """
+    本地的SQLite run目录：每个run在开始时登记一行，结束时更新状态和结束时间。
+    runs表记录run的基本信息，parameters表记录扫描参数的范围、测量参数、其他参数在扫描开始时的数值
+    以及run本身的设置(例如重复扫描的次数，role为'setting')，
+    两张表都建立了索引，因此可以不打开hdf5文件，直接按日期、参数名和参数值查找几个月以来的run。
+    每次操作都单独连接数据库，多个线程(例如ScanQueue)可以同时使用同一个RunCatalog。
+    """
+    schema = ("CREATE TABLE IF NOT EXISTS runs ("
+              "date TEXT NOT NULL, run_id INTEGER NOT NULL, path TEXT NOT NULL, scan_type TEXT, "
+              "started REAL, finished REAL, status TEXT, shape TEXT, snapshot_digest TEXT, "
+              "PRIMARY KEY (date, run_id))",
+              "CREATE TABLE IF NOT EXISTS parameters ("
+              "date TEXT NOT NULL, run_id INTEGER NOT NULL, name TEXT NOT NULL, role TEXT NOT NULL, "
+              "axis INTEGER, start REAL, stop REAL, points INTEGER)",
+              "CREATE INDEX IF NOT EXISTS runs_started ON runs (started)",
+              "CREATE INDEX IF NOT EXISTS parameters_name ON parameters (name, role)",
+              "CREATE INDEX IF NOT EXISTS parameters_run ON parameters (date, run_id)")
+
+    def __init__(self, path: str):
+        """
+        :param path: 数据库文件路径
+        """
+        self.path = path
+        with closing(self.connect()) as conn, conn:
+            for statement in self.schema:
+                conn.execute(statement)
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def last_id(self, date: str) -> int:
+        """
+        :param date: 日期，例如'2023-09-19'
+        :return: 该日期最大的run id，没有记录时返回-1
+        """
+        with closing(self.connect()) as conn:
+            row = conn.execute('SELECT MAX(run_id) FROM runs WHERE date = ?', (date,)).fetchone()
+        return row[0] if row[0] is not None else -1
+
+    def count(self, date: str) -> int:
+        with closing(self.connect()) as conn:
+            return conn.execute('SELECT COUNT(*) FROM runs WHERE date = ?', (date,)).fetchone()[0]
+
+    def register(self, date: str, run_id: int, path: str, scan_type: str, axes: list, ranges: list,
+                 measured: list, shape: tuple, snapshot_digest: str = None, static: dict = None,
+                 settings: dict = None):
+        """
+        登记一个开始的run，同一日期同一run id的旧记录会被替换
+        :param date: 日期
+        :param run_id: run id
+        :param path: hdf5文件路径
+        :param scan_type: 'scan_1d'、'scan_2d'等
+        :param axes: 每个扫描维度的参数名列表，联动参数在同一个列表中
+        :param ranges: 每个扫描维度的扫描范围
+        :param measured: 测量参数名
+        :param shape: 数据的形状
+        :param snapshot_digest: station快照的摘要
+        :param static: 其他参数在扫描开始时的数值，key为参数名
+        :param settings: run的数值设置，例如{'repeats': 10, 'target_sem': 1e-3}，可以用role='setting'查找
+        :return: None
+        """
+        rows = [(date, run_id, name, 'scan', axis, float(np.min(scan_range)), float(np.max(scan_range)),
+                 len(scan_range))
+                for axis, (names, scan_range) in enumerate(zip(axes, ranges)) for name in names]
+        rows += [(date, run_id, name, 'meas', None, None, None, None) for name in measured]
+        rows += [(date, run_id, name, 'static', None, value, value, 1)
+                 for name, value in (static if static is not None else {}).items()]
+        rows += [(date, run_id, name, 'setting', None, value, value, 1)
+                 for name, value in (settings if settings is not None else {}).items()]
+        with closing(self.connect()) as conn, conn:
+            conn.execute('DELETE FROM parameters WHERE date = ? AND run_id = ?', (date, run_id))
+            conn.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (date, run_id, path, scan_type, time.time(), None, 'running',
+                          json.dumps([int(size) for size in shape]), snapshot_digest))
+            conn.executemany('INSERT INTO parameters VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def finish(self, date: str, run_id: int, status: str = 'finished'):
+        with closing(self.connect()) as conn, conn:
+            conn.execute('UPDATE runs SET finished = ?, status = ? WHERE date = ? AND run_id = ?',
+                         (time.time(), status, date, run_id))
+
+    def update_settings(self, date: str, run_id: int, settings: dict):
+        """更新run的设置，例如重复扫描结束时实际的重复次数"""
+        with closing(self.connect()) as conn, conn:
+            for name, value in settings.items():
+                conn.execute("DELETE FROM parameters WHERE date = ? AND run_id = ? AND name = ? AND role = 'setting'",
+                             (date, run_id, name))
+                conn.execute("INSERT INTO parameters VALUES (?, ?, ?, 'setting', NULL, ?, ?, 1)",
+                             (date, run_id, name, value, value))
+
+    def relocate(self, date: str, run_ids: list, path: str):
+        """run合并到归档文件之后更新路径，run在归档中的位置为runs/{run_id}"""
+        with closing(self.connect()) as conn, conn:
+            conn.executemany('UPDATE runs SET path = ? WHERE date = ? AND run_id = ?',
+                             [(path, date, run_id) for run_id in run_ids])
+
+    def get(self, date: str, run_id: int) -> dict:
+        """
+        :return: 一个run的完整记录，包括parameters列表；不存在时返回None
+        """
+        runs = self.query(date=date, run_id=run_id)
+        return runs[0] if runs else None
+
+    def query(self, date: str = None, run_id: int = None, since: float = None, until: float = None,
+              parameter: str = None, value: float = None, role: str = None, scan_type: str = None,
+              status: str = None, limit: int = None) -> list:
+        """
+        按条件查找run，结果按开始时间从新到旧排列
+        :param date: 日期，例如'2023-09-19'
+        :param run_id: run id
+        :param since: 开始时间的下限，time.time()格式
+        :param until: 开始时间的上限
+        :param parameter: 参数名，只返回用到该参数的run
+        :param value: 与parameter一起使用，只返回该参数的范围(或数值)包含value的run
+        :param role: 与parameter一起使用，'scan'、'meas'、'static'或者'setting'
+        :param scan_type: 扫描类型，例如'scan_1d'、'repeat_2d'、'monitor'
+        :param status: 'running'、'finished'、'failed'或者'aborted'
+        :param limit: 最多返回的run数
+        :return: run记录的列表，每个记录为dict
+        """
+        conditions, args = [], []
+        for column, arg in (('r.date', date), ('r.run_id', run_id), ('r.scan_type', scan_type),
+                            ('r.status', status)):
+            if arg is not None:
+                conditions.append(f'{column} = ?')
+                args.append(arg)
+        if since is not None:
+            conditions.append('r.started >= ?')
+            args.append(since)
+        if until is not None:
+            conditions.append('r.started <= ?')
+            args.append(until)
+        if parameter is not None:
+            match = 'p.name = ?'
+            args.append(parameter)
+            if role is not None:
+                match += ' AND p.role = ?'
+                args.append(role)
+            if value is not None:
+                match += ' AND p.start <= ? AND p.stop >= ?'
+                args += [value, value]
+            conditions.append('EXISTS (SELECT 1 FROM parameters p WHERE p.date = r.date AND p.run_id = r.run_id '
+                              f'AND {match})')
+        sql = 'SELECT * FROM runs r'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY r.started DESC'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        with closing(self.connect()) as conn:
+            runs = [dict(row) for row in conn.execute(sql, args)]
+            for run in runs:
+                run['shape'] = tuple(json.loads(run['shape'])) if run['shape'] else ()
+                run['parameters'] = [dict(row) for row in conn.execute(
+                    'SELECT name, role, axis, start, stop, points FROM parameters WHERE date = ? AND run_id = ?',
+                    (run['date'], run['run_id']))]
+        return runs
+
+
+def station_state(station) -> (str, dict):
+    """
+    :param station: qcodes Station，可以为None
+    :return: (快照的sha1摘要, 缓存中数值型参数的数值)，不读取仪器
+    """
+    if station is None:
+        return None, {}
+    values = {}
+    for name, component in station.components.items():
+        cache = getattr(component, 'cache', None)
+        if cache is None:
+            continue
+        try:
+            value = cache.get(get_if_invalid=False)
+        except Exception:
+            continue
+        if isinstance(value, (int, float, np.number)) and not isinstance(value, bool):
+            values[name] = float(value)
+    try:
+        snapshot = station.snapshot(update=False)
+    except Exception:
+        snapshot = values
+    digest = hashlib.sha1(json.dumps(snapshot, sort_keys=True, default=str).encode()).hexdigest()
+    return digest, values
@@ -1,6 +1,7 @@
 import os
 from datetime import datetime
 import numpy as np
+from tools.snapshot import StationSnapshot, read_station
 
 
 class File_path:
@@ -52,45 +53,36 @@ def get_date():
 
 
 def snapshot(station):
-    for parameter in station.components.values():
-        try:
-            name = parameter.name
-            unit = parameter.unit
-            val = parameter()
-            if type(val) == np.ndarray or unit == "A":
-                val = np.average(val)
-            value = "%.4g" % val
-            print("     :", value, end='')
-            print(unit, end='')
-            print("\r" + name)
-        except:
-            pass
-
-
-def generate_text(station, tup1=None, tup2=None):
+    """打印station中所有参数的数值，不同仪器的参数同时读取，读取失败的参数不打印"""
+    values = read_station(station, settable_only=False)
+    for name, val in values.values.items():
+        if isinstance(val, str):
+            continue
+        value = "%.4g" % np.average(val)
+        print("     :", value, end='')
+        print(values.units[name], end='')
+        print("\r" + name)
+
+
+def generate_text(station, tup1=None, tup2=None, values: StationSnapshot = None):
+    """
+    :param station: qcodes Station
+    :param tup1: 不包括在内的参数，例如x方向的扫描参数
+    :param tup2: 不包括在内的参数，例如y方向的扫描参数
+    :param values: 已经读取的快照，例如DataManager.snapshot，为None时读取station
+    :return: 可以设置的参数中数值不为0的参数及其数值，每行一个
+    """
     text = ''
-    para_dict = station.components.copy()
-    try:
-        if tup1:
-            for parameter in tup1:
-                del para_dict[parameter.name]
-        if tup2:
-            for parameter in tup2:
-                del para_dict[parameter.name]
-    except:
-        pass
-
-    for parameter in para_dict.values():
+    values = values if values is not None else read_station(station)
+    excluded = {parameter.name for parameter in tuple(tup1 or ()) + tuple(tup2 or ())}
+    for name, value in values.values.items():
         # del para of 0
-        try:
-            if parameter.settable:
-                value = np.average(parameter())
-                if value == 0 or value == -1e-6:
-                    continue
-                unit = parameter.unit
-                text += parameter.name + " = " + "%.4g " % value + unit + "\n"
-        except:
-            pass
+        if name in excluded or isinstance(value, str):
+            continue
+        value = np.average(value)
+        if value == 0 or value == -1e-6:
+            continue
+        text += name + " = " + "%.4g " % value + values.units.get(name, '') + "\n"
     return text
 
 
@@ -0,0 +1,292 @@
+import copy
+import os
+import shutil
+import sys
+import tempfile
+import time
+import h5py
+import numpy as np
+import tools.scan as scan_module
+from instruments.meta_instruments import TriggerLine
+from tools.progress import MemoryReporter
+from tools.storage import RunCache
+
+
+class SimClock:
+    """
+    虚拟时钟：sleep不真正等待，只把时间累加到ramp/settle/acquire中；
+    perf_counter返回真实时间加上累计的虚拟时间，因此Scan中的计时逻辑不需要任何修改
+    """
+    ramp_functions = ('safe', 'ramp', 'ramp_parallel', 'ramp_all_to_zero')
+
+    def __init__(self):
+        self.virtual = 0.
+        self.charges = {'ramp': 0., 'settle': 0., 'acquire': 0.}
+
+    def charge(self, seconds: float, category: str = None):
+        category = category if category is not None else self.phase()
+        self.charges[category] += seconds
+        self.virtual += seconds
+
+    def sleep(self, seconds: float):
+        self.charge(seconds)
+
+    def perf_counter(self) -> float:
+        return time.perf_counter() + self.virtual
+
+    def monotonic(self) -> float:
+        return time.monotonic() + self.virtual
+
+    def phase(self) -> str:
+        """根据调用栈判断当前处于ramp还是扫描点的settle阶段"""
+        frame = sys._getframe(1)
+        while frame is not None:
+            if frame.f_code.co_name in self.ramp_functions:
+                return 'ramp'
+            frame = frame.f_back
+        return 'settle'
+
+
+class SimParameter:
+    """
+    模拟的扫描参数，每次读写都向虚拟时钟计入一次仪器通信的时间。
+    原参数设置了max_val_age时读取使用缓存(与scan.latest一致)，不计入读取时间
+    """
+
+    def __init__(self, parameter, clock: SimClock, write_time: float, read_time: float):
+        self.name = parameter.name
+        self.unit = getattr(parameter, 'unit', '')
+        self.step = getattr(parameter, 'step', None)
+        self.inter_delay = getattr(parameter, 'inter_delay', 0)
+        cache = getattr(parameter, 'cache', None)
+        value = cache.get(get_if_invalid=False) if cache is not None else None
+        self.value = float(value) if value is not None else 0.
+        self.cache = _SimCache(self) if getattr(cache, 'max_val_age', None) is not None else None
+        self.clock = clock
+        self.write_time = write_time
+        self.read_time = read_time
+        self.writes = 0
+
+    def __call__(self, *args):
+        if args:
+            self.value = float(args[0])
+            self.writes += 1
+            self.clock.charge(self.write_time)
+        else:
+            self.clock.charge(self.read_time)
+            return self.value
+
+
+class _SimCache:
+    def __init__(self, parameter: SimParameter):
+        self.parameter = parameter
+        self.max_val_age = float('inf')
+
+    def get(self, get_if_invalid: bool = True):
+        return self.parameter.value
+
+
+class _SimChannel:
+    def __init__(self, channel: int):
+        self.channel = channel
+
+
+class SimDAC:
+    """
+    模拟支持批量设置的DAC(例如SP1060)：通道对应的SimParameter与真实通道一样被dac_channel识别，
+    因此ScanPlan和ramp_parallel会像真实扫描一样把同一台DAC上的通道合并为一条set_voltages指令，
+    每条指令只计入一次写入时间
+    """
+
+    def __init__(self, instrument, clock: SimClock, write_time: float):
+        self.name = instrument.name
+        self.dac_code = instrument.dac_code
+        self.clock = clock
+        self.write_time = write_time
+        self.channels = {}
+        self.commands = 0
+
+    def attach(self, parameter: SimParameter, channel: int):
+        parameter.short_name = 'voltage'
+        parameter.instrument = _SimChannel(channel)
+        parameter.root_instrument = self
+        self.channels[channel] = parameter
+
+    def set_voltages(self, values: dict):
+        for channel, value in values.items():
+            self.channels[channel].value = float(value)
+            self.channels[channel].writes += 1
+        self.commands += 1
+        self.clock.charge(self.write_time)
+
+
+class SimAcquisition:
+    """
+    模拟的ACQTask，每次读取计入memory_size / sample_rate的采集时间，触发模式下每个点读取一次，
+    并把触发延迟计入settle
+    """
+
+    def __init__(self, clock: SimClock, n_channels: int, sample_rate: float, memory_size: int, read_overhead: float,
+                 trigger_delay: float = 0.):
+        self.clock = clock
+        self.trigger_delay = trigger_delay
+        self.sample_rate = sample_rate
+        self.duration = memory_size / sample_rate + read_overhead
+        self.buffer = np.zeros((n_channels, int(memory_size)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def read_block(self):
+        if self.trigger_delay:
+            self.clock.charge(self.trigger_delay, 'settle')
+        self.clock.charge(self.duration, 'acquire')
+        return self.buffer
+
+
+def estimate_file_bytes(path: str, chunk_overhead: int = 64) -> int:
+    """
+    按数据集的形状估计真实扫描的文件大小：dry run写入的数据全为0，压缩之后远小于真实数据，
+    因此按未压缩的chunk计算，每个chunk另加索引的开销，文件中数据集以外的部分(属性、快照等)按实际大小计入
+    :param path: dry run写入的run文件
+    :param chunk_overhead: 每个chunk在B-tree索引中的开销，单位byte
+    :return: 估计的文件大小，单位byte
+    """
+    datasets = []
+    with h5py.File(path, 'r') as file:
+        file.visititems(lambda name, item: datasets.append(item) if isinstance(item, h5py.Dataset) else None)
+        stored, estimate = 0, 0
+        for dataset in datasets:
+            stored += dataset.id.get_storage_size()
+            if dataset.chunks is None:
+                estimate += dataset.size * dataset.dtype.itemsize
+                continue
+            n_chunks = int(np.prod([-(-n // c) for n, c in zip(dataset.shape, dataset.chunks)]))
+            estimate += n_chunks * (int(np.prod(dataset.chunks)) * dataset.dtype.itemsize + chunk_overhead)
+    return max(os.path.getsize(path) - stored, 0) + estimate
+
+
+class _TempPath:
+    def __init__(self, path: str):
+        self.path = path
+        self.date = 'dry-run'
+
+    def __call__(self):
+        return self.path
+
+    def update_date_dir(self) -> bool:
+        return False
+
+
+class _NullLogger:
+    @staticmethod
+    def write(msg: str):
+        pass
+
+    @staticmethod
+    def event(event: str, run_id: int = None, **fields):
+        pass
+
+
+class DryRun:
+    """
+    在模拟的参数和采集卡上完整执行一次扫描逻辑，预测真实扫描所需的时间，并检查内存和磁盘空间。
+    数据写入临时目录中的hdf5文件，因此I/O时间是真实测得的；扫描结束后Scan的所有属性都会恢复。
+    """
+
+    def __init__(self, scan, write_time: float = 0.005, read_time: float = 0.01, read_overhead: float = 0.002):
+        """
+        :param scan: 需要预测的Scan
+        :param write_time: 每次设置参数的仪器通信时间
+        :param read_time: 每次读取参数的仪器通信时间
+        :param read_overhead: 每次采集在memory_size / sample_rate之外的额外耗时
+        """
+        self.scan = scan
+        self.write_time = write_time
+        self.read_time = read_time
+        self.read_overhead = read_overhead
+
+    def run(self, scan_para_list: list) -> dict:
+        """
+        :param scan_para_list: 扫描参数在para_scan中的序号，长度为1时为1d扫描，为2时为2d扫描
+        :return: 预测结果，时间单位为s，空间单位为byte
+        """
+        scan = self.scan
+        clock = SimClock()
+        saved = {key: scan.__dict__[key] for key in ('para_scan', 'manager', 'logger', 'reporter', 'stream',
+                                                     'data', 'plan')}
+        scan_time = scan_module.time
+        with tempfile.TemporaryDirectory() as directory:
+            manager = copy.copy(scan.manager)
+            manager.path = _TempPath(directory + '/')
+            manager.date_path = directory + '/'
+            manager.id = 0
+            manager.catalog = None
+            manager.snapshots = None
+            manager.cache = RunCache(max_bytes=0)
+            dacs = {}
+
+            def simulate(parameter):
+                sim = SimParameter(parameter, clock, self.write_time, self.read_time)
+                target = scan_module.dac_channel(parameter)
+                if target is not None:
+                    dacs.setdefault(id(target[0]), SimDAC(target[0], clock, self.write_time)).attach(sim, target[1])
+                return sim
+
+            sims = [tuple(simulate(element) for element in para) if isinstance(para, (tuple, list)) else
+                    simulate(para) for para in scan.para_scan]
+            scan.para_scan = tuple(sims)
+            scan.manager = manager
+            scan.logger = _NullLogger()
+            scan.reporter = MemoryReporter(max_rate=0, max_length=1)
+            scan.stream = None
+            scan.acq_task = lambda: SimAcquisition(clock, len(scan.acq_channels), scan.sample_rate,
+                                                   scan.memory_size, self.read_overhead, scan.trigger_delay())
+            scan.trigger_task = lambda: TriggerLine(None)
+            scan_module.time = clock
+            try:
+                start = clock.perf_counter()
+                if len(scan_para_list) == 1:
+                    scan.scan_1d(*scan_para_list)
+                else:
+                    scan.scan_2d(*scan_para_list)
+                total = clock.perf_counter() - start
+                file_bytes = estimate_file_bytes(manager.run_file(manager.id))
+                plan = scan.plan
+                data_bytes = scan.data.nbytes + plan.nbytes
+            finally:
+                scan_module.time = scan_time
+                del scan.acq_task
+                del scan.trigger_task
+                scan.__dict__.update(saved)
+        timings = {**clock.charges, 'io': self.io_time(clock, total)}
+        memory_free = self.memory_free()
+        disk_free = shutil.disk_usage(scan.manager.date_path).free
+        return {'total': total,
+                **timings,
+                'points': plan.n_points,
+                'commands': plan.n_commands,
+                'memory_bytes': data_bytes,
+                'file_bytes': file_bytes,
+                'memory_free': memory_free,
+                'disk_free': disk_free,
+                'fits_memory': memory_free is None or data_bytes < memory_free,
+                'fits_disk': file_bytes < disk_free}
+
+    @staticmethod
+    def io_time(clock: SimClock, total: float) -> float:
+        """真实耗时中除去虚拟时间的部分，主要为hdf5的读写以及Python本身的开销"""
+        return max(total - clock.virtual, 0.)
+
+    @staticmethod
+    def memory_free():
+        """
+        :return: 可用物理内存，无法获取时返回None
+        """
+        try:
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            return None
@@ -0,0 +1,92 @@
+import numpy as np
+from numpy import ndarray
+
+
+class LockIn:
+    """
+    软件锁相放大器，对每次采集得到的数据block做数字解调。
+    参考信号的cos/sin表在初始化时计算一次，之后每个点都复用；
+    只使用整数个参考周期的采样点，相当于一个整周期的平均低通滤波器。
+    连续采集时相邻的block在时间上是连续的，内部参考的相位按累计的采样点数推进(samples)，
+    每次开始新的采集时需要调用reset()；触发采集的block之间不连续，需要用reference给出测得的参考信号，
+    X、Y和theta相对于该通道的相位计算。
+    """
+    quantities = ('X', 'Y', 'R', 'theta')
+    # 相位的单位为度，不随电流放大倍数缩放
+    angles = ('theta',)
+
+    def __init__(self,
+                 frequency: float,
+                 sample_rate: float,
+                 memory_size: int,
+                 phase: float = 0.,
+                 quantity: str = 'R',
+                 reference: str = None):
+        """
+        :param frequency: 参考频率，单位Hz
+        :param sample_rate: 采样率，需与Scan的sample_rate一致
+        :param memory_size: 每次采集的采样点数，需与Scan的memory_size一致
+        :param phase: 参考相位，单位为度
+        :param quantity: 作为Scan化简结果输出的量，可选'X', 'Y', 'R', 'theta'
+        :param reference: 参考信号的采集通道，例如'Dev1/ai5'，Scan会自动采集该通道；
+                          为None时使用内部参考，相位从采集开始时连续计算
+        """
+        if quantity not in self.quantities:
+            raise ValueError(f'quantity must be one of {self.quantities}!')
+        periods = int(memory_size * frequency / sample_rate)
+        if periods < 1:
+            raise ValueError(f'The block of {memory_size} samples is shorter than one period of {frequency} Hz!')
+        self.frequency = frequency
+        self.sample_rate = sample_rate
+        self.phase = phase
+        self.quantity = quantity
+        self.reference = reference
+        self.samples = 0
+        self.periods = periods
+        self.n_samples = min(int(round(periods * sample_rate / frequency)), memory_size)
+        omega_t = 2 * np.pi * frequency * np.arange(self.n_samples) / sample_rate + np.deg2rad(phase)
+        # 形状为(采样点数, 2)的参考表，乘以2/N使输入A*cos(wt+theta)时X=A*cos(theta), Y=A*sin(theta)
+        self._reference = np.stack((np.cos(omega_t), -np.sin(omega_t)), axis=1) * 2 / self.n_samples
+
+    def reset(self):
+        """开始新的连续采集，内部参考的相位回到0"""
+        self.samples = 0
+
+    def demodulate(self, block: ndarray, reference: int = None) -> dict:
+        """
+        :param block: 采集数据，形状为(采样点数,)、(通道数, 采样点数)或者(通道数, 点数, 采样点数)，
+                      没有reference时多个点视为依次连续采集的block
+        :param reference: 参考信号在通道中的序号，为None时使用内部参考并推进samples
+        :return: 每个通道的X, Y, R, theta(单位为度)
+        """
+        block = np.asarray(block)
+        xy = block[..., :self.n_samples] @ self._reference
+        z = xy[..., 0] + 1j * xy[..., 1]
+        if reference is not None:
+            phase = z[reference] / np.abs(z[reference])
+            z = z * np.conj(phase)
+        else:
+            n_blocks = block.shape[-2] if block.ndim > 2 else 1
+            starts = self.samples + block.shape[-1] * np.arange(n_blocks)
+            # block开始时内部参考已经经过的周期数，只保留小数部分以免损失精度
+            cycles = np.mod(self.frequency * starts / self.sample_rate, 1.)
+            rotation = np.exp(-2j * np.pi * cycles)
+            z = z * (rotation if block.ndim > 2 else rotation[0])
+            self.samples += block.shape[-1] * n_blocks
+        x, y = z.real, z.imag
+        return {'X': x, 'Y': y, 'R': np.abs(z), 'theta': np.rad2deg(np.angle(z))}
+
+    def __call__(self, block: ndarray) -> ndarray:
+        return self.demodulate(block)[self.quantity]
+
+    def select(self, block: ndarray, channels: ndarray, quantities: list, reference: int = None) -> ndarray:
+        """
+        :param block: 采集数据，形状为(通道数, ..., 采样点数)
+        :param channels: 每个输出在通道中的序号
+        :param quantities: 每个输出的量，None时为self.quantity
+        :param reference: 参考信号在通道中的序号
+        :return: 形状为(输出数, ...)的结果，同一次解调可以同时给出例如X和Y
+        """
+        results = self.demodulate(block, reference)
+        return np.stack([results[quantity if quantity is not None else self.quantity][channel]
+                         for channel, quantity in zip(channels, quantities)])
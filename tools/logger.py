@@ -1,13 +1,193 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
 from tools.constants import get_date, get_time
 
 
+class BufferedSink:
+    """
+    带缓冲的日志文件：write()只把文本放入有界队列，由后台线程批量写入并定时刷新，
+    调用方不需要每次都打开和关闭文件。队列满时丢弃新的文本并计数，而不是阻塞调用方。
+    文件超过max_bytes或者打开时间超过rotate_interval时轮转为path.1、path.2...，最多保留backups个旧文件。
+    写入或轮转出错(例如磁盘已满、文件被占用)时后台线程不退出：没有写入的文本保留到下一次写入时重试，
+    错误保存在error中，write()第一次遇到新的错误时打印，flush()时抛出。
+    """
+
+    def __init__(self, path: str, max_bytes: int = None, rotate_interval: float = None, backups: int = 5,
+                 maxsize: int = 10000, flush_interval: float = 1.):
+        """
+        :param path: 文件路径
+        :param max_bytes: 按大小轮转的阈值，None时不按大小轮转
+        :param rotate_interval: 按时间轮转的间隔，单位s，None时不按时间轮转
+        :param backups: 保留的旧文件数
+        :param maxsize: 队列长度上限，也是出错时保留的未写入文本的上限
+        :param flush_interval: 两次刷新文件的最长间隔，单位s，间隔之内写入的文本只在刷新时才保证写到磁盘
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.maxsize = maxsize
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.error = None
+        self._reported = None
+        self._pending = []
+        self._file = None
+        self._opened = 0.
+        self._flushed = time.monotonic()
+        self._dirty = False
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def write(self, text: str):
+        error = self.error
+        if error is not None and error is not self._reported:
+            self._reported = error
+            print(f'The log file {self.path} can not be written: {error!r}')
+        try:
+            self.queue.put_nowait(text)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """等待队列中的文本全部写入文件并刷新到磁盘，写入出错时抛出保存的错误"""
+        if self._thread.is_alive():
+            done = threading.Event()
+            self.queue.put(done)
+            done.wait()
+        error, self.error = self.error, None
+        if error is not None:
+            raise RuntimeError(f'The log file {self.path} can not be written!') from error
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                # 空闲时刷新间隔之内写入的文本，并重试之前没有写入的文本
+                self.write_pending([])
+                self.flush_file()
+                continue
+            lines = [item]
+            # 一次取出队列中已有的全部文本，合并为一次写入
+            while not isinstance(lines[-1], threading.Event) and lines[-1] is not None:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            control = lines.pop() if not isinstance(lines[-1], str) else False
+            self.write_pending(lines)
+            if control is not False or time.monotonic() - self._flushed >= self.flush_interval:
+                self.flush_file()
+            if isinstance(control, threading.Event):
+                control.set()
+            elif control is None:
+                if self._file is not None:
+                    try:
+                        self._file.close()
+                    except OSError as error:
+                        self.error = error
+                    self._file = None
+                break
+
+    def write_pending(self, lines: list):
+        """写入之前没有写入的文本和lines，出错时保留这些文本，超过maxsize行时丢弃最早的部分"""
+        self._pending.extend(lines)
+        if not self._pending:
+            return
+        try:
+            self.write_lines(self._pending)
+        except OSError as error:
+            self.fail(error)
+            if len(self._pending) > self.maxsize:
+                self.dropped += len(self._pending) - self.maxsize
+                del self._pending[:-self.maxsize]
+            return
+        # 之前的错误已经恢复，保留的文本都已写入
+        self._pending = []
+        self.error = None
+
+    def write_lines(self, lines: list):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+            self._opened = time.time()
+        self._file.write(''.join(lines))
+        self._dirty = True
+        if self.should_rotate():
+            try:
+                self.rotate()
+            except OSError as error:
+                # 文本已经写入，只是没有轮转，下一次写入时重新打开文件并再次尝试轮转
+                self.fail(error)
+
+    def flush_file(self):
+        if self._file is not None and self._dirty:
+            try:
+                self._file.flush()
+            except OSError as error:
+                self.fail(error)
+                return
+        self._dirty = False
+        self._flushed = time.monotonic()
+
+    def fail(self, error: OSError):
+        """记录错误并关闭文件，下一次写入时重新打开"""
+        self.error = error
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+    def should_rotate(self) -> bool:
+        if self.max_bytes is not None and self._file.tell() >= self.max_bytes:
+            return True
+        return self.rotate_interval is not None and time.time() - self._opened >= self.rotate_interval
+
+    def rotate(self):
+        self._file.close()
+        self._file = None
+        for num in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{num}'):
+                os.replace(f'{self.path}.{num}', f'{self.path}.{num + 1}')
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+
 # Todo:规定一下logging的输出格式
 class Logger:
     def __init__(self,
                  sample_name: str,
                  mkor4k: str,
                  tester: str,
-                 path: str):
+                 path: str,
+                 structured: bool = True,
+                 max_bytes: int = 10 * 1024 ** 2,
+                 rotate_interval: float = None,
+                 backups: int = 5):
+        """
+        :param sample_name: 样品名
+        :param mkor4k: 温度，例如'4k'或'mk'
+        :param tester: 测试者
+        :param path: 日志目录
+        :param structured: 是否同时写入JSON lines格式的事件日志(project_name.jsonl)
+        :param max_bytes: 事件日志按大小轮转的阈值
+        :param rotate_interval: 事件日志按时间轮转的间隔，单位s
+        :param backups: 事件日志保留的旧文件数
+        """
         self.logging_path = path
         self.project_name = sample_name + mkor4k + 'test'
         self.sample_name = sample_name
@@ -15,14 +195,53 @@ class Logger:
         self.create_time = get_time()
         self.date = get_date()
         self.full_path = None
-        self.create()
+        self.events_path = None
+        self._text = None
+        self._events = None
+        self.create(structured, max_bytes, rotate_interval, backups)
 
-    def create(self):
+    def create(self, structured: bool = True, max_bytes: int = None, rotate_interval: float = None,
+               backups: int = 5):
+        # 重新创建时先关闭之前的写入线程
+        self.close()
         self.full_path = self.logging_path + self.project_name + '.txt'
+        self._text = BufferedSink(self.full_path)
+        if structured:
+            self.events_path = self.logging_path + self.project_name + '.jsonl'
+            self._events = BufferedSink(self.events_path, max_bytes, rotate_interval, backups)
+        else:
+            self._events = None
+        # 退出时写完队列中的日志；close()时注销，不再持有已关闭的logger
+        atexit.register(self.close)
         msg = f'The logger of {self.project_name} is created at {self.create_time} {self.date}\n Sample name: {self.sample_name}\n tester: {self.tester}\n'
-        with open(self.full_path, 'a') as file:
-            file.write(msg)
+        self.write(msg)
+        self.event('logger_created', sample_name=self.sample_name, tester=self.tester)
 
     def write(self, msg: str):
-        with open(self.full_path, 'a') as file:
-            file.write(msg)
+        self._text.write(msg)
+
+    def event(self, event: str, run_id: int = None, **fields):
+        """
+        记录一个结构化事件，每个事件为一行json：{"time": ..., "run_id": ..., "event": ..., 其他字段}
+        只放入队列，可以在扫描的每个点调用
+        :param event: 事件名，例如'scan_start'
+        :param run_id: run id
+        :param fields: 其他字段，需要可以转换为json(不能转换的值保存为字符串)
+        :return: None
+        """
+        if self._events is None:
+            return
+        record = {'time': time.time(), 'run_id': run_id, 'event': event, **fields}
+        self._events.write(json.dumps(record, default=str) + '\n')
+
+    def flush(self):
+        self._text.flush()
+        if self._events is not None:
+            self._events.flush()
+
+    def close(self):
+        atexit.unregister(self.close)
+        if self._text is not None:
+            self._text.close()
+        if self._events is not None:
+            self._events.close()
@@ -0,0 +1,228 @@
+import threading
+import time
+from typing import List, Union
+import numpy as np
+from instruments.meta_instruments import ACQTask
+from tools.constants import get_time
+from tools.project import Project
+from tools.writer import AsyncWriter
+
+
+class Monitor:
+    """
+    连续时间序列监测模式：长时间连续采集信号(例如漂移、电荷跳变)。
+    内存中只保留一个固定长度的滚动窗口供实时查看，原始数据和抽取后的数据追加写入可扩展的hdf5数据集，
+    每个采集块记录一个时间戳，超出阈值的点记录为事件。内存占用不随监测时间增长。
+    """
+    data_keys = {'raw': 'monitor/raw',
+                 'decimated': 'monitor/decimated',
+                 'timestamps': 'monitor/timestamps',
+                 'events': 'monitor/events'}
+
+    def __init__(self,
+                 project: Project,
+                 acq_channels: Union[str, List[str]] = 'Dev1/ai4',
+                 sample_rate: float = 1e4,
+                 block_size: int = 1000,
+                 window: float = 60.,
+                 decimate: int = 100,
+                 store_raw: bool = True,
+                 thresholds: dict = None,
+                 flush_interval: float = 1.):
+        """
+        :param project: 所属的Project，用于获取run id、数据路径和logger
+        :param acq_channels: 采集通道
+        :param sample_rate: 采样率
+        :param block_size: 每次读取的每个通道的采样点数
+        :param window: 滚动窗口的长度，单位s
+        :param decimate: 抽取倍数，每decimate个点取平均写入decimated数据集，需要整除block_size
+        :param store_raw: 是否保存原始数据
+        :param thresholds: 阈值，key为通道序号，value为(下限, 上限)，超出范围以及回到范围内时各记录一个事件
+        :param flush_interval: 两次将数据刷新到磁盘的最短间隔，单位s
+        """
+        if block_size % decimate:
+            raise ValueError('decimate must divide block_size!')
+        self.manager = project.manager
+        self.logger = project.logger
+        self.acq_channels = [acq_channels] if isinstance(acq_channels, str) else list(acq_channels)
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.decimate = decimate
+        self.store_raw = store_raw
+        self.thresholds = thresholds if thresholds is not None else {}
+        self.flush_interval = flush_interval
+        n_window = max(int(window * sample_rate) // block_size, 1) * block_size
+        self._window = np.zeros((len(self.acq_channels), n_window))
+        self._cursor = 0
+        self._filled = False
+        self._running = False
+        self._thread = None
+        self._writer = None
+        self._outside = {}
+        self.blocks = 0
+        self.events = 0
+
+    @property
+    def window(self) -> np.ndarray:
+        """
+        :return: 滚动窗口中的数据，按时间顺序排列，形状为(通道数, 采样点数)
+        """
+        if not self._filled:
+            return self._window[:, :self._cursor].copy()
+        return np.roll(self._window, -self._cursor, axis=1)
+
+    def start(self, duration: float = None):
+        """
+        在后台线程中开始监测
+        :param duration: 监测时长，单位s，默认一直监测直到调用stop()
+        :return: None
+        """
+        # 在启动线程之前设置，紧接着调用的stop()不会被线程覆盖
+        self._running = True
+        self._thread = threading.Thread(target=self.monitor, args=(duration,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run(self, duration: float = None):
+        """
+        在当前线程中监测
+        :param duration: 监测时长，单位s，默认一直监测直到在其他线程中调用stop()
+        :return: None
+        """
+        self._running = True
+        self.monitor(duration)
+
+    def monitor(self, duration: float = None):
+        """监测的主循环，只读取_running，由start()或者run()设置"""
+        self.manager.update_run_id()
+        data_file = self.manager.create_hdf5_file
+        n_chan = len(self.acq_channels)
+        self.manager.register_run('monitor', [], [], self.acq_channels, (n_chan, 0))
+        self.blocks = 0
+        self.events = 0
+        self._outside = {channel: False for channel in self.thresholds}
+        self.logger.write(f'Monitor {",".join(self.acq_channels)} with the run id {self.manager.id} '
+                          f'starts at {get_time()}\n')
+        self.logger.event('monitor_start', run_id=self.manager.id, channels=self.acq_channels,
+                          sample_rate=self.sample_rate)
+        try:
+            with self.manager.open_file(data_file) as file, \
+                    ACQTask(acq_name='art', acq_channels=self.acq_channels,
+                            sample_rate=self.sample_rate, memory_size=self.block_size) as daq:
+                datasets = self.create_datasets(file, n_chan)
+                self.manager.start_swmr(file)
+                # 扩展和写入数据集都在后台线程中完成，磁盘延迟不会使采集缓冲区溢出
+                self._writer = AsyncWriter(flush_interval=self.flush_interval)
+                try:
+                    self.acquire(file, daq, datasets, duration)
+                finally:
+                    writer, self._writer = self._writer, None
+                    writer.close()
+        except BaseException as error:
+            status = 'aborted' if isinstance(error, KeyboardInterrupt) else 'failed'
+            self._running = False
+            try:
+                self.logger.write(f'Monitor with the run id {self.manager.id} {status} at {get_time()} '
+                                  f'after {self.blocks} blocks: {error!r}\n' + '-' * 20 + '\n')
+                self.logger.event('monitor_' + status, run_id=self.manager.id, blocks=self.blocks,
+                                  error=repr(error))
+            finally:
+                self.manager.finish_run(status)
+            raise
+        self._running = False
+        self.manager.finish_run()
+        self.logger.event('monitor_stop', run_id=self.manager.id, blocks=self.blocks, events=self.events)
+        self.logger.write(f'Monitor with the run id {self.manager.id} stops at {get_time()} '
+                          f'after {self.blocks} blocks and {self.events} events\n' + '-' * 20 + '\n')
+
+    def acquire(self, file, daq: ACQTask, datasets: dict, duration: float = None):
+        start = time.time()
+        last_flush = start
+        first = None
+        while self._running and (duration is None or time.time() - start < duration):
+            block = daq.read_block()
+            # 时间戳为该块第一个采样点的时间：由第一个块的读取时间和采样点数推算，不受每次读取延迟的影响
+            if first is None:
+                first = time.time() - self.block_size / self.sample_rate
+            stamp = first + self.blocks * self.block_size / self.sample_rate
+            self.append_window(block)
+            self.append_block(datasets, block, stamp)
+            if time.time() - last_flush > self.flush_interval:
+                self._writer.after(file.flush)
+                last_flush = time.time()
+
+    def create_datasets(self, file, n_chan: int) -> dict:
+        datasets = {}
+        if self.store_raw:
+            datasets['raw'] = self.manager.create_dataset(file, self.data_keys['raw'], (n_chan, 0), 'f4',
+                                                          maxshape=(n_chan, None), chunks=(n_chan, self.block_size))
+        datasets['decimated'] = self.manager.create_dataset(file, self.data_keys['decimated'], (n_chan, 0), 'f4',
+                                                            maxshape=(n_chan, None),
+                                                            chunks=(n_chan, self.block_size // self.decimate * 64))
+        datasets['timestamps'] = file.create_dataset(self.data_keys['timestamps'], shape=(0,), dtype='f8',
+                                                     maxshape=(None,), chunks=(1024,))
+        # 每个事件记录(时间戳, 通道序号, 数值, 1超出范围/0回到范围内)
+        datasets['events'] = file.create_dataset(self.data_keys['events'], shape=(0, 4), dtype='f8',
+                                                 maxshape=(None, 4), chunks=(256, 4))
+        for dataset in datasets.values():
+            dataset.attrs['sample_rate'] = self.sample_rate
+            dataset.attrs['block_size'] = self.block_size
+        datasets['decimated'].attrs['decimate'] = self.decimate
+        file['monitor'].attrs['channels'] = self.acq_channels
+        return datasets
+
+    def append_window(self, block: np.ndarray):
+        n = block.shape[1]
+        self._window[:, self._cursor:self._cursor + n] = block
+        self._cursor += n
+        if self._cursor >= self._window.shape[1]:
+            self._cursor = 0
+            self._filled = True
+
+    def append_block(self, datasets: dict, block: np.ndarray, stamp: float):
+        n_chan, n = block.shape
+        if self.store_raw:
+            self._writer.after(self.extend, datasets['raw'], np.array(block))
+        decimated = block.reshape(n_chan, n // self.decimate, self.decimate).mean(axis=2)
+        self._writer.after(self.extend, datasets['decimated'], decimated)
+        self._writer.after(self.extend, datasets['timestamps'], np.array([stamp]))
+        events = self.find_events(block, stamp)
+        if len(events):
+            self._writer.after(self.extend, datasets['events'], events, 0)
+            self.events += len(events)
+            for stamp, channel, value, outside in events:
+                self.logger.event('threshold', run_id=self.manager.id, stamp=stamp, channel=int(channel), value=value,
+                                  outside=bool(outside))
+        self.blocks += 1
+
+    @staticmethod
+    def extend(dataset, value: np.ndarray, axis: int = -1):
+        """在后台写入线程中沿axis扩展dataset并在末尾写入value"""
+        axis = axis % dataset.ndim
+        n = value.shape[axis]
+        dataset.resize(dataset.shape[axis] + n, axis=axis)
+        key = [slice(None)] * dataset.ndim
+        key[axis] = slice(-n, None)
+        dataset[tuple(key)] = value
+
+    def find_events(self, block: np.ndarray, stamp: float) -> np.ndarray:
+        """
+        找出超出阈值和回到阈值范围内的点，持续超出阈值的一段只在开始和结束时各记录一个事件，跨越多个块时也是如此
+        :return: 形状为(事件数, 4)的数组，每行为(时间戳, 通道序号, 数值, 1超出范围/0回到范围内)
+        """
+        events = []
+        for channel, (low, high) in self.thresholds.items():
+            outside = (block[channel] < low) | (block[channel] > high)
+            previous = self._outside.get(channel, False)
+            # 与上一个块最后的状态比较，状态改变的点即为事件
+            changes = np.flatnonzero(np.diff(outside, prepend=previous))
+            for index in changes:
+                events.append((stamp + index / self.sample_rate, channel, block[channel, index], outside[index]))
+            self._outside[channel] = bool(outside[-1]) if len(outside) else previous
+        events.sort(key=lambda event: event[0])
+        return np.array(events, dtype=float).reshape(-1, 4)
@@ -0,0 +1,131 @@
+import time
+from abc import ABC, abstractmethod
+
+
+class ProgressReporter(ABC):
+    """
+    扫描进度汇报的基类。
+    update()每个测量点都会调用，但只有距离上一次输出超过1/max_rate秒时才真正输出，
+    输出内容包括点速率(points/s)、剩余时间(ETA)以及settle/acquire/write各阶段的耗时。
+    子类只需要实现emit()决定输出到哪里(终端、日志文件或者内存)。
+    """
+    stages = ('settle', 'acquire', 'write')
+
+    def __init__(self, max_rate: float = 5.):
+        """
+        :param max_rate: 每秒最多输出的次数，0代表每个点都输出
+        """
+        self.interval = 1 / max_rate if max_rate else 0.
+        self.run_id = None
+        self.total = 0
+        self.done = 0
+        self.timings = dict.fromkeys(self.stages, 0.)
+        self._start = 0.
+        self._last_emit = 0.
+
+    def start(self, run_id, total: int):
+        """
+        :param run_id: 当前的run id
+        :param total: 本次扫描的总点数
+        :return: None
+        """
+        self.run_id = run_id
+        self.total = total
+        self.done = 0
+        self.timings = dict.fromkeys(self.stages, 0.)
+        self._start = time.perf_counter()
+        self._last_emit = 0.
+
+    def add_time(self, stage: str, seconds: float):
+        self.timings[stage] += seconds
+
+    def update(self, done: int, current: float = None, unit: str = '', **index):
+        """
+        :param done: 已经完成的点数
+        :param current: 当前点的测量值(已换算到unit)
+        :param unit: 测量值的单位
+        :param index: 当前点的索引，例如idx=3, idy=5
+        :return: None
+        """
+        self.done = done
+        now = time.perf_counter()
+        if now - self._last_emit < self.interval and done < self.total:
+            return
+        self._last_emit = now
+        self.emit(self.state(now, current, unit, index))
+
+    def finish(self):
+        self.emit(self.state(time.perf_counter(), None, '', {}))
+
+    def state(self, now: float, current, unit: str, index: dict) -> dict:
+        elapsed = now - self._start
+        rate = self.done / elapsed if elapsed > 0 else 0.
+        eta = (self.total - self.done) / rate if rate > 0 else float('inf')
+        return {'run_id': self.run_id, 'done': self.done, 'total': self.total, 'elapsed': elapsed,
+                'rate': rate, 'eta': eta, 'current': current, 'unit': unit, 'index': dict(index),
+                'timings': dict(self.timings)}
+
+    @staticmethod
+    def format(state: dict, scale: int = 40) -> str:
+        fraction = state['done'] / state['total'] if state['total'] else 1.
+        index = ' '.join(f'{k}:{v}' for k, v in state['index'].items())
+        current = '' if state['current'] is None else f"--- {state['current']:.4f} {state['unit']} "
+        timings = ' '.join(f'{k}:{v:.1f}s' for k, v in state['timings'].items())
+        return ('Run id:{ID} {index} {current}[{done}{padding}]{percent:.1f}% '
+                '{rate:.1f} pts/s ETA {eta:.0f}s ({timings})').format(ID=state['run_id'],
+                                                                     index=index,
+                                                                     current=current,
+                                                                     done='#' * int(fraction * scale),
+                                                                     padding=' ' * (scale - int(fraction * scale)),
+                                                                     percent=fraction * 100,
+                                                                     rate=state['rate'],
+                                                                     eta=state['eta'],
+                                                                     timings=timings)
+
+    @abstractmethod
+    def emit(self, state: dict):
+        """
+        :param state: format()所需的进度信息，包括run_id、done、total、rate、eta以及各阶段的耗时
+        :return: None
+        """
+
+
+class TerminalReporter(ProgressReporter):
+    """在终端中用同一行刷新进度"""
+
+    def emit(self, state: dict):
+        print('\r' + self.format(state), end='', flush=True)
+
+    def finish(self):
+        super().finish()
+        print()
+
+
+class FileReporter(ProgressReporter):
+    """将进度逐行追加写入日志文件"""
+
+    def __init__(self, path: str, max_rate: float = 1.):
+        super().__init__(max_rate)
+        self.path = path
+
+    def emit(self, state: dict):
+        with open(self.path, 'a') as file:
+            file.write(self.format(state) + '\n')
+
+
+class MemoryReporter(ProgressReporter):
+    """将进度保存在内存中，便于在notebook中查看"""
+
+    def __init__(self, max_rate: float = 5., max_length: int = 1000):
+        super().__init__(max_rate)
+        self.max_length = max_length
+        self.history = []
+
+    @property
+    def latest(self) -> dict:
+        return self.history[-1] if self.history else {}
+
+    def emit(self, state: dict):
+        self.history.append(state)
+        if len(self.history) > self.max_length:
+            del self.history[0]
@@ -1,9 +1,12 @@
 import os
 from tools.constants import File_path
 from tools.logger import Logger
+from tools.catalog import RunCatalog, station_state
+from tools.storage import RunCache, RunView, Pyramid
+from tools.archive import ARCHIVE_NAME, RunArchive, consolidate
+from tools.snapshot import SnapshotStore, StationSnapshot, read_station, load_snapshot
 import numpy as np
 import h5py
-import sys
 
 path = File_path()
 project_path = path()
@@ -30,14 +33,52 @@ class Project:
 
 
 class DataManager:
-    def __init__(self, data_path: File_path, run_id: int = 0):
+    def __init__(self, data_path: File_path, run_id: int = 0, compression: str = None, compression_opts=None,
+                 shuffle: bool = True, swmr: bool = False, chunk_bytes: int = 256 * 1024, catalog=True,
+                 cache_bytes: int = 512 * 1024 ** 2, spill_dir: str = None, pyramid: bool = False,
+                 pyramid_size: int = 256, snapshot: bool = True, snapshot_update: bool = True,
+                 snapshot_full_every: int = 50):
+        """
+        :param data_path: 数据路径
+        :param run_id: 起始run id
+        :param compression: 数据集的无损压缩方式，None、'gzip'或者'lzf'
+        :param compression_opts: 压缩参数，例如gzip的压缩等级0-9
+        :param shuffle: 压缩前是否做字节重排，对浮点数据通常可以明显提高压缩率
+        :param swmr: 是否以SWMR(单写多读)模式写入，其他进程可以用open_file(..., 'r')在扫描过程中读取数据
+        :param chunk_bytes: 每个chunk的目标大小，需要小于h5py默认的1 MB chunk缓存
+        :param catalog: run目录，True时使用数据根目录下的runs.sqlite，也可以传入数据库路径，False时不记录
+        :param cache_bytes: 内存中缓存最近扫描结果的字节数上限
+        :param spill_dir: 缓存溢出时保存memmap文件的目录，None时直接丢弃
+        :param pyramid: 2d扫描时是否同时生成多分辨率金字塔
+        :param pyramid_size: 金字塔一直生成到x和y方向的点数都不超过该值的一层
+        :param snapshot: 是否在每个run文件中保存station快照
+        :param snapshot_update: 快照是否从仪器读取，False时只使用参数的缓存
+        :param snapshot_full_every: 两个完整快照之间最多的差异快照数，见SnapshotStore
+        """
         self.path = data_path
         self.date_path = data_path()  # e.g. 'D:/Data/2023-09-19/'
         self.date = path.date
         self.id = run_id
         self.data_keys = {"scan": ['scan/scan_range_x', 'scan/scan_range_y'],
-                          'meas': 'meas/measurement'}
-        self.data_cache = 0
+                          'meas': 'meas/measurement',
+                          'variance': 'meas/variance',
+                          'repeats': 'meas/repeats',
+                          'raw': 'meas/raw',
+                          'pyramid': 'pyramid'}
+        self.cache = RunCache(self.load_run, cache_bytes, spill_dir)
+        self.pyramid = pyramid
+        self.pyramid_size = pyramid_size
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.shuffle = shuffle
+        self.swmr = swmr
+        self.chunk_bytes = chunk_bytes
+        if catalog is True:
+            catalog = data_path.root_path + 'runs.sqlite'
+        self.catalog = RunCatalog(catalog) if catalog else None
+        self.snapshots = SnapshotStore(snapshot_full_every) if snapshot else None
+        self.snapshot_update = snapshot_update
+        self.snapshot = None
 
     def count_hdf5_files(self):
         """
@@ -45,6 +86,8 @@ class DataManager:
         过滤出以 '.h5' 结尾的文件名
         :return: hdf5文件数量
         """
+        if self.catalog is not None:
+            return self.catalog.count(self.date)
         file_names = os.listdir(self.date_path)
         h5_file_names = [file_name for file_name in file_names if file_name.endswith('.h5')]
         return len(h5_file_names)
@@ -54,14 +97,187 @@ class DataManager:
             self.id = 0
             self.date_path = self.path()
             self.date = self.path.date
+            # run id在新的日期重新开始，旧的缓存不再对应，快照的差异也不跨日期
+            self.cache.clear()
+            if self.snapshots is not None:
+                self.snapshots.reset()
         else:
             self.id += 1
+        if self.catalog is not None:
+            # 重启程序后不会覆盖当天已有的run
+            self.id = max(self.id, self.catalog.last_id(self.date) + 1)
+
+    def register_run(self, scan_type: str, axes: list, ranges: list, measured: list, shape: tuple, station=None,
+                     settings: dict = None):
+        """
+        读取station快照(保存在self.snapshot中，由save_snapshot写入run文件)，并在run目录中登记当前run id对应的run
+        :param scan_type: 'scan_1d'、'scan_2d'等
+        :param axes: 每个扫描维度的参数名列表
+        :param ranges: 每个扫描维度的扫描范围
+        :param measured: 测量参数名
+        :param shape: 数据的形状
+        :param station: qcodes Station，用于记录快照摘要以及其他参数的数值
+        :param settings: run的数值设置，例如重复扫描的次数
+        :return: None
+        """
+        self.snapshot = None
+        if station is not None and self.snapshots is not None:
+            self.snapshot = read_station(station, self.snapshot_update)
+        if self.catalog is None:
+            return
+        if self.snapshot is not None:
+            digest, static = self.snapshot.digest, self.snapshot.numeric()
+        else:
+            digest, static = station_state(station)
+        for names in axes:
+            for name in names:
+                static.pop(name, None)
+        self.catalog.register(self.date, self.id, self.run_file(self.id), scan_type, axes, ranges, measured,
+                              shape, digest, static, settings)
+
+    def save_snapshot(self, file: h5py.File):
+        """把register_run读取的快照写入run文件，需要在开始SWMR之前调用"""
+        if self.snapshot is not None and self.snapshots is not None:
+            self.snapshots.save(file, self.snapshot, self.id)
+
+    def load_snapshot(self, run_id: int, date: str = None) -> StationSnapshot:
+        """
+        :param run_id: run id
+        :param date: 日期，默认为当前日期
+        :return: run开始时的完整station快照，由差异快照向前合并得到
+        """
+        return load_snapshot(lambda num: self.locate_run(num, date), run_id)
+
+    def update_settings(self, settings: dict):
+        """更新当前run在run目录中登记的设置"""
+        if self.catalog is not None:
+            self.catalog.update_settings(self.date, self.id, settings)
+
+    def finish_run(self, status: str = 'finished'):
+        if self.catalog is not None:
+            self.catalog.finish(self.date, self.id, status)
 
     @property
     def create_hdf5_file(self):
-        file_name = self.date_path + f'{self.id}.hdf5'
+        file_name = self.run_file(self.id)
         return file_name
 
+    def run_file(self, run_id: int) -> str:
+        """
+        :param run_id: run id
+        :return: 当前日期目录下run id对应的hdf5文件路径
+        """
+        return self.date_path + f'{run_id}.hdf5'
+
+    def locate_run(self, run_id: int, date: str = None) -> h5py.Group:
+        """
+        以只读方式打开run：优先打开{run_id}.hdf5，原文件已经合并并删除时打开归档文件中的runs/{run_id}组，
+        两种情况下组内的结构相同，用完之后关闭group.file
+        :param run_id: run id
+        :param date: 日期，默认为当前日期
+        :return: h5py.File或者h5py.Group
+        """
+        date_path = self.date_path if date is None else self.path.root_path + date + '/'
+        file_name = date_path + f'{run_id}.hdf5'
+        if os.path.exists(file_name):
+            return self.open_file(file_name, 'r')
+        archive = RunArchive(date_path + ARCHIVE_NAME)
+        if run_id in archive:
+            return archive.open(run_id)
+        raise FileNotFoundError(f'The run {run_id} is not found in {date_path}!')
+
+    def consolidate(self, date: str = None, **kwargs) -> list:
+        """
+        把一个日期目录下的run合并到该目录的归档文件中，见tools.archive.consolidate；当前日期时跳过当前run
+        :param date: 日期，默认为当前日期
+        :param kwargs: 传给consolidate的参数，例如workers、remove
+        :return: 本次合并的run id
+        """
+        date = self.date if date is None else date
+        skip = set(kwargs.pop('skip', ()))
+        if date == self.date:
+            skip.add(self.id)
+        return consolidate(self.path.root_path + date + '/', skip=skip, catalog=self.catalog, date=date, **kwargs)
+
+    def open_file(self, file_name: str, mode: str = 'a') -> h5py.File:
+        """
+        打开数据文件，SWMR模式下使用最新的文件格式，以'r'打开时可以读取正在写入的文件
+        :param file_name: 文件路径
+        :param mode: 打开方式
+        :return: h5py.File
+        """
+        if not self.swmr:
+            return h5py.File(file_name, mode)
+        if mode == 'r':
+            return h5py.File(file_name, 'r', libver='latest', swmr=True)
+        return h5py.File(file_name, mode, libver='latest')
+
+    def start_swmr(self, file: h5py.File):
+        """所有数据集和属性创建完成之后调用，此后其他进程可以读取该文件"""
+        if self.swmr and not file.swmr_mode:
+            file.swmr_mode = True
+
+    @staticmethod
+    def chunk_shape(shape: tuple, itemsize: int, chunk_bytes: int = 256 * 1024) -> tuple:
+        """
+        按写入顺序确定chunk的形状：扫描沿最后一维(1d为点，2d为行)写入，
+        因此chunk包含其他维度的全部数据，沿最后一维取尽量多的切片使chunk接近chunk_bytes
+        :param shape: 数据集的形状
+        :param itemsize: 每个元素的字节数
+        :param chunk_bytes: chunk的目标大小
+        :return: chunk的形状
+        """
+        inner = [max(int(size), 1) for size in shape[:-1]]
+        # 单个切片超过目标大小时，依次减半最大的维度
+        while int(np.prod(inner)) * itemsize > chunk_bytes and max(inner, default=1) > 1:
+            largest = int(np.argmax(inner))
+            inner[largest] = (inner[largest] + 1) // 2
+        outer = max(chunk_bytes // (int(np.prod(inner)) * itemsize), 1)
+        return tuple(inner) + (int(min(outer, max(int(shape[-1]), 1))),)
+
+    def create_dataset(self, file: h5py.File, key: str, shape: tuple, dtype='f8', **kwargs) -> h5py.Dataset:
+        """
+        创建按写入顺序分块、可选压缩的数据集
+        :param file: 打开的hdf5文件
+        :param key: 数据集的路径，例如self.data_keys['meas']
+        :param shape: 数据集的形状，最后一维为写入的顺序
+        :param dtype: 数据类型
+        :param kwargs: 传给h5py create_dataset的其他参数，例如maxshape
+        :return: h5py.Dataset
+        """
+        dtype = np.dtype(dtype)
+        options = {'chunks': self.chunk_shape(shape, dtype.itemsize, self.chunk_bytes)}
+        if self.compression is not None:
+            options.update(compression=self.compression, shuffle=self.shuffle)
+            if self.compression_opts is not None:
+                options['compression_opts'] = self.compression_opts
+        options.update(kwargs)
+        return file.create_dataset(key, shape=shape, dtype=dtype, **options)
+
+    def create_pyramid(self, file: h5py.File, dataset: h5py.Dataset, write=None):
+        """
+        为2d扫描数据创建金字塔的各层数据集(已经存在时直接使用)
+        :param file: 打开的hdf5文件
+        :param dataset: 形状为(测量参数个数, nx, ny)的扫描数据集
+        :param write: 写入函数，见Pyramid
+        :return: Pyramid，未开启金字塔或者数据不是2d时返回None
+        """
+        if not self.pyramid or dataset.ndim != 3:
+            return None
+        group = file.require_group(self.data_keys['pyramid'])
+        shape = dataset.shape
+        levels = []
+        while max(shape[1:]) > self.pyramid_size:
+            shape = (shape[0],) + tuple((size + 1) // 2 for size in shape[1:])
+            name = f'level{len(levels) + 1}'
+            if name in group:
+                levels.append({stat: group[name][stat] for stat in Pyramid.stats})
+                continue
+            level = group.create_group(name)
+            levels.append({stat: self.create_dataset(level, stat, shape, dataset.dtype) for stat in Pyramid.stats})
+            level.attrs['factor'] = 2 ** len(levels)
+        return Pyramid(levels, dataset.shape[-1], write) if levels else None
+
     def progress_bar(self, length, idx, idz, current, current_unit: str, idy=None):
         scale = 40
         unit_ = {'pA': 1e12, 'nA': 1e9, 'muA': 1e6, 'mA': 1e3, 'A': 1e0}
@@ -86,12 +302,47 @@ class DataManager:
         else:
             return False
 
+    @property
+    def data_cache(self):
+        """当前run id对应的缓存数据，没有缓存时为0"""
+        return self.cache.get(self.id) if self.id in self.cache else 0
+
     def save_cache(self, data, unit: str = 'MB', threshold: int = 50):
+        """
+        将当前run的数据放入缓存，超过threshold的数据不保存在内存中(设置了spill_dir时保存为memmap)
+        """
         scale = {'B': 1, 'KB': 1024, 'MB': 1048576, 'GB': 1073741824}[unit]
-        size = sys.getsizeof(data) // scale
+        size = data.nbytes / scale
         if size > threshold:
+            self.cache.discard(self.id)
+            self.cache.spill(self.id, data)
             msg = f'The size of data is larger than {threshold} {unit} and it is failed to save into a cache'
             print(msg)
             return msg
-        self.data_cache = data
+        self.cache.put(self.id, data)
         return 'Save a cache successfully'
+
+    def load(self, run_id: int):
+        """
+        :param run_id: 当前日期目录下的run id
+        :return: 测量数据，优先从缓存中读取
+        """
+        return self.cache.get(run_id)
+
+    def open_run(self, run_id: int, memmap: bool = True, date: str = None) -> RunView:
+        """
+        以只读方式打开run，返回惰性视图，只读取切片需要的数据，例如
+        with manager.open_run(3) as run:
+            line = run[0, :, 10]
+            x, y = run.axes
+        :param run_id: run id
+        :param memmap: 连续存储且未压缩的数据集是否映射为np.memmap
+        :param date: 日期，默认为当前日期
+        :return: RunView
+        """
+        return RunView(self.locate_run(run_id, date), self.data_keys, memmap)
+
+    def load_run(self, run_id: int) -> np.ndarray:
+        group = self.locate_run(run_id)
+        with group.file:
+            return group[self.data_keys['meas']][:]
@@ -1,31 +1,46 @@
-from typing import List
+from typing import List, Callable
 from tools.project import Project
-from instruments.meta_instruments import ACQTask
+from tools.progress import ProgressReporter, TerminalReporter
+from tools.stream import LiveStream
+from tools.storage import ScanStore
+from tools.writer import AsyncWriter
+from tools.lockin import LockIn
+from instruments.meta_instruments import ACQTask, TriggerLine
 from qcodes.instrument import Parameter
 from qcodes.utils.validators import Union
 # from tools.logger import Logger
 from numpy import ndarray
 import numpy as np
 import time
+import hashlib
 from tools.constants import snapshot, get_time
 from collections import Iterable
 # from visualization import generate_notes
-import h5py
 
 
 def safe(parameter, end_point):
     if isinstance(parameter, Iterable):
-        for element in parameter:
-            ramp(element, end_point)
+        ramp_parallel(parameter, end_point)
     else:
         ramp(parameter, end_point)
 
 
+def latest(parameter):
+    """
+    参数当前的数值：设置了max_val_age的参数(例如SP1060的通道电压)在缓存没有过期时直接使用qcodes的缓存，
+    其余参数仍然查询仪器
+    """
+    cache = getattr(parameter, 'cache', None)
+    if cache is not None and getattr(cache, 'max_val_age', None) is not None:
+        return cache.get()
+    return parameter()
+
+
 def ramp(parameter, end_point, step=0.01):
     if end_point > 50 or step == 0:
         pass
     else:
-        start_point = parameter()
+        start_point = latest(parameter)
         if start_point > end_point:
             step = -step
         interval = np.arange(start_point, end_point, step)
@@ -35,6 +50,106 @@ def ramp(parameter, end_point, step=0.01):
     parameter(end_point)
 
 
+def ramp_parallel(parameters, end_points, step=0.01, delay=0.005, skip_errors: bool = False):
+    """
+    多个参数同步ramp：所有参数同时出发、同时到达终点，总时间由最长的一条ramp决定。
+    某个参数读取或设置失败时不再设置该参数，其余参数继续ramp到终点；已经在终点的参数不再重复设置。
+    :param parameters: 需要ramp的参数
+    :param end_points: 终点，可以是一个数值，也可以是与parameters一一对应的列表
+    :param step: 默认的最大步长，参数自身设置了step时以参数自身为准
+    :param delay: 每一步之后的等待时间，参数设置了更长的inter_delay时以inter_delay为准
+    :param skip_errors: 为True时只打印失败的参数，为False时在其余参数ramp完成之后抛出RuntimeError
+    :return: None
+    """
+    parameters = list(parameters)
+    if not parameters:
+        return
+    end_points = np.broadcast_to(np.asarray(end_points, dtype=float), (len(parameters),))
+    max_steps = np.array([getattr(para, 'step', None) or step for para in parameters], dtype=float)
+    # 与ramp()保持一致：终点大于50或者步长为0时不ramp，直接设置
+    moving = (end_points <= 50) & (max_steps > 0)
+    start_points = np.full(len(parameters), np.nan)
+    errors = {}
+    for num in np.flatnonzero(moving):
+        try:
+            start_points[num] = latest(parameters[num])
+        except Exception as error:
+            errors[num] = error
+    # 已经在终点的参数不需要设置
+    active = np.array([num not in errors and start_points[num] != end_points[num]
+                       for num in range(len(parameters))])
+    moving &= active
+    n_steps = np.ceil(np.abs(end_points - start_points)[moving] / max_steps[moving]).astype(int)
+    n_total = int(n_steps.max(initial=0))
+    delay = max([delay] + [getattr(para, 'inter_delay', 0) or 0 for para in parameters])
+    if n_total > 1:
+        indices = np.flatnonzero(moving)
+        path = np.linspace(start_points[moving], end_points[moving], n_total + 1)[1:-1]
+        previous = start_points[moving]
+        for values in path:
+            # 只设置数值有变化且没有失败过的参数
+            selected = [num for num, (index, val, last) in enumerate(zip(indices, values, previous))
+                        if index not in errors and val != last]
+            failed = output_batch([parameters[indices[num]] for num in selected], values[selected])
+            errors.update({indices[selected[num]]: error for num, error in failed.items()})
+            previous = values
+            time.sleep(delay)
+    final = [num for num in np.flatnonzero(active) if num not in errors]
+    failed = output_batch([parameters[num] for num in final], end_points[final])
+    errors.update({final[num]: error for num, error in failed.items()})
+    if errors:
+        msg = '\n'.join(f'{getattr(parameters[num], "name", parameters[num])}: {error!r}'
+                        for num, error in sorted(errors.items()))
+        if not skip_errors:
+            raise RuntimeError('Failed to ramp the parameters:\n' + msg)
+        print('Skip the parameters that can not be ramped:\n' + msg)
+
+
+def dac_channel(parameter):
+    """
+    判断参数是否为支持批量设置的DAC通道电压（例如SP1060的chX.voltage）
+    :param parameter: 参数
+    :return: (仪器, 通道号)，不支持批量设置时返回None
+    """
+    instrument = getattr(parameter, 'root_instrument', None)
+    channel = getattr(getattr(parameter, 'instrument', None), 'channel', None)
+    if getattr(parameter, 'short_name', None) == 'voltage' and hasattr(instrument, 'set_voltages') \
+            and isinstance(channel, int):
+        return instrument, channel
+    return None
+
+
+def output_batch(parameters, values) -> dict:
+    """
+    同时设置多个参数，同一台DAC上的通道合并成一条指令，其余参数逐个设置。
+    一个参数失败不影响其他参数，批量指令失败时该DAC上的通道改为逐个设置
+    :param parameters: 参数列表
+    :param values: 与parameters一一对应的设置值
+    :return: 设置失败的参数，key为在parameters中的序号，value为异常
+    """
+    batches = {}
+    errors = {}
+    for num, (para, val) in enumerate(zip(parameters, values)):
+        target = dac_channel(para)
+        if target is None:
+            try:
+                para(val)
+            except Exception as error:
+                errors[num] = error
+        else:
+            batches.setdefault(target[0], {})[target[1]] = (num, float(val))
+    for instrument, channels in batches.items():
+        try:
+            instrument.set_voltages({channel: val for channel, (num, val) in channels.items()})
+        except Exception:
+            for num, val in channels.values():
+                try:
+                    parameters[num](val)
+                except Exception as error:
+                    errors[num] = error
+    return errors
+
+
 def output(parameter, val):
     if isinstance(parameter, Iterable):
         for element in parameter:
@@ -44,31 +159,253 @@ def output(parameter, val):
 
 
 def ramp_all_to_zero(station):
+    parameters = []
     for parameter in station.components.values():
-        if parameter.unit != 'V':
-            pass
-        else:
-            try:
-                ramp(parameter, 0)
-            except:
-                pass
+        # 只读的参数(例如万用表的电压)不能设置
+        if getattr(parameter, 'unit', None) != 'V' or not getattr(parameter, 'settable', True):
+            continue
+        parameters.append(parameter)
+    # 无法读取或设置的参数跳过，其余参数仍然ramp到0，同以前逐个ramp时的行为一致
+    ramp_parallel(parameters, 0, skip_errors=True)
     snapshot(station)
 
 
+class ScanPlan:
+    """
+    扫描计划：扫描开始前按扫描维度编译设置点，
+    去掉数值没有变化(或者量化到同一个DAC码值)的写操作，并把同一时刻写到同一台DAC上的通道合并成一条指令。
+    点的顺序与scan_action一致：2d扫描中x变化最快，每一行开始前x已经被ramp回起点。
+    因此x的写操作在每一行中相同，y只在每一行的第一个点写入，写操作和步长按维度保存，大小与点数无关。
+    """
+
+    def __init__(self, ranges: list, scan_para: list):
+        """
+        :param ranges: 扫描范围，长度为1或2
+        :param scan_para: 每个扫描维度对应的参数，可以是一个参数或者多个联动参数组成的元组
+        """
+        axes = [tuple(para) if isinstance(para, Iterable) else (para,) for para in scan_para]
+        self.parameters = [para for axis in axes for para in axis]
+        self.shape = tuple(len(scan_range) for scan_range in ranges)
+        self.ranges = [np.asarray(scan_range, dtype=float) for scan_range in ranges]
+        # 每个参数所在的扫描维度以及在该维度中的序号
+        self._axis = [num for num, axis in enumerate(axes) for _ in axis]
+        self._column = [col for axis in axes for col in range(len(axis))]
+
+        self._groups = {}
+        self.writes = []
+        for num, (axis, scan_range) in enumerate(zip(axes, self.ranges)):
+            writes = np.zeros((len(scan_range), len(axis)), dtype=bool)
+            for col, para in enumerate(axis):
+                target = dac_channel(para)
+                codes = target[0].dac_code(scan_range) if target is not None else scan_range
+                # 每个维度的第一个点写入前参数已经位于起点
+                writes[1:, col] = codes[1:] != codes[:-1]
+                self._groups.setdefault(target[0] if target is not None else para, []).append(
+                    sum(len(a) for a in axes[:num]) + col)
+            self.writes.append(writes)
+        self.steps = [np.abs(np.diff(scan_range, prepend=scan_range[:1])) for scan_range in self.ranges]
+
+    def locate(self, point: int) -> (int, int):
+        """
+        :return: (写入的维度, 该维度中的序号)，2d扫描每一行的第一个点写入y，其余点写入x
+        """
+        idx = point % self.shape[0]
+        if len(self.shape) == 2 and idx == 0:
+            return 1, point // self.shape[0]
+        return 0, idx
+
+    @property
+    def n_points(self) -> int:
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.writes + self.steps + self.ranges)
+
+    def count(self, nums: list, combine: bool = False) -> int:
+        """
+        :param nums: 参数的序号
+        :param combine: 为True时同一个点的多个写操作只计一次
+        :return: 整个扫描中这些参数的写操作数
+        """
+        total = 0
+        for axis, writes in enumerate(self.writes):
+            columns = [self._column[num] for num in nums if self._axis[num] == axis]
+            if not columns:
+                continue
+            selected = writes[:, columns]
+            count = selected.any(axis=1).sum() if combine else selected.sum()
+            # x的写操作在每一行中重复
+            total += int(count) * (int(np.prod(self.shape[1:])) if axis == 0 else 1)
+        return total
+
+    @property
+    def n_writes(self) -> int:
+        """保留下来的单个参数的写操作数"""
+        return self.count(list(range(len(self.parameters))))
+
+    @property
+    def n_dropped(self) -> int:
+        """被去掉的写操作数"""
+        return self.n_points * len(self.parameters) - self.n_writes
+
+    @property
+    def n_commands(self) -> int:
+        """合并之后实际发给仪器的指令数"""
+        return sum(self.count(index, self.is_batch(target)) for target, index in self._groups.items())
+
+    @staticmethod
+    def is_batch(target) -> bool:
+        return hasattr(target, 'set_voltages')
+
+    def settle_times(self, models: dict, default: float):
+        """
+        每个点写入之后需要等待的时间：取该点所有被写入参数中最长的等待时间，
+        有SettleModel的参数按步长计算，没有的参数等待default；没有写操作的点等待default。
+        2d扫描每一行的第一个点之前x从上一行的终点ramp回起点，这个点的等待时间同时包括x回到起点所需的时间
+        :param models: key为参数名，value为SettleModel
+        :param default: 默认等待时间
+        :return: PointWaits，waits[point]为第point个点的等待时间
+        """
+        axis_waits = []
+        for axis, (writes, steps) in enumerate(zip(self.writes, self.steps)):
+            waits = np.where(writes, default, 0.)
+            for num, para in enumerate(self.parameters):
+                if self._axis[num] == axis and para.name in models:
+                    col = self._column[num]
+                    waits[:, col] = np.where(writes[:, col], models[para.name].wait(steps), 0.)
+            axis_waits.append(np.where(writes.any(axis=1), waits.max(axis=1, initial=0.), default))
+        if len(self.shape) == 2 and self.shape[0] > 1:
+            x_range = self.ranges[0]
+            returns = [models[para.name].wait(abs(x_range[-1] - x_range[0])) if para.name in models else default
+                       for num, para in enumerate(self.parameters) if self._axis[num] == 0]
+            if x_range[-1] != x_range[0]:
+                axis_waits[1] = np.maximum(axis_waits[1], max(returns, default=0.))
+        return PointWaits(self, axis_waits)
+
+    def estimate(self, command_time: float = 0.005, settle: float = 0., acquire: float = 0.) -> float:
+        """
+        估计执行计划所需的时间(不包括每一行开始前的ramp)
+        :param command_time: 每条仪器指令的耗时
+        :param settle: 每个点的等待时间
+        :param acquire: 每个点的采集时间
+        :return: 秒
+        """
+        return self.n_commands * command_time + self.n_points * (settle + acquire)
+
+    def apply(self, point: int):
+        """
+        执行第point个点的写操作
+        """
+        axis, index = self.locate(point)
+        writes = self.writes[axis][index]
+        value = self.ranges[axis][index]
+        for target, nums in self._groups.items():
+            nums = [num for num in nums if self._axis[num] == axis and writes[self._column[num]]]
+            if not nums:
+                continue
+            if self.is_batch(target):
+                target.set_voltages({dac_channel(self.parameters[num])[1]: float(value) for num in nums})
+            else:
+                target(value)
+
+    def __repr__(self):
+        return (f'ScanPlan(shape={self.shape}, parameters={[para.name for para in self.parameters]}, '
+                f'writes={self.n_writes}, dropped={self.n_dropped}, commands={self.n_commands})')
+
+
+class PointWaits:
+    """
+    每个点的等待时间，按扫描维度保存，waits[point]时才计算，不需要形状为(点数,)的数组
+    """
+
+    def __init__(self, plan: ScanPlan, axis_waits: list):
+        self.plan = plan
+        self.axis_waits = axis_waits
+
+    def __len__(self):
+        return self.plan.n_points
+
+    def __getitem__(self, point):
+        if isinstance(point, slice):
+            return np.array([self[num] for num in range(*point.indices(len(self)))])
+        axis, index = self.plan.locate(point)
+        return float(self.axis_waits[axis][index])
+
+
+class RepeatSlice:
+    """
+    重复扫描时代替dataset传给scan_action：把对dataset的写操作转发到逐次保存的数据集的第repeat层，
+    不保存逐次数据时直接丢弃
+    """
+
+    def __init__(self, repeats_dataset=None):
+        self.dataset = repeats_dataset
+        self.repeat = 0
+
+    def __setitem__(self, key, value):
+        if self.dataset is not None:
+            self.dataset[(self.repeat,) + key] = value
+
+
 class Scan:
+    # 随扫描范围一起由scan_spec保存、apply_spec恢复的设置
+    spec_settings = ('sleep', 'sample_rate', 'memory_size', 'trigger_batch')
 
     def __init__(self,
                  para_meas: Parameter,
                  para_scan: Union[List[Parameter], Parameter],
                  project: Project,
                  scaler: float,
-                 sleep: float = 0.01
+                 sleep: float = 0.01,
+                 reporter: ProgressReporter = None,
+                 acq_channels: Union[str, List[str]] = 'Dev1/ai4',
+                 sample_rate: float = 1e4,
+                 memory_size: int = 1000,
+                 reduction: Callable[[ndarray], ndarray] = None,
+                 stream: LiveStream = None,
+                 settle_models: dict = None,
+                 trigger_source: str = None,
+                 trigger_line: str = None,
+                 trigger_batch: int = 100,
+                 dtype: str = 'f8',
+                 window: int = None,
+                 writer: AsyncWriter = None,
+                 raw_dtype: str = None,
+                 raw_decimate: int = 1,
+                 raw_range: float = 10.
                  ):
         """
 
         :param para_meas: 测量参数，类型为Parameter，支持多个或者一个
         :param para_scan: 扫描参数
-        :param scaler: 最后结果为数据同scaler相乘
+        :param scaler: 最后结果为数据同scaler相乘，LockIn的相位('theta')不缩放
+        :param reporter: 进度汇报器，默认为在终端中每秒最多刷新5次的TerminalReporter
+        :param acq_channels: 每个测量参数对应的采集通道，传入一个字符串时所有测量参数都使用该通道。
+                             使用LockIn时也可以是(通道, 量)，例如[('Dev1/ai4', 'X'), ('Dev1/ai4', 'Y')]，
+                             同一个通道的多个量由一次解调得到
+        :param sample_rate: 采样率
+        :param memory_size: 每个点每个通道的采样点数
+        :param reduction: 每个点的化简函数，输入形状为(通道数, 采样点数)的数据，输出每个通道的一个数值，
+                          默认为取平均，也可以传入LockIn做数字锁相。触发模式下LockIn的X、Y和theta需要给出reference
+        :param stream: 实时发送数据给viewer进程的LiveStream，默认不发送
+        :param settle_models: 每个扫描参数的稳定时间模型，key为参数名，value为SettleModel，
+                              有模型的参数按步长决定等待时间，其余参数仍然等待sleep
+        :param trigger_source: 采集卡的触发输入，例如'/Dev1/PFI0'。设置后每个点由硬件触发采集memory_size个点，
+                               每次触发之后立即读取该点的数据，1d扫描每trigger_batch个点、2d扫描每一行处理和写入一次。
+                               稳定时间作为触发延迟由采集卡计时，Python只负责设置、输出触发和读取数据
+        :param trigger_line: 产生触发脉冲的数字输出线，例如'Dev1/port0/line0'，
+                             为None时触发由其他仪器在设置完成后产生
+        :param trigger_batch: 触发模式下1d扫描每次处理和写入的点数
+        :param dtype: 扫描数据的数据类型，例如'f4'可以使内存和文件大小减半
+        :param window: 为None时整个扫描的数据都保存在内存中；否则数据直接写入hdf5文件，
+                       内存中只保留最近的window个外层切片(1d为点，2d为行)，见ScanStore
+        :param writer: 后台写入数据的AsyncWriter，默认在扫描循环中直接写入
+        :param raw_dtype: 保存每个点原始采集数据的类型，'i2'或者'f4'，None时不保存。
+                          原始数据写入压缩的meas/raw数据集，未设置writer时每次扫描自动创建AsyncWriter在后台写入，
+                          扫描结束或者中断时关闭
+        :param raw_decimate: 原始数据的降采样倍数，每raw_decimate个采样点取平均，需要整除memory_size
+        :param raw_range: 'i2'格式对应的满量程电压，单位V
         :return: None
         """
         self.scaler = scaler
@@ -78,8 +415,49 @@ class Scan:
         self._ranges = {"scan_1d": [np.array([0])],
                         "scan_2d": [np.array([0]), np.array([0])]}
         self.logger = project.logger
+        self.station = project.station
         self.sleep = sleep
+        self.reporter = reporter if reporter is not None else TerminalReporter()
+        self.acq_channels, self._meas_index, self._quantities = self.channel_validate(acq_channels,
+                                                                                     len(self.para_meas))
+        self.sample_rate = sample_rate
+        self.memory_size = memory_size
+        self.reduction = reduction
+        if any(quantity is not None for quantity in self._quantities) and not hasattr(reduction, 'select'):
+            raise ValueError('Quantities of the acquisition channels require a LockIn reduction!')
+        # 外部参考信号的通道，不在测量通道中时额外采集
+        reference = getattr(reduction, 'reference', None)
+        if reference is not None and reference not in self.acq_channels:
+            self.acq_channels.append(reference)
+        self._reference = self.acq_channels.index(reference) if reference is not None else None
+        if trigger_source is not None and hasattr(reduction, 'select') and reference is None and \
+                any((quantity if quantity is not None else reduction.quantity) != 'R' for quantity in self._quantities):
+            raise ValueError('Triggered blocks are not contiguous, X, Y and theta require a LockIn with a reference!')
+        self._scale = self.quantity_scale()
+        self.stream = stream
+        self.settle_models = settle_models if settle_models is not None else {}
+        self.trigger_source = trigger_source
+        self.trigger_line = trigger_line
+        self.trigger_batch = trigger_batch
+        self.dtype = np.dtype(dtype)
+        self.window = window
+        if raw_dtype is not None and np.dtype(raw_dtype) not in (np.dtype('i2'), np.dtype('f4')):
+            raise ValueError('raw_dtype must be int16 or float32!')
+        if memory_size % raw_decimate:
+            raise ValueError('raw_decimate must divide memory_size!')
+        self.raw_dtype = np.dtype(raw_dtype) if raw_dtype is not None else None
+        self.raw_decimate = raw_decimate
+        self.raw_range = raw_range
+        self.writer = writer
+        # 自动创建的writer只在一次扫描中使用，由open_writer和close_writer管理
+        self._own_writer = writer is None and raw_dtype is not None
+        self._raw = None
+        self._raw_row = None
+        self._pyramid = None
+        self.waits: ndarray = np.array([sleep])
         self.data: ndarray = np.array([[0], [0]])
+        self._checkpoint = None
+        self.plan = None
 
     @property
     def scaler_parser(self):
@@ -95,6 +473,106 @@ class Scan:
         args = tuple(args)
         return args
 
+    @staticmethod
+    def channel_validate(acq_channels: Union[str, List[str]], length: int):
+        """
+        :param acq_channels: 采集通道，一个字符串或者与测量参数一一对应的列表，列表的元素可以是(通道, 量)
+        :param length: 测量参数的个数
+        :return: 去重后的通道列表，每个测量参数在通道列表中的序号，以及每个测量参数的量(没有指定时为None)
+        """
+        if isinstance(acq_channels, str):
+            acq_channels = [acq_channels] * length
+        if len(acq_channels) != length:
+            raise ValueError('The number of acquisition channels does not match para_meas!')
+        specs = [tuple(ch) if isinstance(ch, (tuple, list)) else (ch, None) for ch in acq_channels]
+        for channel, quantity in specs:
+            if quantity is not None and quantity not in LockIn.quantities:
+                raise ValueError(f'The quantity of {channel} must be one of {LockIn.quantities}!')
+        channels = list(dict.fromkeys(channel for channel, quantity in specs))
+        return (channels, np.array([channels.index(channel) for channel, quantity in specs]),
+                [quantity for channel, quantity in specs])
+
+    def quantity_scale(self) -> ndarray:
+        """
+        :return: 每个测量参数的除数，幅度除以scaler，相位不缩放
+        """
+        default = getattr(self.reduction, 'quantity', None)
+        angles = getattr(self.reduction, 'angles', ())
+        return np.array([1. if (quantity if quantity is not None else default) in angles else self.scaler
+                         for quantity in self._quantities])
+
+    def acq_task(self) -> ACQTask:
+        """
+        :return: 覆盖所有测量通道的采集任务
+        """
+        # 新的采集从头开始，内部参考的相位也从头开始
+        if hasattr(self.reduction, 'reset'):
+            self.reduction.reset()
+        return ACQTask(acq_name='art',
+                       acq_channels=self.acq_channels,
+                       sample_rate=self.sample_rate,
+                       memory_size=self.memory_size,
+                       trigger_source=self.trigger_source,
+                       trigger_delay=self.trigger_delay())
+
+    def trigger_delay(self) -> float:
+        """
+        触发模式下每个点的稳定时间由采集卡的触发延迟完成，取所有点中最长的等待时间，
+        因此由设置指令本身产生的触发(trigger_line为None)也在稳定之后才开始采集
+        :return: 触发延迟，单位s，非触发模式下为0
+        """
+        if self.trigger_source is None:
+            return 0.
+        waits = getattr(self.waits, 'axis_waits', [self.waits])
+        return float(max(np.max(wait, initial=0.) for wait in waits))
+
+    def trigger_task(self) -> TriggerLine:
+        return TriggerLine(self.trigger_line)
+
+    def reduce(self, block: ndarray) -> ndarray:
+        """
+        将一次采集的数据block(通道数, 采样点数)化简为每个测量参数的一个数值，
+        默认的平均以及LockIn也可以直接处理(通道数, 点数, 采样点数)的数据
+        """
+        if self.reduction is None:
+            values = np.mean(block, axis=-1)[self._meas_index]
+        elif hasattr(self.reduction, 'select'):
+            values = self.reduction.select(block, self._meas_index, self._quantities, self._reference)
+        else:
+            values = self.reduction(block)[self._meas_index]
+        return values / self._scale.reshape((-1,) + (1,) * (values.ndim - 1))
+
+    def reduce_points(self, blocks: ndarray) -> ndarray:
+        """
+        将触发模式下一次读取的数据blocks(通道数, 点数, 采样点数)化简为(测量参数个数, 点数)
+        """
+        if self.reduction is None or hasattr(self.reduction, 'select'):
+            return self.reduce(blocks)
+        values = np.stack([self.reduction(blocks[:, num]) for num in range(blocks.shape[1])], axis=1)
+        return values[self._meas_index] / self._scale[:, None]
+
+    def trigger_points(self, daq: ACQTask, trigger: TriggerLine, points) -> (ndarray, float):
+        """
+        触发模式下依次设置扫描点并发出触发，然后读取该点的数据，读取结束后再设置下一个点。
+        稳定时间由采集卡的触发延迟(见trigger_delay)计时，不在Python中等待；
+        读取在采集结束时返回，因此下一个点的设置不会落在上一个点的采集之内。
+        采集卡的缓冲区只能容纳一次触发的数据，因此不能先触发多个点再一起读取
+        :param daq: 设置了trigger_source的ACQTask
+        :param trigger: TriggerLine
+        :param points: 扫描点在plan中的序号
+        :return: (形状为(通道数, 点数, 采样点数)的数据, 读取所用的总时间)
+        """
+        points = range(points.start, points.stop) if isinstance(points, range) else list(points)
+        blocks = np.empty((len(self.acq_channels), len(points), int(self.memory_size)))
+        acquire = 0.
+        for num, point in enumerate(points):
+            self.plan.apply(point)
+            trigger.pulse()
+            t0 = time.perf_counter()
+            blocks[:, num] = daq.read_block()
+            acquire += time.perf_counter() - t0
+        return blocks, acquire
+
     @staticmethod
     def range_scan_parser(range_scan):
         if isinstance(range_scan, list):
@@ -124,6 +602,26 @@ class Scan:
         else:
             raise IndexError('Only one-dimensional data is accepted!')
 
+    def scan_spec(self) -> dict:
+        """
+        :return: 当前的扫描范围和设置，可以保存为json，之后用apply_spec恢复(例如ScanQueue中的任务)
+        """
+        return {'ranges': {scan_type: [np.asarray(range_scan).tolist() for range_scan in ranges]
+                           for scan_type, ranges in self._ranges.items()},
+                'settings': {key: np.asarray(getattr(self, key)).tolist() for key in self.spec_settings}}
+
+    def apply_spec(self, spec: dict):
+        """
+        :param spec: scan_spec()的结果
+        :return: None
+        """
+        for scan_type, ranges in spec['ranges'].items():
+            self._ranges[scan_type] = [np.array(range_scan) for range_scan in ranges]
+        for key, value in spec['settings'].items():
+            if key not in self.spec_settings:
+                raise ValueError(f'{key} is not a scan setting!')
+            setattr(self, key, value)
+
     def scan_1d(self, scan_x: int):
         # Todo：将scan_x同chip的channel联系起来
         """
@@ -132,121 +630,532 @@ class Scan:
         """
         range_1d, scan_x_para, data_file = self.scan_prepare(scan_type='scan_1d', scan_para_list=[scan_x])
 
-        with h5py.File(data_file, 'a') as file:
+        try:
+            with self.manager.open_file(data_file) as file:
+
+                dataset = self.scan_dataset(file, range_1d)
 
-            dataset = self.scan_dataset(file, range_1d)
+                self.scan_checkpoint(file, scan_type='scan_1d', scan_para_list=[scan_x])
 
-            start_time = self.scan_start(scan_x_para, range_1d)
+                start_time = self.scan_start(scan_x_para, range_1d)
 
-            self.scan_action(range_1d, scan_x_para, dataset)
+                self.scan_action(range_1d, scan_x_para, dataset)
 
-            end_time = self.scan_end(scan_x_para)
+                end_time = self.scan_end(scan_x_para)
+        except BaseException as error:
+            self.scan_abort(error)
+            raise
 
-    def scan_prepare(self, scan_type: str, scan_para_list: list) -> (list, Parameter, str):
+    def scan_prepare(self, scan_type: str, scan_para_list: list, run_type: str = None,
+                     settings: dict = None) -> (list, Parameter, str):
         """
         :param scan_type: 只能是'scan_1d'或者'scan_2d'
         :param scan_para_list:
+        :param run_type: 在run目录中登记的类型，默认与scan_type相同，例如重复扫描为'repeat_1d'
+        :param settings: 在run目录中登记的设置，例如重复次数
         :return:
         """
         ranges = self._ranges[scan_type]
         scan_para = [self.para_scan[para] for para in scan_para_list]
         if len(ranges) == len(scan_para):
-            self.data = np.zeros((len(self.para_meas),) + self.range_scan_dimension(ranges))
+            shape = (len(self.para_meas),) + self.range_scan_dimension(ranges)
+            # window模式下只记录形状和类型，不分配内存，scan_dataset创建数据集后替换为ScanStore
+            self.data = (np.zeros(shape, dtype=self.dtype) if self.window is None else
+                         np.broadcast_to(np.zeros((), dtype=self.dtype), shape))
         else:
             raise ValueError('scan_para_list is out of range and it does not match the scan range.')
+        self.plan = ScanPlan(ranges, scan_para)
+        self.waits = self.plan.settle_times(self.settle_models, self.sleep)
         self.manager.update_run_id()
         data_file = self.manager.create_hdf5_file
+        self.manager.register_run(run_type if run_type is not None else scan_type,
+                                  [[element.name for element in self.parameter_validate(para)[0]]
+                                   for para in scan_para], ranges,
+                                  [para.name for para in self.para_meas], self.data.shape, self.station, settings)
+        self.open_writer()
         return ranges, scan_para, data_file
 
+    def compile_plan(self, scan_type: str, scan_para_list: list) -> ScanPlan:
+        """
+        编译扫描计划但不执行，用于检查写操作数以及估计时间
+        :param scan_type: 只能是'scan_1d'或者'scan_2d'
+        :param scan_para_list: 扫描参数在para_scan中的序号
+        :return: ScanPlan
+        """
+        return ScanPlan(self._ranges[scan_type], [self.para_scan[para] for para in scan_para_list])
+
     def scan_dataset(self, file, ranges):
         try:
             for num in range(len(ranges)):
                 file.create_dataset(self.manager.data_keys['scan'][num], data=ranges[num])
-            dataset = file.create_dataset(self.manager.data_keys['meas'], shape=np.shape(self.data))
+            dataset = self.manager.create_dataset(file, self.manager.data_keys['meas'], self.data.shape,
+                                                  self.data.dtype)
         except ValueError:
             # Todo: 加入到logs里面
             print(f'The dataset is already created with id {self.manager.id}!')
             dataset = file[self.manager.data_keys['meas']]
+        if self.window is not None:
+            self.data = ScanStore(dataset, self.window, self.writer)
+        self._raw = self.raw_dataset(file) if self.raw_dtype is not None else None
+        self._pyramid = self.manager.create_pyramid(file, dataset, self.store)
+        self.manager.save_snapshot(file)
         return dataset
 
-    def scan_start(self, scan_para: list, ranges: list):
+    @property
+    def raw_scale(self) -> float:
+        """int16原始数据每个计数对应的电压"""
+        return self.raw_range / 32767 if self.raw_dtype == np.dtype('i2') else 1.
+
+    def raw_dataset(self, file):
+        """
+        原始数据集的形状为(采集通道数, 每个点的采样点数, 扫描维度...)，按照扫描的写入顺序分块并压缩，
+        电压 = 数值 * scale
+        """
+        key = self.manager.data_keys['raw']
+        if key in file:
+            raw = file[key]
+        else:
+            shape = (len(self.acq_channels), self.memory_size // self.raw_decimate) + self.data.shape[1:]
+            options = {} if self.manager.compression is not None else {'compression': 'gzip', 'shuffle': True}
+            raw = self.manager.create_dataset(file, key, shape, self.raw_dtype, **options)
+            raw.attrs['scale'] = self.raw_scale
+            raw.attrs['sample_rate'] = self.sample_rate / self.raw_decimate
+            raw.attrs['channels'] = self.acq_channels
+        self._raw_row = np.zeros(raw.shape[:3], dtype=self.raw_dtype) if raw.ndim == 4 else None
+        return raw
+
+    def raw_samples(self, block: ndarray) -> ndarray:
+        """
+        :param block: 一个点(通道数, 采样点数)或多个点(通道数, 点数, 采样点数)的采集数据
+        :return: 降采样并转换类型之后的数据，多个点时点数为最后一维
+        """
+        block = block.reshape(block.shape[:-1] + (-1, self.raw_decimate)).mean(axis=-1)
+        if self.raw_dtype == np.dtype('i2'):
+            block = np.clip(np.round(block / self.raw_scale), -32768, 32767)
+        block = block.astype(self.raw_dtype)
+        return block if block.ndim == 2 else block.transpose(0, 2, 1)
+
+    def store_raw(self, key, samples: ndarray):
+        if self._raw is not None:
+            self.store(self._raw, key, samples)
+
+    def config_hash(self, scan_type: str, scan_para_list: list, ranges: list) -> str:
+        """
+        扫描配置的哈希值，用于resume时确认当前Scan与断点文件中的扫描一致
+        :param scan_type: 'scan_1d'或者'scan_2d'
+        :param scan_para_list: 扫描参数在para_scan中的序号
+        :param ranges: 扫描范围
+        :return: sha1字符串
+        """
+        sha = hashlib.sha1(scan_type.encode())
+        for para in scan_para_list:
+            for element in self.parameter_validate(self.para_scan[para])[0]:
+                sha.update(element.name.encode())
+        for para in self.para_meas:
+            sha.update(para.name.encode())
+        for scan_range in ranges:
+            sha.update(np.ascontiguousarray(scan_range, dtype=float).tobytes())
+        sha.update(repr(self.scaler).encode())
+        return sha.hexdigest()
+
+    def scan_checkpoint(self, file, scan_type: str, scan_para_list: list):
+        """
+        在hdf5文件的scan组中记录断点信息：扫描类型、扫描参数、配置哈希以及最后完成的序号
+        :param file: 打开的hdf5文件
+        :param scan_type: 'scan_1d'或者'scan_2d'
+        :param scan_para_list: 扫描参数在para_scan中的序号
+        :return: None
+        """
+        checkpoint = file['scan'].attrs
+        checkpoint['scan_type'] = scan_type
+        checkpoint['scan_para_list'] = np.array(scan_para_list, dtype=int)
+        checkpoint['config_hash'] = self.config_hash(scan_type, scan_para_list, self._ranges[scan_type])
+        checkpoint['last_index'] = -1
+        checkpoint['finished'] = False
+        self._checkpoint = checkpoint
+        self.manager.start_swmr(file)
+
+    def update_checkpoint(self, dataset, index: int):
+        """
+        1d扫描每完成一个点、2d扫描每完成一行后调用，记录序号并将数据刷新到磁盘
+        """
+        if self._checkpoint is None:
+            return
+        if self.writer is not None:
+            # 断点在数据实际写入之后才更新，文件由writer定时刷新
+            self.writer.after(self._checkpoint.__setitem__, 'last_index', index)
+        else:
+            self._checkpoint['last_index'] = index
+            dataset.file.flush()
+
+    def store(self, dataset, key, value):
+        """dataset[key] = value，设置了writer时在后台线程中写入"""
+        if self.writer is not None:
+            self.writer.write(dataset, key, value)
+        else:
+            dataset[key] = value
+
+    def resume(self, run_id: int):
+        """
+        继续一个中断的扫描：读取run_id对应文件中的断点，ramp回断点位置后继续写入同一个dataset
+        :param run_id: 中断扫描的run id，需要与当前日期目录下的文件对应
+        :return: None
+        """
+        current_id = self.manager.id
+        data_file = self.manager.run_file(run_id)
+        self.open_writer()
+        try:
+            with self.manager.open_file(data_file) as file:
+                checkpoint = file['scan'].attrs
+                if 'config_hash' not in checkpoint:
+                    raise ValueError(f'The run {run_id} has no checkpoint and can not be resumed!')
+                if checkpoint['finished']:
+                    raise ValueError(f'The run {run_id} is already finished!')
+                scan_type = str(checkpoint['scan_type'])
+                scan_para_list = [int(para) for para in checkpoint['scan_para_list']]
+                ranges = [file[key][:] for key in self.manager.data_keys['scan'][:len(scan_para_list)]]
+                if self.config_hash(scan_type, scan_para_list, ranges) != checkpoint['config_hash']:
+                    raise ValueError(f'The configuration of the scan does not match the checkpoint '
+                                     f'of run {run_id}!')
+                self._ranges[scan_type] = ranges
+                scan_para = [self.para_scan[para] for para in scan_para_list]
+                self.plan = ScanPlan(ranges, scan_para)
+                self.waits = self.plan.settle_times(self.settle_models, self.sleep)
+                dataset = file[self.manager.data_keys['meas']]
+                self.data = dataset[:] if self.window is None else ScanStore(dataset, self.window, self.writer)
+                self._raw = self.raw_dataset(file) if self.raw_dtype is not None else None
+                self._checkpoint = checkpoint
+                start = int(checkpoint['last_index']) + 1
+                self._pyramid = self.manager.create_pyramid(file, dataset, self.store)
+                if self._pyramid is not None:
+                    self._pyramid.rebuild(dataset, start)
+                self.manager.start_swmr(file)
+                self.manager.id = run_id
+                try:
+                    self.logger.write(f'Resume the run {run_id} from index {start}\n')
+                    self.logger.event('scan_resume', run_id=run_id, start=start)
+                    position = [start] if len(ranges) == 1 else [0, start]
+                    start_time = self.scan_start(scan_para, ranges, position)
+                    self.scan_action(ranges, scan_para, dataset, start)
+                    end_time = self.scan_end(scan_para)
+                except BaseException as error:
+                    self.scan_abort(error)
+                    raise
+                finally:
+                    self.manager.id = current_id
+        except BaseException as error:
+            self.close_writer(error)
+            raise
+
+    @staticmethod
+    def axis_name(para) -> str:
+        if isinstance(para, Iterable):
+            return '&'.join(element.name for element in para)
+        return para.name
+
+    def scan_start(self, scan_para: list, ranges: list, position: list = None):
+        """
+        :param position: 每个扫描参数的起始序号，默认都从0开始
+        """
         start_time = get_time()
+        position = position if position is not None else [0] * len(scan_para)
         for num, para in enumerate(scan_para):
-            safe(para, ranges[num][0])
-            start_msg = f"Scan {para.name} on {len(scan_para)}d with the result of {self.para_meas[0].name} of which the run id is {self.manager.id} at {start_time}\n"
+            safe(para, ranges[num][position[num]])
+            start_msg = f"Scan {self.axis_name(para)} on {len(scan_para)}d with the result of {self.para_meas[0].name} of which the run id is {self.manager.id} at {start_time}\n"
             self.logger.write(start_msg)
+        self.logger.event('scan_start', run_id=self.manager.id,
+                          axes=[self.axis_name(para) for para in scan_para],
+                          ranges=[[float(np.min(r)), float(np.max(r)), len(r)] for r in ranges[:len(scan_para)]],
+                          measured=[para.name for para in self.para_meas],
+                          position=list(position))
         return start_time
 
-    def scan_action(self, ranges: list, scan_para_list: list, dataset):
-        if len(ranges) == 1:
-            self.scan_action_1d(ranges, scan_para_list, dataset)
-        elif len(ranges) == 2:
-            self.scan_action_2d(ranges, scan_para_list, dataset)
-        else:
-            raise ValueError('The dimension of scan ranges excesses two !')
-
-    def scan_action_1d(self, ranges, scan_para, dataset):
-        with ACQTask(acq_name='art',
-                     acq_channels='Dev1/ai4',
-                     sample_rate=1e4,
-                     memory_size=1000) as daq:
-            for idx, vx in enumerate(ranges[0]):
-                output(scan_para[0], vx)
-                time.sleep(self.sleep)
-                for idz, vz in enumerate(self.para_meas):
-                    raw_data = np.array(daq.read()) / self.scaler
-                    self.data[idz, idx] = np.average(raw_data)
-                    self.manager.progress_bar(current=self.data[idz, idx],
-                                              current_unit=self.current_unit,
-                                              idx=idx,
-                                              idz=idz,
-                                              length=len(ranges[0]))
-
-                dataset[:, idx] = self.data[:, idx]
-
-    def scan_action_2d(self, ranges, scan_para, dataset):
-        with ACQTask(acq_name='art',
-                     acq_channels='Dev1/ai4',
-                     sample_rate=1e4,
-                     memory_size=1000) as daq:
-            for idy, vy in enumerate(ranges[1]):
+    def scan_action(self, ranges: list, scan_para_list: list, dataset, start: int = 0):
+        if self.stream is not None:
+            self.stream.begin(self.manager.id, ranges, [para.name for para in self.para_meas])
+        try:
+            if len(ranges) == 1:
+                self.scan_action_1d(ranges, scan_para_list, dataset, start)
+            elif len(ranges) == 2:
+                self.scan_action_2d(ranges, scan_para_list, dataset, start)
+            else:
+                raise ValueError('The dimension of scan ranges excesses two !')
+        except BaseException:
+            # 文件关闭之前写完队列中的数据，写入失败时只记录，重新抛出的仍是扫描本身的异常
+            if self.writer is not None:
+                try:
+                    self.writer.flush()
+                except Exception as error:
+                    self.logger.write(f'Failed to write the queued data of the run {self.manager.id}: {error!r}\n')
+            raise
+        # 文件关闭之前写完队列中的数据
+        if self.writer is not None:
+            self.writer.flush()
+        if self.stream is not None:
+            self.stream.end()
+
+    def scan_action_1d(self, ranges, scan_para, dataset, start: int = 0):
+        if self.trigger_source is not None:
+            return self.scan_triggered_1d(ranges, dataset, start)
+        reporter = self.reporter
+        reporter.start(self.manager.id, len(ranges[0]) - start)
+        sent = start
+        with self.acq_task() as daq:
+            for idx in range(start, len(ranges[0])):
+                t0 = time.perf_counter()
+                self.plan.apply(idx)
+                time.sleep(self.waits[idx])
+                t1 = time.perf_counter()
+                block = daq.read_block()
+                self.data[:, idx] = self.reduce(block)
+                t2 = time.perf_counter()
+                self.store(dataset, (slice(None), idx), self.data[:, idx])
+                if self._raw is not None:
+                    self.store_raw((slice(None), slice(None), idx), self.raw_samples(block))
+                self.update_checkpoint(dataset, idx)
+                t3 = time.perf_counter()
+                reporter.add_time('settle', t1 - t0)
+                reporter.add_time('acquire', t2 - t1)
+                reporter.add_time('write', t3 - t2)
+                reporter.update(idx + 1 - start,
+                                current=self.data[0, idx] * self.scaler,
+                                unit=self.current_unit,
+                                idx=idx)
+                if self.stream is not None and (self.stream.due() or idx == len(ranges[0]) - 1):
+                    self.stream.block(sent, self.data[:, sent:idx + 1])
+                    sent = idx + 1
+        reporter.finish()
+
+    def scan_action_2d(self, ranges, scan_para, dataset, start: int = 0):
+        if self.trigger_source is not None:
+            return self.scan_triggered_2d(ranges, scan_para, dataset, start)
+        reporter = self.reporter
+        reporter.start(self.manager.id, len(ranges[0]) * (len(ranges[1]) - start))
+        with self.acq_task() as daq:
+            for idy in range(start, len(ranges[1])):
+                t0 = time.perf_counter()
+                safe(scan_para[0], ranges[0][0])
+                reporter.add_time('settle', time.perf_counter() - t0)
+                for idx in range(len(ranges[0])):
+                    t0 = time.perf_counter()
+                    self.plan.apply(idy * len(ranges[0]) + idx)
+                    time.sleep(self.waits[idy * len(ranges[0]) + idx])
+                    t1 = time.perf_counter()
+                    block = daq.read_block()
+                    self.data[:, idx, idy] = self.reduce(block)
+                    if self._raw is not None:
+                        self._raw_row[:, :, idx] = self.raw_samples(block)
+                    reporter.add_time('settle', t1 - t0)
+                    reporter.add_time('acquire', time.perf_counter() - t1)
+                    reporter.update((idy - start) * len(ranges[0]) + idx + 1,
+                                    current=self.data[0, idx, idy] * self.scaler,
+                                    unit=self.current_unit,
+                                    idy=idy,
+                                    idx=idx)
+                t2 = time.perf_counter()
+                self.store(dataset, (slice(None), slice(None), idy), self.data[:, :, idy])
+                self.store_raw((slice(None), slice(None), slice(None), idy), self._raw_row)
+                if self._pyramid is not None:
+                    self._pyramid.add_row(idy, self.data[:, :, idy])
+                self.update_checkpoint(dataset, idy)
+                if self.stream is not None:
+                    self.stream.block(idy, self.data[:, :, idy:idy + 1])
+                reporter.add_time('write', time.perf_counter() - t2)
+        reporter.finish()
+
+    def scan_triggered_1d(self, ranges, dataset, start: int = 0):
+        reporter = self.reporter
+        reporter.start(self.manager.id, len(ranges[0]) - start)
+        with self.acq_task() as daq, self.trigger_task() as trigger:
+            for begin in range(start, len(ranges[0]), self.trigger_batch):
+                end = min(begin + self.trigger_batch, len(ranges[0]))
+                t0 = time.perf_counter()
+                blocks, acquire = self.trigger_points(daq, trigger, range(begin, end))
+                t1 = time.perf_counter()
+                self.data[:, begin:end] = self.reduce_points(blocks)
+                t2 = time.perf_counter()
+                self.store(dataset, (slice(None), slice(begin, end)), self.data[:, begin:end])
+                if self._raw is not None:
+                    self.store_raw((slice(None), slice(None), slice(begin, end)), self.raw_samples(blocks))
+                self.update_checkpoint(dataset, end - 1)
+                reporter.add_time('settle', t1 - t0 - acquire)
+                reporter.add_time('acquire', t2 - t1 + acquire)
+                reporter.add_time('write', time.perf_counter() - t2)
+                reporter.update(end - start,
+                                current=self.data[0, end - 1] * self.scaler,
+                                unit=self.current_unit,
+                                idx=end - 1)
+                if self.stream is not None:
+                    self.stream.block(begin, self.data[:, begin:end])
+        reporter.finish()
+
+    def scan_triggered_2d(self, ranges, scan_para, dataset, start: int = 0):
+        reporter = self.reporter
+        reporter.start(self.manager.id, len(ranges[0]) * (len(ranges[1]) - start))
+        nx = len(ranges[0])
+        with self.acq_task() as daq, self.trigger_task() as trigger:
+            for idy in range(start, len(ranges[1])):
+                t0 = time.perf_counter()
                 safe(scan_para[0], ranges[0][0])
-                output(scan_para[1], vy)
-                for idx, vx in enumerate(ranges[0]):
-                    output(scan_para[0], vx)
-                    time.sleep(self.sleep)
-                    for idz, vz in enumerate(self.para_meas):
-                        raw_data = np.array(daq.read()) / self.scaler
-                        self.data[idz, idx, idy] = np.average(raw_data)
-                        self.manager.progress_bar(current=self.data[idz, idx, idy],
-                                                  current_unit=self.current_unit,
-                                                  idy=idy,
-                                                  idx=idx,
-                                                  idz=idz,
-                                                  length=len(ranges[0]))
-
-                dataset[:, :, idy] = self.data[:, :, idy]
+                blocks, acquire = self.trigger_points(daq, trigger, range(idy * nx, (idy + 1) * nx))
+                t1 = time.perf_counter()
+                self.data[:, :, idy] = self.reduce_points(blocks)
+                t2 = time.perf_counter()
+                self.store(dataset, (slice(None), slice(None), idy), self.data[:, :, idy])
+                if self._raw is not None:
+                    self.store_raw((slice(None), slice(None), slice(None), idy), self.raw_samples(blocks))
+                if self._pyramid is not None:
+                    self._pyramid.add_row(idy, self.data[:, :, idy])
+                self.update_checkpoint(dataset, idy)
+                if self.stream is not None:
+                    self.stream.block(idy, self.data[:, :, idy:idy + 1])
+                reporter.add_time('settle', t1 - t0 - acquire)
+                reporter.add_time('acquire', t2 - t1 + acquire)
+                reporter.add_time('write', time.perf_counter() - t2)
+                reporter.update((idy + 1 - start) * nx,
+                                current=self.data[0, -1, idy] * self.scaler,
+                                unit=self.current_unit,
+                                idy=idy)
+        reporter.finish()
 
     def scan_end(self, scan_para: list):
         end_time = get_time()
         for num, para in enumerate(scan_para):
             safe(para, 0)
-            end_msg = f'Scan {para.name} stops at {end_time}\n' + '-' * 20 + "\n"
+            end_msg = f'Scan {self.axis_name(para)} stops at {end_time}\n' + '-' * 20 + "\n"
             self.logger.write(end_msg)
+        self.logger.event('scan_end', run_id=self.manager.id, axes=[self.axis_name(para) for para in scan_para])
+        if self._checkpoint is not None:
+            self._checkpoint['finished'] = True
+            self._checkpoint = None
+        self.manager.finish_run()
         self.manager.save_cache(self.data)
+        self.close_writer()
         return end_time
 
+    def scan_abort(self, error: BaseException):
+        """
+        扫描出错或者被中断时记录run的状态，之后由调用者重新抛出异常。
+        断点没有标记为finished，run仍然可以用resume继续
+        :param error: 中断扫描的异常，KeyboardInterrupt记为'aborted'，其他异常记为'failed'
+        :return: None
+        """
+        status = 'aborted' if isinstance(error, KeyboardInterrupt) else 'failed'
+        self._checkpoint = None
+        try:
+            self.logger.write(f'Scan with the run id {self.manager.id} {status} at {get_time()}: {error!r}\n'
+                              + '-' * 20 + '\n')
+            self.logger.event('scan_' + status, run_id=self.manager.id, error=repr(error))
+        finally:
+            self.manager.finish_run(status)
+            self.close_writer(error)
+
+    def open_writer(self):
+        """保存原始数据而没有传入writer时，为这次扫描创建AsyncWriter"""
+        if self._own_writer and self.writer is None:
+            self.writer = AsyncWriter()
+
+    def close_writer(self, error: BaseException = None):
+        """
+        关闭open_writer创建的AsyncWriter，传入的writer由调用者管理
+        :param error: 扫描中断的异常，此时写入失败只记录，不覆盖该异常
+        :return: None
+        """
+        if not self._own_writer or self.writer is None:
+            return
+        writer, self.writer = self.writer, None
+        try:
+            writer.close()
+        except Exception as close_error:
+            if error is None:
+                raise
+            self.logger.write(f'Failed to close the writer of the run {self.manager.id}: {close_error!r}\n')
+
     def scan_2d(self, scan_x: int, scan_y: int):
 
         range_2d, scan_xy_para, data_file = self.scan_prepare(scan_type='scan_2d', scan_para_list=[scan_x, scan_y])
 
-        with h5py.File(data_file, 'a') as file:
-            dataset = self.scan_dataset(file, range_2d)
+        try:
+            with self.manager.open_file(data_file) as file:
+                dataset = self.scan_dataset(file, range_2d)
+
+                self.scan_checkpoint(file, scan_type='scan_2d', scan_para_list=[scan_x, scan_y])
 
-            start_time = self.scan_start(scan_xy_para, range_2d)
+                start_time = self.scan_start(scan_xy_para, range_2d)
 
-            self.scan_action(range_2d, scan_xy_para, dataset)
+                self.scan_action(range_2d, scan_xy_para, dataset)
 
-            end_time = self.scan_end(scan_xy_para)
+                end_time = self.scan_end(scan_xy_para)
+        except BaseException as error:
+            self.scan_abort(error)
+            raise
+
+    def scan_repeat(self, scan_para_list: list, repeats: int, target_sem: float = None,
+                    min_repeats: int = 3, store_repeats: bool = False) -> int:
+        """
+        重复同一个1d或2d扫描并求平均，所有重复写入同一个run。
+        用Welford算法在预先分配好的数组中逐点更新平均值和方差，
+        meas/measurement保存平均值，meas/variance保存样本方差。
+        run目录中登记为'repeat_1d'或'repeat_2d'，设置(role='setting')包括repeats、min_repeats、target_sem
+        以及每次重复之后更新的completed。
+        :param scan_para_list: 扫描参数在para_scan中的序号，长度为1时为1d扫描，为2时为2d扫描
+        :param repeats: 最多重复的次数
+        :param target_sem: 所有点的标准误差都小于该值(单位与data相同)时提前结束，默认不提前结束
+        :param min_repeats: 提前结束前至少重复的次数
+        :param store_repeats: 是否在meas/repeats中保存每一次的数据
+        :return: 实际重复的次数
+        """
+        scan_type = {1: 'scan_1d', 2: 'scan_2d'}[len(scan_para_list)]
+        settings = {'repeats': repeats, 'min_repeats': min_repeats}
+        if target_sem is not None:
+            settings['target_sem'] = target_sem
+        ranges, scan_para, data_file = self.scan_prepare(scan_type=scan_type, scan_para_list=scan_para_list,
+                                                         run_type=scan_type.replace('scan', 'repeat'),
+                                                         settings=settings)
+        mean = np.zeros(self.data.shape)
+        m2 = np.zeros(self.data.shape)
+        count = 0
+        try:
+            with self.manager.open_file(data_file) as file:
+                dataset = self.scan_dataset(file, ranges)
+                # Welford算法需要每次重复的完整数据，因此重复模式下数据总是保存在内存中
+                self.data = np.zeros(self.data.shape, dtype=self.dtype)
+                variance = self.manager.create_dataset(file, self.manager.data_keys['variance'], self.data.shape,
+                                                       self.dtype)
+                view = RepeatSlice(self.manager.create_dataset(file, self.manager.data_keys['repeats'],
+                                                               (repeats,) + self.data.shape, self.dtype)
+                                   if store_repeats else None)
+                dataset.attrs['repeats'] = 0
+                # 金字塔由每次重复之后的平均值重新生成
+                pyramid, self._pyramid = self._pyramid, None
+                self.manager.start_swmr(file)
+                for repeat in range(repeats):
+                    view.repeat = repeat
+                    start_time = self.scan_start(scan_para, ranges)
+                    self.scan_action(ranges, scan_para, view)
+                    count += 1
+                    delta = self.data - mean
+                    mean += delta / count
+                    m2 += delta * (self.data - mean)
+                    dataset[...] = mean
+                    if pyramid is not None:
+                        pyramid.rebuild(mean, mean.shape[-1])
+                    if count > 1:
+                        variance[...] = m2 / (count - 1)
+                    dataset.attrs['repeats'] = count
+                    self.manager.update_settings({'completed': count})
+                    file.flush()
+                    if target_sem is not None and count >= max(min_repeats, 2):
+                        sem = np.sqrt(m2 / (count - 1) / count)
+                        if np.max(sem) <= target_sem:
+                            self.logger.write(f'Stop repeating after {count} repeats with the maximum standard error '
+                                              f'{np.max(sem):.4g}\n')
+                            break
+                self.data = mean
+                end_time = self.scan_end(scan_para)
+        except BaseException as error:
+            self.scan_abort(error)
+            raise
+        return count
 
 
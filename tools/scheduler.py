@@ -0,0 +1,264 @@
+import json
+import os
+import threading
+import time
+import traceback
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from tools.constants import get_time
+
+
+class ScanJob:
+    """
+    队列中的一个任务：调用已注册对象(通常是Scan)的某个方法，例如scan_2d(0, 1)。
+    任务本身只保存名字、参数以及提交时对象的扫描设置(扫描范围等，见Scan.scan_spec)，因此可以写入json文件，
+    程序重启后重新注册对象即可继续执行。
+    """
+    fields = ('job_id', 'target', 'method', 'args', 'kwargs', 'spec', 'priority', 'depends_on', 'resources',
+              'status', 'error', 'submitted', 'started', 'finished')
+
+    def __init__(self, job_id: int, target: str, method: str, args: list = None, kwargs: dict = None,
+                 spec: dict = None, priority: int = 0, depends_on: list = None, resources: list = None,
+                 status: str = 'pending', error: str = None, submitted: float = None, started: float = None,
+                 finished: float = None):
+        self.job_id = job_id
+        self.target = target
+        self.method = method
+        self.args = list(args) if args is not None else []
+        self.kwargs = dict(kwargs) if kwargs is not None else {}
+        self.spec = spec
+        self.priority = priority
+        self.depends_on = list(depends_on) if depends_on is not None else []
+        self.resources = list(resources) if resources is not None else []
+        self.status = status
+        self.error = error
+        self.submitted = submitted if submitted is not None else time.time()
+        self.started = started
+        self.finished = finished
+
+    def __repr__(self):
+        return f'ScanJob({self.job_id}: {self.target}.{self.method}{tuple(self.args)} {self.status})'
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in self.fields}
+
+
+class ScanQueue:
+    """
+    扫描任务队列：按优先级和依赖关系依次执行任务，单个任务出错不会影响其他任务(依赖它的任务会被跳过)。
+    max_workers为1时任务在调用run()的线程中依次执行，Ctrl+C可以中断当前任务；
+    max_workers大于1时，占用资源(仪器)互不相交、并且不共用同一个DataManager的任务可以同时执行。
+    队列在每次状态变化后写入json文件，程序重启后用同一个路径创建ScanQueue即可恢复；
+    被中断或者重启时仍处于running状态的任务记为aborted，依赖它的任务会被跳过。
+    """
+
+    def __init__(self, path: str, logger=None, max_workers: int = 1):
+        """
+        :param path: 保存队列的json文件路径
+        :param logger: tools.logger.Logger，用于记录任务的开始、结束和错误
+        :param max_workers: 最多同时执行的任务数，为1时在调用run()的线程中执行
+        """
+        self.path = path
+        self.logger = logger
+        self.max_workers = max_workers
+        self.targets = {}
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def register(self, name: str, target):
+        """
+        注册可以被任务调用的对象
+        :param name: 对象的名字，任务中以该名字引用对象
+        :param target: 对象，例如Scan
+        :return: None
+        """
+        self.targets[name] = target
+
+    def submit(self, target: str, method: str, *args, priority: int = 0, depends_on: list = None,
+               resources: list = None, **kwargs) -> int:
+        """
+        :param target: 已注册对象的名字
+        :param method: 需要调用的方法名，例如'scan_2d'
+        :param args: 方法的参数
+        :param priority: 优先级，数值越大越先执行
+        :param depends_on: 依赖的任务id，这些任务全部完成后才会执行
+        :param resources: 任务占用的资源，默认根据对象的扫描参数和采集通道推断
+        :param kwargs: 方法的关键字参数
+        :return: 任务id
+        """
+        if target not in self.targets:
+            raise KeyError(f'{target} is not registered!')
+        # 提交时记录扫描范围等设置，执行前恢复，之后修改对象的设置不会影响已经提交的任务
+        scan_spec = getattr(self.targets[target], 'scan_spec', None)
+        with self._lock:
+            job_id = max(self.jobs, default=-1) + 1
+            job = ScanJob(job_id, target, method, args, kwargs, scan_spec() if scan_spec is not None else None,
+                          priority, depends_on,
+                          resources if resources is not None else self.resources(self.targets[target]))
+            # 参数无法保存为json时直接报错，不把任务加入队列
+            json.dumps(job.to_dict())
+            self.jobs[job_id] = job
+            try:
+                self.save()
+            except Exception:
+                del self.jobs[job_id]
+                raise
+        return job_id
+
+    def cancel(self, job_id: int):
+        with self._lock:
+            if self.jobs[job_id].status == 'pending':
+                self.jobs[job_id].status = 'cancelled'
+                self.save()
+
+    @staticmethod
+    def resources(target) -> list:
+        """
+        推断对象占用的资源：扫描参数所属仪器的名字以及采集卡名字。
+        共用DataManager(当前run id)的任务在run()中另外判断，不作为资源保存
+        """
+        resources = set()
+        parameters = list(getattr(target, 'para_scan', ())) + list(getattr(target, 'para_meas', ()))
+        for para in parameters:
+            for element in (para if isinstance(para, Iterable) else (para,)):
+                instrument = getattr(element, 'root_instrument', None)
+                resources.add(instrument.name if instrument is not None else element.name)
+        for channel in getattr(target, 'acq_channels', ()):
+            resources.add(channel.split('/')[0])
+        return sorted(resources)
+
+    def ready(self, running_resources: set) -> list:
+        """
+        :param running_resources: 正在执行的任务占用的资源
+        :return: 可以立即执行的任务，按优先级排序
+        """
+        ready = []
+        for job in self.jobs.values():
+            if job.status != 'pending':
+                continue
+            states = [self.jobs[dep].status if dep in self.jobs else 'failed' for dep in job.depends_on]
+            if any(state in ('failed', 'aborted', 'skipped', 'cancelled') for state in states):
+                job.status = 'skipped'
+                self.save()
+                continue
+            if all(state == 'done' for state in states) and not running_resources & set(job.resources):
+                ready.append(job)
+        return sorted(ready, key=lambda job: (-job.priority, job.job_id))
+
+    def run(self):
+        """
+        执行队列中所有可以执行的任务，直到没有pending的任务为止
+        :return: None
+        """
+        if self.max_workers == 1:
+            while True:
+                with self._lock:
+                    ready = self.ready(set())
+                    if not ready:
+                        break
+                    self.start(ready[0])
+                self.execute(ready[0])
+            return
+        running = {}
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            while True:
+                with self._lock:
+                    busy = set().union(*[self.claims(job) for job in running.values()])
+                    for job in self.ready(busy):
+                        if len(running) >= self.max_workers or busy & self.claims(job):
+                            continue
+                        busy |= self.claims(job)
+                        self.start(job)
+                        running[executor.submit(self.execute, job)] = job
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    del running[future]
+
+    def claims(self, job: ScanJob) -> set:
+        """
+        :return: 任务执行时占用的资源，包括对象的DataManager：它保存当前的run id，同一时间只能有一个run
+        """
+        manager = getattr(self.targets.get(job.target), 'manager', None)
+        return set(job.resources) | ({f'manager:{id(manager)}'} if manager is not None else set())
+
+    def start(self, job: ScanJob):
+        job.status = 'running'
+        job.started = time.time()
+        self.save()
+
+    def execute(self, job: ScanJob):
+        self.write(f'Job {job.job_id} {job.target}.{job.method}{tuple(job.args)} starts at {get_time()}\n')
+        self.event('job_start', job)
+        target = self.targets[job.target]
+        try:
+            if job.spec is not None:
+                target.apply_spec(job.spec)
+            getattr(target, job.method)(*job.args, **job.kwargs)
+        except Exception:
+            status, job.error = 'failed', traceback.format_exc()
+            self.write(f'Job {job.job_id} failed at {get_time()}:\n{job.error}')
+        except BaseException as error:
+            # Ctrl+C：记录任务被中断，之后停止整个队列
+            self.finish(job, 'aborted', repr(error))
+            self.write(f'Job {job.job_id} is aborted at {get_time()}\n')
+            raise
+        else:
+            status = 'done'
+            self.write(f'Job {job.job_id} is done at {get_time()}\n')
+        self.finish(job, status, job.error)
+
+    def finish(self, job: ScanJob, status: str, error: str = None):
+        with self._lock:
+            job.finished = time.time()
+            job.status = status
+            job.error = error
+            self.save()
+        self.event('job_end', job)
+
+    def write(self, msg: str):
+        if self.logger is not None:
+            self.logger.write(msg)
+
+    def event(self, event: str, job: ScanJob):
+        if self.logger is not None:
+            self.logger.event(event, job_id=job.job_id, target=job.target, method=job.method, args=job.args,
+                              status=job.status, duration=job.duration)
+
+    def statistics(self) -> dict:
+        """
+        :return: 每种任务(对象名.方法名)完成的次数以及耗时的平均值、最小值和最大值，单位s
+        """
+        durations = {}
+        for job in self.jobs.values():
+            if job.status == 'done':
+                durations.setdefault(f'{job.target}.{job.method}', []).append(job.duration)
+        return {key: {'count': len(value), 'mean': sum(value) / len(value), 'min': min(value), 'max': max(value)}
+                for key, value in durations.items()}
+
+    def save(self):
+        temp = self.path + '.tmp'
+        text = json.dumps([job.to_dict() for job in self.jobs.values()], indent=1)
+        with open(temp, 'w') as file:
+            file.write(text)
+        os.replace(temp, self.path)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as file:
+            for item in json.load(file):
+                job = ScanJob(**item)
+                if job.status == 'running':
+                    # 上次运行时被中断，run的数据不完整，需要时重新提交或者用Scan.resume继续
+                    job.status = 'aborted'
+                    job.error = 'interrupted'
+                self.jobs[job.job_id] = job
@@ -0,0 +1,127 @@
+import json
+import time
+import numpy as np
+from instruments.meta_instruments import ACQTask
+
+
+class SettleModel:
+    """
+    单个栅极的稳定时间模型，假设响应为指数弛豫：
+    步长为step时，剩余偏差|step| * exp(-(t - dead_time) / tau)小于tolerance所需的时间为
+    wait = dead_time + tau * ln(|step| / tolerance)，步长小于tolerance时只等待dead_time。
+    """
+
+    def __init__(self, tau: float, dead_time: float = 0., tolerance: float = 1e-5, max_wait: float = None):
+        """
+        :param tau: 弛豫时间常数，单位s
+        :param dead_time: 设置之后到响应开始变化的延迟，单位s
+        :param tolerance: 允许的剩余偏差，单位与参数相同(例如V)
+        :param max_wait: 等待时间的上限，单位s
+        """
+        self.tau = tau
+        self.dead_time = dead_time
+        self.tolerance = tolerance
+        self.max_wait = max_wait
+
+    def __repr__(self):
+        return f'SettleModel(tau={self.tau:.3g} s, dead_time={self.dead_time:.3g} s, tolerance={self.tolerance:.3g})'
+
+    def wait(self, step):
+        """
+        :param step: 步长，可以是数组
+        :return: 需要等待的时间，单位s
+        """
+        step = np.abs(np.asarray(step, dtype=float))
+        wait = self.dead_time + self.tau * np.log(np.maximum(step, self.tolerance) / self.tolerance)
+        return np.minimum(wait, self.max_wait) if self.max_wait is not None else wait
+
+    def to_dict(self) -> dict:
+        return {'tau': self.tau, 'dead_time': self.dead_time, 'tolerance': self.tolerance, 'max_wait': self.max_wait}
+
+
+def fit_settling(trace: np.ndarray, baseline: float, sample_rate: float, low: float = 0.05, high: float = 0.9):
+    """
+    从阶跃响应中拟合弛豫时间常数
+    :param trace: 阶跃之后采集的响应
+    :param baseline: 阶跃之前的响应
+    :param sample_rate: 采样率
+    :param low: 参与拟合的归一化剩余偏差的下限，更小的部分被噪声淹没
+    :param high: 参与拟合的归一化剩余偏差的上限
+    :return: (tau, dead_time)
+    """
+    final = np.mean(trace[-max(len(trace) // 5, 1):])
+    if final == baseline:
+        raise ValueError('The sensor does not respond to the step!')
+    residual = (final - trace) / (final - baseline)
+    t = np.arange(len(trace)) / sample_rate
+    mask = (residual > low) & (residual < high)
+    if mask.sum() < 3:
+        raise ValueError('Too few samples on the settling edge, use a higher sample rate!')
+    slope, intercept = np.polyfit(t[mask], np.log(residual[mask]), 1)
+    if slope >= 0:
+        raise ValueError('The response does not settle within the acquisition!')
+    tau = -1 / slope
+    return tau, max(intercept * tau, 0.)
+
+
+def calibrate_settling(parameter,
+                       acq_channel: str,
+                       step: float = 0.01,
+                       sample_rate: float = 1e5,
+                       duration: float = 0.05,
+                       repeats: int = 3,
+                       tolerance: float = 1e-5) -> SettleModel:
+    """
+    对一个栅极做阶跃，高速采集传感器的响应并拟合稳定时间模型。
+    采集在第一次阶跃之前开始并一直连续进行：每次阶跃前读取一段作为基线，读取结束后立即设置参数，
+    再读取一段作为响应，拟合的时间从发出设置指令的时刻开始计算，因此不会漏掉设置之后的瞬态。
+    交替向上和向下阶跃。
+    :param parameter: 需要标定的栅极参数
+    :param acq_channel: 传感器对应的采集通道
+    :param step: 阶跃的大小
+    :param sample_rate: 采样率
+    :param duration: 每次阶跃前后各采集的时长，需要明显长于稳定时间
+    :param repeats: 阶跃的次数，取各次拟合结果的中位数
+    :param tolerance: 生成的SettleModel的tolerance
+    :return: SettleModel
+    """
+    start = parameter()
+    memory_size = int(duration * sample_rate)
+    taus, dead_times = [], []
+    try:
+        with ACQTask(acq_name='art', acq_channels=acq_channel, sample_rate=sample_rate,
+                     memory_size=memory_size) as daq:
+            for num in range(repeats):
+                # 读取返回时缓冲区中已经没有更早的数据，下一段的第一个采样点即为此刻之后的采样
+                baseline = np.mean(daq.read_block()[0])
+                read_end = time.perf_counter()
+                # 阶跃的时刻取发出设置指令之前：仪器可能在指令返回之前就已经改变输出，
+                # 指令本身的耗时计入dead_time，拟合不会漏掉阶跃开始的一段
+                edge = int(round((time.perf_counter() - read_end) * sample_rate))
+                parameter(start + step if num % 2 == 0 else start)
+                set_end = int(round((time.perf_counter() - read_end) * sample_rate))
+                trace = daq.read_block()[0]
+                if set_end >= memory_size // 2:
+                    raise RuntimeError(f'Setting {parameter.name} took longer than half of the acquisition, '
+                                       f'use a longer duration!')
+                tau, dead_time = fit_settling(trace[edge:], baseline, sample_rate)
+                taus.append(tau)
+                dead_times.append(dead_time)
+    finally:
+        parameter(start)
+    return SettleModel(float(np.median(taus)), float(np.median(dead_times)), tolerance)
+
+
+def save_models(path: str, models: dict):
+    """
+    :param path: json文件路径
+    :param models: key为参数名，value为SettleModel
+    :return: None
+    """
+    with open(path, 'w') as file:
+        json.dump({name: model.to_dict() for name, model in models.items()}, file, indent=1)
+
+
+def load_models(path: str) -> dict:
+    with open(path) as file:
+        return {name: SettleModel(**value) for name, value in json.load(file).items()}
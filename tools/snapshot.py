@@ -0,0 +1,288 @@
+import hashlib
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+class StationSnapshot:
+    """
+    station中参数的一次读取结果，key为station.components中的名字。
+    数值型参数保存为float(数组保存为ndarray)，其他类型保存为字符串，读取失败的参数记录在errors中。
+    """
+
+    def __init__(self, values: dict, units: dict = None, errors: dict = None, timestamp: float = None,
+                 duration: float = 0.):
+        """
+        :param values: 参数的数值
+        :param units: 参数的单位
+        :param errors: 读取失败的参数以及错误信息
+        :param timestamp: 读取的时间，time.time()格式
+        :param duration: 读取所用的时间，单位s
+        """
+        self.values = values
+        self.units = units if units is not None else {}
+        self.errors = errors if errors is not None else {}
+        self.time = timestamp if timestamp is not None else time.time()
+        self.duration = duration
+
+    def __repr__(self):
+        return f'StationSnapshot({len(self.values)} parameters, {len(self.errors)} errors, {self.duration * 1e3:.1f} ms)'
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def __contains__(self, name):
+        return name in self.values
+
+    @property
+    def digest(self) -> str:
+        """数值的sha1摘要，数值相同的快照摘要相同"""
+        return hashlib.sha1(json.dumps(self.values, sort_keys=True, default=jsonable).encode()).hexdigest()
+
+    def numeric(self) -> dict:
+        """
+        :return: 数值型标量参数，用于RunCatalog
+        """
+        return {name: value for name, value in self.values.items()
+                if isinstance(value, float) and not np.isnan(value)}
+
+    def diff(self, previous) -> (dict, list):
+        """
+        :param previous: 上一个StationSnapshot
+        :return: (数值有变化或新增的参数, 不再存在的参数名)
+        """
+        changed = {name: value for name, value in self.values.items()
+                   if name not in previous.values or not same(value, previous.values[name])}
+        removed = [name for name in previous.values if name not in self.values]
+        return changed, removed
+
+
+def same(a, b) -> bool:
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        a, b = np.asarray(a), np.asarray(b)
+        if a.shape != b.shape or a.dtype.kind != b.dtype.kind:
+            return False
+        if a.dtype.kind in 'fc':
+            return bool(np.array_equal(a, b, equal_nan=True))
+        return bool(np.array_equal(a, b))
+    if isinstance(a, float) and isinstance(b, float) and np.isnan(a) and np.isnan(b):
+        return True
+    return type(a) is type(b) and a == b
+
+
+def jsonable(value):
+    return value.tolist() if isinstance(value, np.ndarray) else str(value)
+
+
+def normalize(value):
+    """把读取的数值转换为可以保存为hdf5属性的类型"""
+    if isinstance(value, np.ndarray):
+        return value.astype(float) if value.dtype.kind in 'biuf' else str(value.tolist())
+    if isinstance(value, (bool, np.bool_)):
+        return str(bool(value))
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return float(value)
+    return str(value)
+
+
+def station_parameters(station, settable_only: bool = True) -> dict:
+    """
+    :param station: qcodes Station
+    :param settable_only: 是否只包括可以设置的参数，测量参数(例如电流)每次读取都不同，也可能很慢
+    :return: key为station.components中的名字，value为参数，不是参数的component(例如仪器)不包括在内
+    """
+    parameters = {}
+    for name, component in station.components.items():
+        if not callable(getattr(component, 'get', None)) or not hasattr(component, 'unit'):
+            continue
+        if settable_only and not getattr(component, 'settable', True):
+            continue
+        parameters[name] = component
+    return parameters
+
+
+def read_station(station, update: bool = True, settable_only: bool = True, workers: int = 8) -> StationSnapshot:
+    """
+    读取station中所有参数：不同仪器的参数在不同线程中同时读取，同一台仪器的参数依次读取，
+    支持批量查询的仪器(例如SP1060的'ALL V?')用一次查询读取所有通道
+    :param station: qcodes Station
+    :param update: 是否从仪器读取，False时只使用参数的缓存，不与仪器通信
+    :param settable_only: 是否只包括可以设置的参数
+    :param workers: 最多同时读取的仪器数
+    :return: StationSnapshot
+    """
+    start = time.perf_counter()
+    parameters = station_parameters(station, settable_only)
+    groups = {}
+    for name, parameter in parameters.items():
+        instrument = getattr(parameter, 'root_instrument', None)
+        # 不属于仪器的参数各自为一组
+        groups.setdefault(id(instrument) if instrument is not None else id(parameter),
+                          (instrument, {}))[1][name] = parameter
+    values, errors = {}, {}
+    if update and len(groups) > 1:
+        with ThreadPoolExecutor(min(len(groups), max(workers, 1))) as executor:
+            results = list(executor.map(lambda group: read_instrument(*group, update), groups.values()))
+    else:
+        results = [read_instrument(instrument, group, update) for instrument, group in groups.values()]
+    for group_values, group_errors in results:
+        values.update(group_values)
+        errors.update(group_errors)
+    units = {name: parameters[name].unit for name in values}
+    return StationSnapshot(values, units, errors, duration=time.perf_counter() - start)
+
+
+def read_instrument(instrument, parameters: dict, update: bool = True) -> (dict, dict):
+    """
+    :param instrument: 参数所属的仪器，可以为None
+    :param parameters: key为名字，value为参数
+    :param update: 是否从仪器读取
+    :return: (数值, 读取失败的参数以及错误信息)
+    """
+    values, errors = {}, {}
+    if update and instrument is not None:
+        try:
+            values.update(bulk_read(instrument, parameters))
+        except Exception as error:
+            # 批量查询失败时逐个读取
+            errors['bulk:' + instrument.name] = repr(error)
+    for name, parameter in parameters.items():
+        if name in values:
+            continue
+        try:
+            value = parameter() if update else parameter.cache.get(get_if_invalid=False)
+        except Exception as error:
+            errors[name] = repr(error)
+            continue
+        if value is not None:
+            values[name] = normalize(value)
+    return values, errors
+
+
+def bulk_read(instrument, parameters: dict) -> dict:
+    """
+    用一次批量查询读取同一台仪器的多个参数，目前支持SP1060的通道电压('ALL V?')，
+    读取的数值同时更新参数的缓存
+    :param instrument: 仪器
+    :param parameters: key为名字，value为参数
+    :return: 批量读取的参数，不支持的参数不包括在内
+    """
+    if not hasattr(instrument, 'get_all_val'):
+        return {}
+    channels = {name: parameter for name, parameter in parameters.items()
+                if parameter.name == 'voltage' and isinstance(getattr(parameter.instrument, 'channel', None), int)}
+    if not channels:
+        return {}
+    voltages = instrument.get_all_val()
+    values = {}
+    for name, parameter in channels.items():
+        voltage = float(voltages[parameter.instrument.channel - 1])
+        parameter.cache.set(voltage)
+        values[name] = voltage
+    return values
+
+
+class SnapshotStore:
+    """
+    在run文件的snapshot组中保存快照：snapshot/values和snapshot/units的属性保存参数的数值和单位，
+    snapshot组的属性记录base(差异所基于的run id，完整快照为-1)、removed、errors、time等。
+    每个日期的第一个run以及之后每隔full_every个run保存完整快照，其余run只保存与上一个run相比有变化的参数，
+    读取时由load_snapshot沿base向前合并。
+    """
+    key = 'snapshot'
+
+    def __init__(self, full_every: int = 50):
+        """
+        :param full_every: 两个完整快照之间最多的差异快照数
+        """
+        self.full_every = full_every
+        self.previous = None
+        self.previous_id = None
+        self.count = 0
+
+    def reset(self):
+        """下一个run保存完整快照，例如日期改变之后"""
+        self.previous = None
+        self.previous_id = None
+        self.count = 0
+
+    def save(self, file, snapshot: StationSnapshot, run_id: int):
+        """
+        :param file: 打开的run文件，需要在开始SWMR之前调用
+        :param snapshot: 当前run的快照
+        :param run_id: 当前run id
+        :return: None
+        """
+        full = self.previous is None or self.previous_id == run_id or self.count >= self.full_every
+        changed, removed = (snapshot.values, []) if full else snapshot.diff(self.previous)
+        if self.key in file:
+            del file[self.key]
+        group = file.create_group(self.key)
+        group.attrs['base'] = -1 if full else self.previous_id
+        group.attrs['removed'] = json.dumps(removed)
+        group.attrs['errors'] = json.dumps(snapshot.errors)
+        group.attrs['digest'] = snapshot.digest
+        group.attrs['time'] = snapshot.time
+        group.attrs['duration'] = snapshot.duration
+        values, units = group.create_group('values'), group.create_group('units')
+        for name, value in changed.items():
+            values.attrs[name] = value
+            units.attrs[name] = snapshot.units.get(name, '')
+        self.previous, self.previous_id = snapshot, run_id
+        self.count = 0 if full else self.count + 1
+
+
+def read_record(file) -> dict:
+    """
+    :param file: 打开的run文件或者归档中run对应的组
+    :return: snapshot组中保存的内容
+    """
+    group = file[SnapshotStore.key]
+    return {'base': int(group.attrs['base']),
+            'values': {name: decode(value) for name, value in group['values'].attrs.items()},
+            'units': {name: decode(value) for name, value in group['units'].attrs.items()},
+            'removed': json.loads(group.attrs['removed']),
+            'errors': json.loads(group.attrs['errors']),
+            'time': float(group.attrs['time']),
+            'duration': float(group.attrs['duration'])}
+
+
+def decode(value):
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, np.floating):
+        return float(value)
+    return value
+
+
+def load_snapshot(open_run, run_id: int, max_depth: int = 10000) -> StationSnapshot:
+    """
+    读取一个run的完整快照：从该run开始沿base找到完整快照，再依次合并之后的差异
+    :param open_run: open_run(run_id)以只读方式打开run，返回文件或者组，例如DataManager.locate_run
+    :param run_id: run id
+    :param max_depth: 最多向前查找的run数
+    :return: StationSnapshot
+    """
+    records = []
+    while True:
+        group = open_run(run_id)
+        with group.file:
+            if SnapshotStore.key not in group:
+                raise ValueError(f'The run {run_id} has no snapshot!')
+            record = read_record(group)
+        records.append(record)
+        if record['base'] < 0:
+            break
+        if len(records) >= max_depth:
+            raise ValueError(f'The snapshot chain of the run {run_id} is too long!')
+        run_id = record['base']
+    values, units = {}, {}
+    for record in reversed(records):
+        for name in record['removed']:
+            values.pop(name, None)
+            units.pop(name, None)
+        values.update(record['values'])
+        units.update(record['units'])
+    last = records[0]
+    return StationSnapshot(values, units, last['errors'], last['time'], last['duration'])
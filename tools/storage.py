@@ -0,0 +1,402 @@
+import os
+from collections import OrderedDict
+import h5py
+import numpy as np
+
+
+class ScanStore:
+    """
+    以hdf5数据集为后端的扫描数据：内存中只保留最近的window个外层切片(1d为x方向的点，2d为y方向的行)，
+    支持与ndarray相同的切片读写。扫描循环每完成一个点或一行都会自己写入数据集，
+    因此移出窗口的切片直接丢弃，读取窗口之外的数据时从数据集(文件关闭后重新打开文件)中读取。
+    """
+
+    def __init__(self, dataset, window: int = 2, writer=None):
+        """
+        :param dataset: 扫描数据对应的hdf5数据集，最后一维为外层维度
+        :param window: 内存中保留的外层切片数
+        :param writer: 后台写入该数据集的AsyncWriter，从数据集读取之前先等待其写完
+        """
+        if window < 1:
+            raise ValueError('The window must hold at least one slice!')
+        self.dataset = dataset
+        self.filename = dataset.file.filename
+        self.key = dataset.name
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+        self.window = window
+        self.writer = writer
+        self._slices = OrderedDict()
+
+    def __repr__(self):
+        return f'ScanStore({self.filename}:{self.key}, shape={self.shape}, window={len(self._slices)}/{self.window})'
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def nbytes(self) -> int:
+        """内存中窗口实际占用的字节数"""
+        return sum(value.nbytes for value in self._slices.values())
+
+    def __len__(self):
+        return self.shape[0]
+
+    def split(self, key):
+        """
+        :return: (除外层维度之外的索引, 外层维度的序号列表, 外层维度是否为整数索引)
+        """
+        key = key if isinstance(key, tuple) else (key,)
+        if Ellipsis in key:
+            pos = key.index(Ellipsis)
+            key = key[:pos] + (slice(None),) * (self.ndim - len(key) + 1) + key[pos + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        outer = key[-1]
+        if isinstance(outer, slice):
+            return key[:-1], list(range(*outer.indices(self.shape[-1]))), False
+        outer = int(outer)
+        if not -self.shape[-1] <= outer < self.shape[-1]:
+            raise IndexError(f'Index {outer} is out of range for the size {self.shape[-1]}!')
+        return key[:-1], [outer % self.shape[-1]], True
+
+    def slice(self, index: int) -> np.ndarray:
+        """取出窗口中的外层切片，不在窗口中时新建一个，并移出最早的切片"""
+        if index in self._slices:
+            self._slices.move_to_end(index)
+        else:
+            self._slices[index] = np.zeros(self.shape[:-1], dtype=self.dtype)
+            while len(self._slices) > self.window:
+                self._slices.popitem(last=False)
+        return self._slices[index]
+
+    def __setitem__(self, key, value):
+        inner, outer, scalar = self.split(key)
+        value = np.asarray(value)
+        for num, index in enumerate(outer):
+            self.slice(index)[inner] = value if scalar else value[..., num]
+
+    def __getitem__(self, key):
+        inner, outer, scalar = self.split(key)
+        if not any(index in self._slices for index in outer):
+            return self.read(key)
+        values = [self._slices[index][inner] if index in self._slices else self.read(inner + (index,))
+                  for index in outer]
+        return values[0] if scalar else np.stack(values, axis=-1)
+
+    def read(self, key):
+        if self.writer is not None and self.dataset.id.valid:
+            self.writer.flush()
+        if self.dataset.id.valid:
+            return self.dataset[key]
+        with h5py.File(self.filename, 'r') as file:
+            return file[self.key][key]
+
+    def __array__(self, dtype=None):
+        data = self.read(Ellipsis)
+        return data if dtype is None else data.astype(dtype)
+
+
+class RunCache:
+    """
+    最近扫描结果的LRU缓存，key为run id，大小按数组的nbytes统计。
+    内存中的数据超过max_bytes时，最久没有使用的结果移到磁盘上的memmap(spill_dir不为None时)或者直接丢弃；
+    memmap层超过spill_bytes时同样按LRU删除。两层都没有命中时由loader从run文件中重新读取。
+    """
+
+    def __init__(self, loader=None, max_bytes: int = 512 * 1024 ** 2, spill_dir: str = None,
+                 spill_bytes: int = 4 * 1024 ** 3):
+        """
+        :param loader: 未命中时调用loader(run_id)读取数据，为None时未命中返回None
+        :param max_bytes: 内存中缓存的字节数上限
+        :param spill_dir: memmap文件的目录，为None时不使用磁盘层
+        :param spill_bytes: 磁盘层的字节数上限
+        """
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_bytes = spill_bytes
+        self._memory = OrderedDict()
+        self._spilled = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return (f'RunCache({len(self._memory)} runs {self.nbytes / 1024 ** 2:.1f} MB in memory, '
+                f'{len(self._spilled)} runs {self.spilled_bytes / 1024 ** 2:.1f} MB spilled)')
+
+    def __contains__(self, run_id):
+        return run_id in self._memory or run_id in self._spilled
+
+    def __len__(self):
+        return len(self._memory) + len(self._spilled)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(data.nbytes for data in self._memory.values())
+
+    @property
+    def spilled_bytes(self) -> int:
+        return sum(data.nbytes for data in self._spilled.values())
+
+    def put(self, run_id, data) -> bool:
+        """
+        :return: 数据是否保存在内存中，超过max_bytes的数据直接进入磁盘层
+        """
+        self.discard(run_id)
+        if data.nbytes > self.max_bytes:
+            self.spill(run_id, data)
+            return False
+        self._memory[run_id] = data
+        while self.nbytes > self.max_bytes:
+            self.spill(*self._memory.popitem(last=False))
+        return True
+
+    def get(self, run_id):
+        """
+        :return: run id对应的数据，内存和磁盘层都没有时由loader读取并放入缓存
+        """
+        if run_id in self._memory:
+            self.hits += 1
+            self._memory.move_to_end(run_id)
+            return self._memory[run_id]
+        if run_id in self._spilled:
+            self.hits += 1
+            data = self._spilled.pop(run_id)
+            if data.nbytes > self.max_bytes:
+                self._spilled[run_id] = data
+                return data
+            self.put(run_id, np.array(data))
+            self.remove_file(data)
+            return self._memory[run_id]
+        self.misses += 1
+        if self.loader is None:
+            return None
+        data = self.loader(run_id)
+        self.put(run_id, data)
+        return data
+
+    def spill(self, run_id, data):
+        if self.spill_dir is None or not isinstance(data, np.ndarray) or data.nbytes > self.spill_bytes:
+            return
+        memmap = np.lib.format.open_memmap(os.path.join(self.spill_dir, f'{run_id}.npy'), mode='w+',
+                                           dtype=data.dtype, shape=data.shape)
+        memmap[...] = data
+        memmap.flush()
+        self._spilled[run_id] = memmap
+        while self.spilled_bytes > self.spill_bytes:
+            self.remove_file(self._spilled.popitem(last=False)[1])
+
+    def discard(self, run_id):
+        self._memory.pop(run_id, None)
+        if run_id in self._spilled:
+            self.remove_file(self._spilled.pop(run_id))
+
+    @staticmethod
+    def remove_file(memmap: np.memmap):
+        filename = memmap.filename
+        del memmap
+        try:
+            os.remove(filename)
+        except OSError:
+            # Windows下仍有其他引用时无法删除，留给spill_dir的清理
+            pass
+
+    def clear(self):
+        for run_id in list(self._spilled):
+            self.discard(run_id)
+        self._memory.clear()
+
+
+class RunView:
+    """
+    已保存run的惰性视图：打开文件但不读取数据，切片时才从磁盘读取需要的部分。
+    连续存储且未压缩的数据集通过数据集在文件中的偏移量映射为np.memmap，其余情况直接使用h5py数据集的切片。
+    """
+
+    def __init__(self, file: h5py.Group, data_keys: dict, memmap: bool = True):
+        """
+        :param file: 以只读方式打开的run文件，或者归档文件中run对应的组，关闭视图时关闭所在的文件
+        :param data_keys: DataManager.data_keys
+        :param memmap: 是否在可能时使用np.memmap
+        """
+        self.file = file.file
+        self.filename = file.file.filename
+        self.axes = [file[key][:] for key in data_keys['scan'] if key in file]
+        self.datasets = {name: file[key] for name, key in data_keys.items()
+                         if isinstance(key, str) and key in file and isinstance(file[key], h5py.Dataset)}
+        self.pyramid = file[data_keys['pyramid']] if data_keys.get('pyramid') in file else None
+        self.data = self.view('meas', memmap)
+
+    def __repr__(self):
+        kind = 'memmap' if isinstance(self.data, np.memmap) else 'h5py'
+        return f'RunView({self.filename}, shape={self.shape}, {kind})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def shape(self) -> tuple:
+        return self.data.shape
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def view(self, name: str, memmap: bool = True):
+        """
+        :param name: data_keys中的名字，例如'meas'、'variance'
+        :param memmap: 是否在可能时使用np.memmap
+        :return: np.memmap或者h5py数据集，两者都只在切片时读取数据
+        """
+        dataset = self.datasets[name]
+        if memmap and dataset.chunks is None and dataset.compression is None:
+            offset = dataset.id.get_offset()
+            if offset is not None:
+                return np.memmap(self.filename, mode='r', dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+        return dataset
+
+    def preview(self, step: int = None, max_points: int = 256) -> np.ndarray:
+        """
+        抽取后的预览，每个扫描维度每隔step个点取一个点
+        :param step: 抽取间隔，默认每个维度分别抽取到不超过max_points个点
+        :param max_points: 每个维度的最大点数
+        :return: ndarray
+        """
+        steps = [step if step is not None else max(int(np.ceil(size / max_points)), 1) for size in self.shape[1:]]
+        return self.data[(slice(None),) + tuple(slice(None, None, num) for num in steps)]
+
+    @property
+    def levels(self) -> int:
+        """金字塔的层数，不包括原始数据(第0层)"""
+        return len(self.pyramid) if self.pyramid is not None else 0
+
+    def level(self, level: int, stat: str = 'mean'):
+        """
+        :param level: 第几层，0为原始数据
+        :param stat: 'mean'、'min'或者'max'
+        :return: 该层的惰性数据集，形状为(测量参数个数, nx / 2^level, ny / 2^level)
+        """
+        if level == 0:
+            return self.data
+        return self.pyramid[f'level{level}'][stat]
+
+    def select_level(self, max_pixels: int) -> int:
+        """
+        :param max_pixels: 屏幕上每个方向的像素数
+        :return: x和y方向的点数都不超过max_pixels的最精细的一层，没有这样的层时返回最粗的一层
+        """
+        for level in range(self.levels + 1):
+            if max(self.level(level).shape[1:]) <= max_pixels:
+                return level
+        return self.levels
+
+    def level_axes(self, level: int) -> list:
+        """
+        :return: 该层每个点对应的块中心的扫描坐标
+        """
+        axes = []
+        for axis in self.axes:
+            axis = np.asarray(axis, dtype=float)
+            for _ in range(level):
+                if len(axis) % 2:
+                    axis = np.append(axis, np.nan)
+                axis = np.nanmean(axis.reshape(-1, 2), axis=1)
+            axes.append(axis)
+        return axes
+
+    def tile(self, level: int, x: slice = slice(None), y: slice = slice(None), stat: str = 'mean', index: int = 0):
+        """
+        只读取某一层中的一块区域，用于放大查看
+        :param level: 第几层
+        :param x: x方向的切片(该层的序号)
+        :param y: y方向的切片
+        :param stat: 'mean'、'min'或者'max'
+        :param index: 测量参数的序号
+        :return: (x坐标, y坐标, 形状为(nx, ny)的数据)
+        """
+        axes = self.level_axes(level)
+        return axes[0][x], axes[1][y], self.level(level, stat)[index, x, y]
+
+    def refresh(self):
+        """SWMR模式下读取正在写入的run时，更新数据集的形状和内容"""
+        for dataset in self.datasets.values():
+            dataset.refresh()
+
+    def close(self):
+        self.data = None
+        self.file.close()
+
+
+def block_reduce(rows: np.ndarray, function) -> np.ndarray:
+    """
+    对(测量参数个数, nx, 行数)的数据按2×行数的块化简，nx为奇数时最后一块只有一列
+    :param rows: 1行或2行数据
+    :param function: np.nanmean、np.nanmin或者np.nanmax
+    :return: 形状为(测量参数个数, ceil(nx / 2))的数组
+    """
+    n_meas, nx, n_rows = rows.shape
+    if nx % 2:
+        rows = np.concatenate([rows, np.full((n_meas, 1, n_rows), np.nan, dtype=rows.dtype)], axis=1)
+    return function(rows.reshape(n_meas, -1, 2, n_rows), axis=(2, 3))
+
+
+class Pyramid:
+    """
+    2d扫描数据的多分辨率金字塔：第n层的每个点对应原始数据中2^n×2^n的块，保存块内的平均值、最小值和最大值。
+    扫描每写入一行调用add_row()，凑满两行时计算上一层的一行并逐层向上传递，因此不需要在扫描结束后重新读取数据。
+    更高层的平均值由下一层的平均值计算，只有边缘不完整的块与原始数据的平均值略有差别。
+    """
+    stats = ('mean', 'min', 'max')
+    functions = {'mean': np.nanmean, 'min': np.nanmin, 'max': np.nanmax}
+
+    def __init__(self, levels: list, rows: int, write=None):
+        """
+        :param levels: 每一层的数据集，{'mean': dataset, 'min': dataset, 'max': dataset}，从第1层开始
+        :param rows: 原始数据的行数(y方向的点数)
+        :param write: 写入函数write(dataset, key, value)，默认直接写入，也可以传入Scan.store在后台写入
+        """
+        self.levels = levels
+        self.rows = [rows] + [level['mean'].shape[-1] for level in levels]
+        self.write = write if write is not None else self.write_direct
+        self._pending = [None] * len(levels)
+
+    @staticmethod
+    def write_direct(dataset, key, value):
+        dataset[key] = value
+
+    def add_row(self, idy: int, row: np.ndarray):
+        """
+        :param idy: 行号
+        :param row: 形状为(测量参数个数, nx)的一行数据
+        :return: None
+        """
+        row = np.asarray(row, dtype=float)
+        self.add(0, idy, {stat: row for stat in self.stats})
+
+    def add(self, level: int, idy: int, values: dict):
+        if level >= len(self.levels):
+            return
+        pending = self._pending[level]
+        if idy % 2 == 0 and idy < self.rows[level] - 1:
+            self._pending[level] = (idy, values)
+            return
+        if idy % 2 == 1:
+            if pending is None or pending[0] != idy - 1:
+                raise ValueError(f'The row {idy - 1} is missing at the pyramid level {level + 1}!')
+            stacked = {stat: np.stack([pending[1][stat], values[stat]], axis=-1) for stat in self.stats}
+        else:
+            stacked = {stat: values[stat][..., np.newaxis] for stat in self.stats}
+        self._pending[level] = None
+        reduced = {stat: block_reduce(stacked[stat], self.functions[stat]) for stat in self.stats}
+        for stat in self.stats:
+            self.write(self.levels[level][stat], (slice(None), slice(None), idy // 2), reduced[stat])
+        self.add(level + 1, idy // 2, reduced)
+
+    def rebuild(self, dataset, stop: int):
+        """从数据集中重新读入前stop行，用于resume"""
+        self._pending = [None] * len(self.levels)
+        for idy in range(stop):
+            self.add_row(idy, dataset[..., idy])
@@ -0,0 +1,179 @@
+import multiprocessing
+import queue
+import time
+import numpy as np
+
+
+class LiveStream:
+    """
+    将扫描中已经完成的数据发送给独立的viewer进程。
+    发送使用有界的multiprocessing.Queue和put_nowait，扫描循环永远不会因为viewer而阻塞；
+    viewer处理不过来时队列会满，此时直接丢弃该帧并计数，而不是让扫描等待。
+    只有描述图像形状的begin和end帧最多等待control_timeout，viewer也会忽略与当前begin不对应的数据。
+    viewer进程没有运行(没有启动或者已经退出)时不发送，队列中残留的数据也不会使解释器在退出时等待。
+    """
+
+    def __init__(self, maxsize: int = 32, decimate: int = 1, interval: float = 0.1, control_timeout: float = 1.):
+        """
+        :param maxsize: 队列长度上限
+        :param decimate: 2d扫描每一行沿x方向的抽取倍数
+        :param interval: 1d扫描两次发送之间的最短时间间隔，单位s
+        :param control_timeout: begin和end帧在队列满时最多等待的时间，单位s
+        """
+        self.maxsize = maxsize
+        self.queue = multiprocessing.Queue(maxsize)
+        self.decimate = decimate
+        self.interval = interval
+        self.dropped = 0
+        self.sent = 0
+        self.control_timeout = control_timeout
+        self.process = None
+        self.run_id = None
+        self._last = 0.
+        self._closed = False
+
+    def start_viewer(self, **kwargs):
+        """
+        启动viewer进程
+        :param kwargs: 传给viewer_main的参数
+        :return: None
+        """
+        if self._closed:
+            self.queue = multiprocessing.Queue(self.maxsize)
+            self._closed = False
+        self.process = multiprocessing.Process(target=viewer_main, args=(self.queue,), kwargs=kwargs, daemon=True)
+        self.process.start()
+
+    @property
+    def alive(self) -> bool:
+        """viewer进程是否正在运行"""
+        return self.process is not None and self.process.is_alive()
+
+    def publish(self, frame: dict, timeout: float = None) -> bool:
+        """
+        :param frame: 发送的帧
+        :param timeout: 队列满时最多等待的时间，None时不等待
+        :return: 是否发送成功
+        """
+        if not self.alive:
+            # 没有viewer读取时队列中的数据永远不会被取走，退出时不等待后台线程把它们写入管道
+            if not self._closed:
+                self.queue.cancel_join_thread()
+            self.dropped += 1
+            return False
+        try:
+            if timeout is None:
+                self.queue.put_nowait(frame)
+            else:
+                self.queue.put(frame, timeout=timeout)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.sent += 1
+        return True
+
+    def due(self) -> bool:
+        """距离上一次发送是否已经超过interval"""
+        now = time.perf_counter()
+        if now - self._last < self.interval:
+            return False
+        self._last = now
+        return True
+
+    def begin(self, run_id, ranges: list, names: list):
+        """
+        :param run_id: run id
+        :param ranges: 扫描范围
+        :param names: 测量参数的名字
+        :return: None
+        """
+        ranges = [np.asarray(ranges[0])[::self.decimate if len(ranges) == 2 else 1]] + list(ranges[1:])
+        self.run_id = run_id
+        self.publish({'kind': 'begin', 'run_id': run_id, 'ranges': ranges, 'names': list(names)},
+                     self.control_timeout)
+
+    def block(self, start: int, data: np.ndarray):
+        """
+        发送一段数据，data的最后一维为扫描的外层维度(1d为x，2d为y)，start为该段在外层维度上的起点
+        """
+        if data.ndim == 3:
+            data = data[:, ::self.decimate]
+        self.publish({'kind': 'block', 'run_id': self.run_id, 'start': start, 'data': np.array(data)})
+
+    def end(self):
+        self.publish({'kind': 'end', 'run_id': self.run_id}, self.control_timeout)
+
+    def close(self, timeout: float = 1.):
+        if self.alive:
+            try:
+                self.queue.put({'kind': 'close'}, timeout=timeout)
+            except queue.Full:
+                pass
+            self.process.join(timeout)
+        self.process = None
+        if not self._closed:
+            self.queue.cancel_join_thread()
+            self.queue.close()
+            self._closed = True
+
+
+class LiveImage:
+    """viewer进程中增量更新的图像，未测量的点为nan"""
+
+    def __init__(self):
+        self.run_id = None
+        self.ranges = []
+        self.names = []
+        self.image = np.zeros((0,))
+
+    def update(self, frame: dict):
+        if frame['kind'] == 'begin':
+            self.run_id = frame['run_id']
+            self.ranges = frame['ranges']
+            self.names = frame['names']
+            self.image = np.full((len(self.names),) + tuple(len(r) for r in self.ranges), np.nan)
+        elif frame['kind'] == 'block':
+            data = frame['data']
+            # begin帧丢失时图像仍然是上一个run的形状，忽略不对应的数据
+            if frame.get('run_id') != self.run_id or data.shape[:-1] != self.image.shape[:-1] or \
+                    frame['start'] + data.shape[-1] > self.image.shape[-1]:
+                return
+            self.image[..., frame['start']:frame['start'] + data.shape[-1]] = data
+
+
+def viewer_main(frames, plot: bool = True, refresh: float = 0.2):
+    """
+    viewer进程的入口：不断从队列中取出数据更新LiveImage，并按refresh的间隔重新绘图
+    :param frames: LiveStream.queue
+    :param plot: 是否用matplotlib绘图
+    :param refresh: 绘图刷新间隔，单位s
+    :return: None
+    """
+    image = LiveImage()
+    figure = None
+    if plot:
+        import matplotlib.pyplot as plt
+        plt.ion()
+        figure = plt.figure()
+    last = 0.
+    while True:
+        try:
+            frame = frames.get(timeout=refresh)
+        except queue.Empty:
+            frame = None
+        if frame is not None:
+            if frame['kind'] == 'close':
+                break
+            image.update(frame)
+        if figure is not None and image.run_id is not None and time.perf_counter() - last > refresh:
+            last = time.perf_counter()
+            figure.clf()
+            axes = figure.add_subplot(111)
+            if image.image.ndim == 2:
+                for num, name in enumerate(image.names):
+                    axes.plot(image.ranges[0], image.image[num], label=name)
+                axes.legend()
+            else:
+                axes.pcolormesh(image.ranges[0], image.ranges[1], image.image[0].T, shading='auto')
+            axes.set_title(f'id:{image.run_id} {image.names[0]}')
+            plt.pause(0.001)
@@ -1,8 +1,9 @@
 from matplotlib.pyplot import (figure, plot, xlabel, ylabel, title, xlim, ylim, yscale, xscale, legend, text, \
                                pcolormesh, colorbar, axhline, axvline, tick_params)
-from numpy import polyfit, poly1d, average, unique, shape, reshape
+from numpy import polyfit, poly1d, unique
 from numpy import linspace, max
 import numpy as np
+from tools.constants import generate_text
 
 
 def generate_label(tup):
@@ -12,37 +13,12 @@ def generate_label(tup):
     return label
 
 
-def generate_text(station, tup1=None, tup2=None):
-    text = ''
-    para_dict = station.components.copy()
-    try:
-        if tup1:
-            for parameter in tup1:
-                del para_dict[parameter.name]
-        if tup2:
-            for parameter in tup2:
-                del para_dict[parameter.name]
-    except:
-        pass
-
-    for parameter in para_dict.values():
-        # del para of 0
-        try:
-            if parameter.settable:
-                value = average(parameter())
-                if value == 0 or value == -1e-6:
-                    continue
-                unit = parameter.unit
-                text += parameter.name + " = " + "%.4g " % value + unit + "\n"
-        except:
-            pass
-    return text
-
-
 def generate_notes(project, run_id, start_time, end_time, para_meas=None, para_scan_x=None, para_scan_y=None,
                    memsize=None, sr=None, repeat=None):
     subtitle = f"id:{run_id} " + project.data_path + "\n" + start_time + " --- " + end_time + "\n" + f"sample: {project.sample_name}, T={project.temperature}, tester: {project.tester}"
-    text = generate_text(project.station, para_scan_x, para_scan_y)
+    # 当前run的快照已经在扫描开始时读取，不需要再次读取仪器
+    values = project.manager.snapshot if run_id == project.manager.id else None
+    text = generate_text(project.station, para_scan_x, para_scan_y, values)
 
     notes = {"text": text, "subtitle": subtitle, "comment": ""}
 
@@ -183,7 +159,7 @@ def plot_3d(x, y, z, notes, label_x=None, label_y=None, label_z=None, tit=None,
         tit = f"{notes['subtitle']}\n{notes['comment']}"
     title(tit)
 
-    text(min(x), max(y), notes["text"], fontsize=11, style="italic", alpha=alpha,
+    text(min(x), max(y), notes["text"] if notes else "", fontsize=11, style="italic", alpha=alpha,
          horizontalalignment="left", verticalalignment="top", visible=visible)
 
     xscale(scale_x)
@@ -225,3 +201,33 @@ def plot_raw(y, notes=None, marker=None, label_x="T (s)", label_y="Voltage (V)",
     elif notes:
         tit = f"{notes['subtitle']}\n{notes['comment']}"
     title(tit)
+
+
+def plot_run(run, notes=None, index=0, stat="mean", max_pixels=800, range_x=None, range_y=None, **kwargs):
+    """
+    按屏幕分辨率从金字塔中选择一层绘制2d扫描结果，只读取该层中需要显示的区域
+    :param run: DataManager.open_run返回的RunView
+    :param notes: 同plot_3d
+    :param index: 测量参数的序号
+    :param stat: 'mean'、'min'或者'max'
+    :param max_pixels: 每个方向最多显示的点数
+    :param range_x: 放大显示的x范围(xmin, xmax)，默认显示全部
+    :param range_y: 放大显示的y范围(ymin, ymax)，默认显示全部
+    :param kwargs: 传给plot_3d的其他参数
+    :return: 使用的层数
+    """
+    bounds = []
+    for axis, scan_range in zip(run.axes, (range_x, range_y)):
+        if scan_range is None:
+            bounds.append((0, len(axis)))
+        else:
+            inside = np.flatnonzero((axis >= min(scan_range)) & (axis <= max(scan_range)))
+            bounds.append((inside.min(), inside.max() + 1) if len(inside) else (0, len(axis)))
+    level = 0
+    while level < run.levels and max([stop - start for start, stop in bounds]) > max_pixels * 2 ** level:
+        level += 1
+    factor = 2 ** level
+    x, y, z = run.tile(level, *[slice(start // factor, -(-stop // factor)) for start, stop in bounds],
+                       stat=stat, index=index)
+    plot_3d(x, y, z.T, notes, **kwargs)
+    return level
@@ -0,0 +1,180 @@
+import queue
+import threading
+import time
+import h5py
+import numpy as np
+
+
+class AsyncWriter:
+    """
+    后台写入hdf5数据的线程：扫描循环只把数据放入有界队列，写盘在后台线程中完成，
+    磁盘(尤其是网络路径)的延迟不会出现在扫描点的时间里。
+    沿最后一维依次写入的切片(1d的点、2d的行)会合并，凑满一个chunk(连续存储时为max_batch个切片)再写入；
+    每隔flush_interval或者调用flush()时写入剩余的数据并刷新文件。
+    """
+
+    def __init__(self, maxsize: int = 256, flush_interval: float = 1., max_batch: int = 64):
+        """
+        :param maxsize: 队列长度上限，队列满时扫描循环会等待
+        :param flush_interval: 两次刷新文件的最长间隔，单位s
+        :param max_batch: 连续存储的数据集最多合并的切片数
+        """
+        self.queue = queue.Queue(maxsize)
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.error = None
+        self.items = 0
+        self.writes = 0
+        self.max_depth = 0
+        self.latency_total = 0.
+        self.latency_max = 0.
+        self._pending = {}
+        self._deferred = []
+        self._files = set()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def write(self, dataset, key, value):
+        """
+        相当于dataset[key] = value，但在后台线程中执行；value会被复制，调用之后可以继续修改
+        """
+        self.put(('write', time.perf_counter(), dataset, key, np.array(value)))
+
+    def after(self, function, *args):
+        """在之前放入队列的数据全部写入之后调用function(*args)，例如更新断点"""
+        self.put(('call', time.perf_counter(), function, args))
+
+    def put(self, item):
+        self.raise_error()
+        self.queue.put(item)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def flush(self, timeout: float = None):
+        """
+        等待队列中的数据全部写入并刷新文件
+        :param timeout: 最长等待时间，单位s
+        :return: None
+        """
+        if not self._thread.is_alive():
+            self.raise_error()
+            return
+        done = threading.Event()
+        self.queue.put(('flush', time.perf_counter(), done))
+        if not done.wait(timeout):
+            raise TimeoutError('The data is not written within the timeout!')
+        self.raise_error()
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(('close', time.perf_counter()))
+            self._thread.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('The background writer failed') from error
+
+    def statistics(self) -> dict:
+        """
+        :return: 当前队列深度、最大队列深度、写入的项数、实际写盘次数以及从放入队列到写入的平均和最大延迟(s)
+        """
+        return {'depth': self.queue.qsize(),
+                'max_depth': self.max_depth,
+                'items': self.items,
+                'writes': self.writes,
+                'latency_mean': self.latency_total / self.items if self.items else 0.,
+                'latency_max': self.latency_max}
+
+    def run(self):
+        last_flush = time.perf_counter()
+        while True:
+            timeout = max(self.flush_interval - (time.perf_counter() - last_flush), 0.)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            try:
+                if item is not None and item[0] == 'write':
+                    self.handle_write(*item[1:])
+                elif item is not None and item[0] == 'call':
+                    self._deferred.append(item[1:])
+                if item is None or item[0] in ('flush', 'close') or \
+                        time.perf_counter() - last_flush >= self.flush_interval:
+                    self.flush_files()
+                    last_flush = time.perf_counter()
+            except Exception as error:
+                # 出错后丢弃未写入的数据，错误在下一次put或flush时抛出
+                self.error = error
+                self._pending.clear()
+                self._deferred.clear()
+            if item is not None and item[0] == 'flush':
+                item[2].set()
+            if item is not None and item[0] == 'close':
+                break
+
+    def flush_files(self):
+        self.write_pending()
+        for file in self._files:
+            if file.id.valid:
+                file.flush()
+        self._files.clear()
+
+    def handle_write(self, enqueued: float, dataset, key, value):
+        outer = self.outer_index(dataset, key)
+        pending = self._pending.get(id(dataset))
+        if pending is not None and (outer is None or outer != pending['stop']):
+            self.write_pending(dataset)
+            pending = None
+        if outer is None:
+            dataset[key] = value
+            self.done(dataset, [enqueued])
+            return
+        if pending is None:
+            pending = self._pending[id(dataset)] = {'dataset': dataset, 'start': outer, 'stop': outer,
+                                                    'values': [], 'enqueued': []}
+        pending['values'].append(value)
+        pending['enqueued'].append(enqueued)
+        pending['stop'] = outer + 1
+        chunk = dataset.chunks[-1] if dataset.chunks is not None else self.max_batch
+        if pending['stop'] % chunk == 0 or pending['stop'] - pending['start'] >= max(chunk, self.max_batch):
+            self.write_pending(dataset)
+
+    @staticmethod
+    def outer_index(dataset, key):
+        """
+        :return: key为(其他维度全部, 最后一维的整数)时返回该整数，否则返回None(不合并，直接写入)
+        """
+        if not isinstance(dataset, h5py.Dataset):
+            return None
+        key = key if isinstance(key, tuple) else (key,)
+        if len(key) != dataset.ndim or any(part != slice(None) for part in key[:-1]):
+            return None
+        if isinstance(key[-1], (int, np.integer)):
+            return int(key[-1]) % dataset.shape[-1]
+        return None
+
+    def write_pending(self, dataset=None):
+        keys = [id(dataset)] if dataset is not None else list(self._pending)
+        for key in keys:
+            pending = self._pending.pop(key, None)
+            if pending is None:
+                continue
+            data = pending['dataset']
+            data[..., pending['start']:pending['stop']] = np.stack(pending['values'], axis=-1)
+            self.done(data, pending['enqueued'])
+        if not self._pending:
+            deferred, self._deferred = self._deferred, []
+            for enqueued, function, args in deferred:
+                function(*args)
+
+    def done(self, dataset, enqueued: list):
+        now = time.perf_counter()
+        self.writes += 1
+        self.items += len(enqueued)
+        for stamp in enqueued:
+            self.latency_total += now - stamp
+            self.latency_max = max(self.latency_max, now - stamp)
+        file = getattr(dataset, 'file', None)
+        if file is not None:
+            self._files.add(file)